@@ -33,43 +33,199 @@ Here is the syntax:
 
 Spaces in layer names are not supported.
 Layers with labels starting with _ will never be exported.
-Existing files will not be overwritten, unless --force is used.
+Existing files are only rewritten if their layers changed since the last run
+(as recorded in the .<base>.slayer.json manifest of <output-dir>), or with --force.
 Layers are stacked in the same order as in the original file.
 """
 
 
-import codecs
 import sys
 import os
+import re
+import copy
+import math
+import json
+import hashlib
 import argparse
-from copy import copy
-from xml.dom import minidom
+import multiprocessing
+from collections import OrderedDict
+from lxml import etree as ET
 
+from svgguru import stats, run_instrumented, add_stats_arguments, load_svg, \
+                    optimize_tree, add_optimize_arguments, \
+                    pop_optimize_arguments, svg_output, add_gzip_argument, \
+                    reference_index, reachable_definitions, \
+                    content_references, watch_files, ResultCache, \
+                    file_digest, add_cache_arguments, pop_cache_arguments
 
-LAYER_KEY = 'inkscape:groupmode'
+
+INKSCAPE_NS = 'http://www.inkscape.org/namespaces/inkscape'
+LAYER_KEY = '{%s}groupmode' % INKSCAPE_NS
 LAYER_VAL = 'layer'
-LABEL_KEY = 'inkscape:label'
+LABEL_KEY = '{%s}label' % INKSCAPE_NS
 STYLE_KEY = 'style'
+GROUP_TAG = '{http://www.w3.org/2000/svg}g'
+
+
+def load_layers(src):
+    """
+    Parse the SVG once, and detach all its labelled layers from the tree.
+
+    What remains in the tree is the part shared by all the exported files
+    (defs, metadata, unlabelled content). Layers are re-attached on demand
+    by `export_layerset`.
+
+    :param src: The source SVG to load: path, bytes, stream, or lxml tree
+                (which is then modified)
+    :return: (tree, layers), layers being a list of
+             (label, element, parent, anchor) in document order. `anchor` is
+             the index where the layer goes among the non-layer children of
+             `parent`.
+    """
+    tree = load_svg(src)
+    root = tree.getroot()
+    # lxml gives re-attached elements the first prefix the root declares for
+    # their namespace: drop the unused aliases of the default namespace (like
+    # Inkscape's xmlns:svg), or the layers would be written as <svg:g>.
+    default_ns = root.nsmap.get(None)
+    aliases = [prefix for prefix, uri in root.nsmap.items()
+               if prefix is not None and uri == default_ns]
+    if aliases:
+        ET.cleanup_namespaces(tree, keep_ns_prefixes=[
+            prefix for prefix in root.nsmap
+            if prefix is not None and prefix not in aliases])
+    layers = []
+    for g in root.iter(GROUP_TAG):
+        if g.get(LAYER_KEY) == LAYER_VAL and g.get(LABEL_KEY) is not None:
+            style = g.get(STYLE_KEY)
+            if style is not None:
+                # make sure the layer isn't hidden
+                g.set(STYLE_KEY, style.replace('display:none', ''))
+            parent = g.getparent()
+            layers.append([g.get(LABEL_KEY), g, parent, parent.index(g)])
+
+    # Detach, and convert the index into an anchor among remaining children.
+    previous_layers = {}
+    for layer in layers:
+        _, g, parent, index = layer
+        n_previous = previous_layers.get(parent, 0)
+        layer[3] = index - n_previous
+        previous_layers[parent] = n_previous + 1
+    for _, g, parent, _ in layers:
+        parent.remove(g)
+
+    return tree, [tuple(layer) for layer in layers]
 
 
 def get_layers(src):
     """
     Returns all layers in the given SVG that don't start with an underscore
 
-    :param src: The source SVG to load
+    :param src: The source SVG to load, or the layer list from `load_layers`
     :return:
     """
-    layers = []
-    svg = minidom.parse(open(src))
-    for g in svg.getElementsByTagName('g'):
-        if (
-            g.hasAttribute(LAYER_KEY) and
-            g.getAttribute(LAYER_KEY) == LAYER_VAL and
-            g.hasAttribute(LABEL_KEY) and
-            g.getAttribute(LABEL_KEY)[:1] != '_'
-        ):
-            layers.append(g.attributes[LABEL_KEY].value)
-    return layers
+    if not isinstance(src, list):
+        _, src = load_layers(src)
+    return [label for label, _, _, _ in src if label[:1] != '_']
+
+
+### Definitions (<defs> content) needed by each part of the document, indexed
+### once: the definitions kept in a frame are then found without rescanning.
+def index_defs(tree, layers):
+    """
+    Index which definitions the shared tree and each layer need.
+
+    :param tree: The tree returned by `load_layers`
+    :param layers: The layer list returned by `load_layers`
+    :return: (definitions, shared_needed, layers_needed), definitions being
+             a list of (definition, label of its layer or None, parent,
+             index in parent), and the others sets of definitions (one per
+             layer for layers_needed).
+    """
+    roots = [tree.getroot()] + [g for _, g, _, _ in layers]
+    definitions, owners, definition_refs = reference_index(roots)
+    labels = dict((g, label) for label, g, _, _ in layers)
+    located = []
+    for definition in definitions:
+        label = None
+        for ancestor in definition.iterancestors():
+            if ancestor in labels:
+                label = labels[ancestor]
+                break
+        parent = definition.getparent()
+        located.append((definition, label, parent, parent.index(definition)))
+    # The layers are detached: each root is scanned separately.
+    shared_needed = reachable_definitions(content_references(roots[0]),
+                                          owners, definition_refs)
+    layers_needed = [reachable_definitions(content_references(g), owners,
+                                           definition_refs)
+                     for g in roots[1:]]
+    stats.count('definitions', len(definitions))
+    return located, shared_needed, layers_needed
+
+
+def detach_unused_defs(defs_index, layers, layerset):
+    """Remove the definitions that the given layers and the shared tree do
+    not need. Return what `restore_defs` needs to put them back."""
+    definitions, shared_needed, layers_needed = defs_index
+    needed = set(shared_needed)
+    for (label, _, _, _), layer_needed in zip(layers, layers_needed):
+        if label in layerset:
+            needed.update(layer_needed)
+    removed = [(definition, parent, index)
+               for definition, label, parent, index in definitions
+               if definition not in needed
+               and (label is None or label in layerset)]
+    for definition, parent, _ in removed:
+        parent.remove(definition)
+    stats.count('definitions pruned', len(removed))
+    return removed
+
+
+def restore_defs(removed):
+    # In document order, so that the indices are right.
+    for definition, parent, index in removed:
+        parent.insert(index, definition)
+
+
+def export_layerset(tree, layers, layerset, dst, gzip_level=None,
+                    defs_index=None):
+    """
+    Write the shared tree with only the given layers attached.
+
+    The tree is left unchanged afterwards.
+
+    :param tree: The tree returned by `load_layers`
+    :param layers: The layer list returned by `load_layers`
+    :param layerset: The names of the layers to export
+    :param dst: The destination SVG to write to (path or binary stream). If
+                None, the SVG is returned as bytes.
+    :param gzip_level: Compression of dst (default: only for .svgz paths)
+    :param defs_index: If given (see `index_defs`), the unused definitions
+                       are not written
+    """
+    inserted, unfound = attach_layers(layers, layerset)
+    removed = []
+    try:
+        if unfound:
+            print('WARNING: unfound layers: ' + ', '.join(map(repr, unfound)),
+                  file=sys.stderr)
+        if defs_index is not None:
+            removed = detach_unused_defs(defs_index, layers, layerset)
+
+        exported = ET.tostring(tree, encoding='utf-8', xml_declaration=True)
+    finally:
+        restore_defs(removed)
+        detach_layers(inserted)
+
+    if dst is None:
+        return exported
+    with svg_output(dst, gzip_level) as out:
+        if hasattr(out, 'write'):
+            out.write(exported)
+        else:
+            with open(out, 'wb') as OUT:
+                OUT.write(exported)
 
 
 def export_layers(layerset, src, dst):
@@ -81,34 +237,9 @@ def export_layers(layerset, src, dst):
     :param dst: The destination SVG to write to
     :return:
     """
-    with open(src) as stream:
-        svg = minidom.parse(stream)
-
-    layerset = copy(layerset)
-
-    for g in svg.getElementsByTagName('g'):
-        if (
-            g.hasAttribute(LAYER_KEY) and
-            g.getAttribute(LAYER_KEY) == LAYER_VAL and
-            g.hasAttribute(LABEL_KEY)
-        ):
-            layername = g.getAttribute(LABEL_KEY)
-            if layername not in layerset:
-                # not the layer we want - remove
-                g.parentNode.removeChild(g)
-            else:
-                if g.hasAttribute(STYLE_KEY):
-                    # make sure the layer isn't hidden
-                    style = g.getAttribute(STYLE_KEY)
-                    style = style.replace('display:none', '')
-                    g.setAttribute(STYLE_KEY, style)
-                layerset.remove(layername)
-
-    if layerset:
-        print('WARNING: unfound layers: ' + ', '.join(map(repr, layerset)), file=sys.stderr)
-
-    exported = svg.toxml()
-    codecs.open(dst, "w", encoding="utf8").write(exported)
+    tree, layers = load_layers(src)
+    export_layerset(tree, layers, layerset, dst,
+                    defs_index=index_defs(tree, layers))
 
 
 def iter_layersets(layer_configfile):
@@ -150,10 +281,523 @@ def iter_add(layers):
         yield layer_set
 
 
+def iter_cfg_layersets(cfg, layers):
+    """Sets of layers of each output, following the cfg argument: None (one
+    output per layer), '+' (add each layer to the previous ones), a config
+    file, or an iterable of layer lists."""
+    if not cfg:
+        return ([layer] for layer in layers)
+    elif cfg == '+':
+        return iter_add(layers)
+    elif isinstance(cfg, str):
+        return iter_layersets(cfg)
+    return iter(cfg)
+
+
+def iter_frames(src, cfg=None, keep_defs=False):
+    """
+    Yield (layerset, svg bytes) for each output, without touching the disk.
+
+    :param src: path, bytes, stream or lxml tree (which is then modified)
+    :param cfg: see `iter_cfg_layersets`
+    :param keep_defs: Also write the definitions unused by the frame
+    """
+    tree, layers = load_layers(src)
+    defs_index = None if keep_defs else index_defs(tree, layers)
+    for layerset in iter_cfg_layersets(cfg, get_layers(layers)):
+        layerset = list(layerset)
+        yield layerset, export_layerset(tree, layers, layerset, None,
+                                        defs_index=defs_index)
+
+
+### Single-file outputs: each layer is written once, whatever the number of
+### frames using it.
+ANIMATION_MODES = ('smil', 'css', 'target', 'sprites')
+ANIMATION_FMT = '{base}_{mode}'
+SVG_NS = 'http://www.w3.org/2000/svg'
+XLINK_NS = 'http://www.w3.org/1999/xlink'
+# Temporary attribute locating the layers in a copy of the document.
+INDEX_KEY = 'slayer-layer-index'
+# Top-level elements that are not drawn (kept once in sprite sheets).
+UNRENDERED_TAGS = set('{%s}%s' % (SVG_NS, tag) for tag in
+                      ('defs', 'metadata', 'style', 'title', 'desc', 'script'))
+REG_DISPLAY = re.compile(r'(?:^|;)\s*display\s*:[^;]*')
+REG_LENGTH = re.compile(r'\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)(.*)')
+
+
+def attach_layers(layers, layerset):
+    """Insert the given layers into the shared tree.
+
+    Return the inserted elements (to be removed with `detach_layers`) and
+    the set of labels not found."""
+    unfound = set(layerset)
+    inserted_counts = {}
+    inserted = []
+    for label, g, parent, anchor in layers:
+        if label in layerset:
+            n_inserted = inserted_counts.get(parent, 0)
+            parent.insert(anchor + n_inserted, g)
+            inserted_counts[parent] = n_inserted + 1
+            inserted.append(g)
+            unfound.discard(label)
+    return inserted, unfound
+
+
+def detach_layers(inserted):
+    for g in inserted:
+        g.getparent().remove(g)
+
+
+def copy_with_layers(tree, layers, layerset, defs_index=None):
+    """Deep copy of the document with the given layers attached (and without
+    the definitions they do not need, if defs_index is given).
+
+    Return (copy, [(label, layer element of the copy)]) in document order."""
+    inserted, _ = attach_layers(layers, layerset)
+    removed = []
+    try:
+        if defs_index is not None:
+            removed = detach_unused_defs(defs_index, layers, layerset)
+        for i, (label, g, _, _) in enumerate(layers):
+            if label in layerset:
+                g.set(INDEX_KEY, str(i))
+        doc = copy.deepcopy(tree)
+    finally:
+        for g in inserted:
+            del g.attrib[INDEX_KEY]
+        restore_defs(removed)
+        detach_layers(inserted)
+    copies = []
+    for g in doc.getroot().iter(GROUP_TAG):
+        index = g.attrib.pop(INDEX_KEY, None)
+        if index is not None:
+            copies.append((layers[int(index)][0], g))
+    return doc, copies
+
+
+def show_layer(g):
+    """Remove the display property of the layer style (it would take
+    precedence over style sheets)."""
+    style = g.get(STYLE_KEY)
+    if style is not None:
+        style = REG_DISPLAY.sub('', style).lstrip(';')
+        if style:
+            g.set(STYLE_KEY, style)
+        else:
+            del g.attrib[STYLE_KEY]
+
+
+def visibility_changes(visible):
+    """[(frame index, visible)] where the visibility changes."""
+    return [(i, v) for i, v in enumerate(visible)
+            if i == 0 or v != visible[i - 1]]
+
+
+def enclosing_labels(copies):
+    """{layer element: labels of the layers enclosing it}"""
+    copies_set = dict((g, label) for label, g in copies)
+    return dict((g, [copies_set[ancestor] for ancestor in g.iterancestors()
+                     if ancestor in copies_set])
+                for _, g in copies)
+
+
+def format_seconds(seconds):
+    return ('%.3f' % seconds).rstrip('0').rstrip('.') + 's'
+
+
+def animate_smil(root, copies, layersets, duration):
+    total = format_seconds(duration * len(layersets))
+    for label, g in copies:
+        changes = visibility_changes([label in layerset
+                                      for layerset in layersets])
+        show_layer(g)
+        # Static renderers show the first frame.
+        g.set('display', 'inline' if changes[0][1] else 'none')
+        if len(changes) == 1:
+            continue
+        ET.SubElement(g, '{%s}animate' % SVG_NS, {
+            'attributeName': 'display',
+            'values': ';'.join('inline' if v else 'none' for _, v in changes),
+            'keyTimes': ';'.join('%g' % (float(i) / len(layersets))
+                                 for i, _ in changes),
+            'dur': total,
+            'calcMode': 'discrete',
+            'repeatCount': 'indefinite'})
+
+
+def animate_css(root, copies, layersets, duration):
+    total = format_seconds(duration * len(layersets))
+    keyframes = OrderedDict()  # One animation per distinct visibility.
+    rules = []
+    enclosing = enclosing_labels(copies)
+    for k, (label, g) in enumerate(copies):
+        # A visible sublayer would show through its hidden parent layer.
+        changes = visibility_changes([
+            label in layerset and layerset.issuperset(enclosing[g])
+            for layerset in map(set, layersets)])
+        show_layer(g)
+        g.set('visibility', 'visible' if changes[0][1] else 'hidden')
+        if len(changes) == 1:
+            continue
+        name = keyframes.setdefault(tuple(changes), 'slayer-k%d' % len(keyframes))
+        layer_class = 'slayer-l%d' % k
+        g.set('class', ' '.join(filter(None, (g.get('class'), layer_class))))
+        rules.append('.%s { animation: %s %s step-end infinite; }'
+                     % (layer_class, name, total))
+    lines = []
+    for changes, name in keyframes.items():
+        steps = ['%g%% { visibility: %s; }'
+                 % (100. * i / len(layersets), 'visible' if v else 'hidden')
+                 for i, v in changes]
+        # Explicit end state: otherwise the base value is interpolated to.
+        steps.append('100%% { visibility: %s; }'
+                     % ('visible' if changes[-1][1] else 'hidden'))
+        lines.append('@keyframes %s { %s }' % (name, ' '.join(steps)))
+    add_stylesheet(root, lines + rules)
+
+
+def animate_target(root, copies, layersets, start=0):
+    """Frame <n> is displayed when the url ends with '#frame<n>' (the first
+    one by default)."""
+    frame_markers = []
+    shown = [[] for _ in layersets]
+    lines = ['.slayer-layer { display: none; }',
+             '.slayer-first { display: inline; }',
+             '.slayer-frame:target ~ .slayer-layer, '
+             '.slayer-frame:target ~ * .slayer-layer { display: none; }']
+    for k, (label, g) in enumerate(copies):
+        show_layer(g)
+        classes = [g.get('class'), 'slayer-layer', 'slayer-l%d' % k]
+        if label in layersets[0]:
+            classes.append('slayer-first')
+        g.set('class', ' '.join(filter(None, classes)))
+        for i, layerset in enumerate(layersets):
+            if label in layerset:
+                shown[i].append(k)
+    for i, layer_indices in enumerate(shown, start=start):
+        frame_markers.append(ET.Element('{%s}g' % SVG_NS,
+                                        {'id': 'frame%d' % i,
+                                         'class': 'slayer-frame'}))
+        if layer_indices:
+            lines.append(', '.join('#frame%d:target ~ .slayer-l%d, '
+                                   '#frame%d:target ~ * .slayer-l%d'
+                                   % (i, k, i, k) for k in layer_indices)
+                         + ' { display: inline; }')
+    # The markers must precede all the layers, for the '~' combinator.
+    for marker in reversed(frame_markers):
+        root.insert(0, marker)
+    add_stylesheet(root, lines)
+
+
+def add_stylesheet(root, lines):
+    style = ET.Element('{%s}style' % SVG_NS, type='text/css')
+    style.text = '\n' + '\n'.join(lines) + '\n'
+    root.insert(0, style)
+
+
+def parse_size(value, default):
+    """(number, unit) of a width/height attribute."""
+    match = REG_LENGTH.match(value or '')
+    if match is None or match.group(2).strip() == '%':
+        return default, ''
+    return float(match.group(1)), match.group(2).strip()
+
+
+def paint_segments(elem, copies_set, ancestors, labels=(), wrappers=()):
+    """Split the content of elem in paint order: yield (labels, [elements],
+    wrappers), where labels are the layers that must all be shown for the
+    elements to be visible, and wrappers are the groups enclosing the
+    elements (between elem and them)."""
+    shared = []
+    for child in elem:
+        if not isinstance(child.tag, str):
+            continue
+        if child in ancestors:
+            # Layer or group containing layers: split it too.
+            if shared:
+                yield labels, shared, wrappers
+                shared = []
+            child_labels = labels
+            if child in copies_set:
+                child_labels += (copies_set[child],)
+            for segment in paint_segments(child, copies_set, ancestors,
+                                          child_labels, wrappers + (child,)):
+                yield segment
+        elif child in copies_set:
+            if shared:
+                yield labels, shared, wrappers
+                shared = []
+            yield labels + (copies_set[child],), [child], wrappers
+        else:
+            shared.append(child)
+    if shared:
+        yield labels, shared, wrappers
+
+
+def sprite_sheet(doc, copies, layersets, columns=None, start=0):
+    """Lay the frames out on a grid. Each part of the drawing is defined once
+    and used by the frames where it is visible. Frame <n> can also be
+    displayed alone with the url '#frame<n>'."""
+    root = doc.getroot()
+    nsmap = dict(root.nsmap)
+    nsmap.setdefault('xlink', XLINK_NS)
+    sheet = ET.Element(root.tag, dict(root.attrib), nsmap=nsmap)
+    sheet.text = root.text
+    viewbox = root.get('viewBox')
+    width, width_unit = parse_size(root.get('width'), None)
+    height, height_unit = parse_size(root.get('height'), None)
+    if viewbox is not None:
+        _, _, vb_width, vb_height = [float(x) for x in
+                                     viewbox.replace(',', ' ').split()]
+    else:
+        vb_width, vb_height = width or 100., height or 100.
+        viewbox = '0 0 %g %g' % (vb_width, vb_height)
+    columns = columns or int(math.ceil(math.sqrt(len(layersets))))
+    rows = int(math.ceil(float(len(layersets)) / columns))
+    sheet.set('viewBox', '0 0 %g %g' % (columns * vb_width, rows * vb_height))
+    if width is not None:
+        sheet.set('width', '%g%s' % (columns * width, width_unit))
+    if height is not None:
+        sheet.set('height', '%g%s' % (rows * height, height_unit))
+
+    # Non-drawn elements are kept as is.
+    for child in list(root):
+        if child.tag in UNRENDERED_TAGS or not isinstance(child.tag, str) \
+                or not child.tag.startswith('{%s}' % SVG_NS):
+            sheet.append(child)
+
+    copies_set = dict((g, label) for label, g in copies)
+    ancestors = set(ancestor for _, g in copies
+                    for ancestor in g.iterancestors())
+    defs = ET.SubElement(sheet, '{%s}defs' % SVG_NS)
+    for _, g in copies:
+        show_layer(g)
+    segments = []
+    for k, (labels, elements, wrappers) in enumerate(
+            paint_segments(root, copies_set, ancestors)):
+        group = container = ET.SubElement(defs, '{%s}g' % SVG_NS,
+                                          id='slayer-s%d' % k)
+        for wrapper in wrappers:
+            container = ET.SubElement(container, wrapper.tag,
+                                      dict(wrapper.attrib))
+            container.attrib.pop('id', None)
+        for element in elements:
+            container.append(element)
+        segments.append((set(labels), group.get('id')))
+
+    for i, layerset in enumerate(layersets):
+        x = (i % columns) * vb_width
+        y = (i // columns) * vb_height
+        ET.SubElement(sheet, '{%s}view' % SVG_NS, id='frame%d' % (i + start),
+                      viewBox='%g %g %g %g' % (x, y, vb_width, vb_height))
+        cell = ET.SubElement(sheet, '{%s}svg' % SVG_NS,
+                             x='%g' % x, y='%g' % y, width='%g' % vb_width,
+                             height='%g' % vb_height, viewBox=viewbox)
+        layerset = set(layerset)
+        for labels, segment_id in segments:
+            if layerset.issuperset(labels):
+                ET.SubElement(cell, '{%s}use' % SVG_NS,
+                              {'{%s}href' % XLINK_NS: '#' + segment_id})
+    return ET.ElementTree(sheet)
+
+
+def export_animation(tree, layers, layersets, dst, mode='smil',
+                     frame_duration=1., columns=None, start=0,
+                     gzip_level=None, defs_index=None):
+    """
+    Write all the frames into a single SVG, where each layer appears once.
+
+    :param tree: The tree returned by `load_layers` (left unchanged)
+    :param layers: The layer list returned by `load_layers`
+    :param layersets: The list of layer names of each frame
+    :param dst: The destination SVG (path or binary stream). If None, the
+                SVG is returned as bytes.
+    :param mode: How frames are displayed, one of ANIMATION_MODES: 'smil' or
+                 'css' animation, 'target' (frame n displayed by the url
+                 fragment '#frame<n>'), or 'sprites' (all frames on a grid)
+    :param frame_duration: In seconds, for 'smil' and 'css'
+    :param columns: Of the sprite sheet (default: about a square)
+    :param start: Number of the first frame, in frame ids
+    :param defs_index: If given (see `index_defs`), the definitions unused by
+                       all frames are not written
+    """
+    if mode not in ANIMATION_MODES:
+        raise ValueError('Unknown animation mode %r' % mode)
+    used = set(label for layerset in layersets for label in layerset)
+    unfound = used.difference(label for label, _, _, _ in layers)
+    if unfound:
+        print('WARNING: unfound layers: ' + ', '.join(map(repr, unfound)),
+              file=sys.stderr)
+    doc, copies = copy_with_layers(tree, layers, used, defs_index)
+    root = doc.getroot()
+    if mode == 'smil':
+        animate_smil(root, copies, layersets, frame_duration)
+    elif mode == 'css':
+        animate_css(root, copies, layersets, frame_duration)
+    elif mode == 'target':
+        animate_target(root, copies, layersets, start)
+    else:
+        doc = sprite_sheet(doc, copies, layersets, columns, start)
+
+    exported = ET.tostring(doc, encoding='utf-8', xml_declaration=True)
+    if dst is None:
+        return exported
+    with svg_output(dst, gzip_level) as out:
+        if hasattr(out, 'write'):
+            out.write(exported)
+        else:
+            with open(out, 'wb') as OUT:
+                OUT.write(exported)
+
+
+### Incremental export: a manifest records what each output was made of.
+MANIFEST_FMT = '.{base}.slayer.json'
+# Number of workers when not specified (None: number of cpus).
+DEFAULT_JOBS = None
+
+
+def hash_bytes(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def hash_layers(tree, layers):
+    """Content hashes of the shared document parts and of each layer
+    subtree (without its sublayers, which are hashed separately)."""
+    shared = hash_bytes(ET.tostring(tree))
+    layer_hashes = [hash_bytes(ET.tostring(g, with_tail=False))
+                    for _, g, _, _ in layers]
+    return shared, layer_hashes
+
+
+def frame_hash(shared_hash, layers, layer_hashes, layerset):
+    """Hash of everything that ends up in the frame."""
+    parts = [shared_hash]
+    for (label, _, parent, anchor), layer_hash in zip(layers, layer_hashes):
+        if label in layerset:
+            # Also record where the layer is, in case it was moved.
+            parts.append('%s:%s:%d:%s' % (label, parent.get('id'), anchor,
+                                          layer_hash))
+    return hash_bytes(' '.join(parts).encode('utf-8'))
+
+
+def read_manifest(manifest_file):
+    try:
+        with open(manifest_file) as IN:
+            return json.load(IN)
+    except (IOError, ValueError):
+        return {}
+
+
+def build_manifest(infile, shared_hash, layers, layer_hashes, frames):
+    return {'source': os.path.basename(infile),
+            'shared': shared_hash,
+            'layers': dict(zip((l[0] for l in layers), layer_hashes)),
+            'frames': frames}
+
+
+def write_manifest(manifest_file, manifest):
+    tmpfile = manifest_file + '.tmp'
+    with open(tmpfile, 'w') as OUT:
+        json.dump(manifest, OUT, indent=1, sort_keys=True)
+    os.replace(tmpfile, manifest_file)
+
+
+# Document loaded once per worker process (inherited when forking).
+_worker_doc = None
+
+
+def load_document(infile, optimize=None, keep_defs=False):
+    """`load_layers`, then optimize the document and the layers if
+    `optimize` (the precision of numbers) is not None, and index their
+    definitions unless keep_defs.
+
+    Return (tree, layers, defs_index)."""
+    tree, layers = load_layers(infile)
+    if optimize is not None:
+        optimize_tree(tree, optimize, [g for _, g, _, _ in layers])
+    defs_index = None if keep_defs else index_defs(tree, layers)
+    return tree, layers, defs_index
+
+
+def _init_worker(infile, optimize=None, keep_defs=False):
+    global _worker_doc
+    if _worker_doc is None:
+        _worker_doc = load_document(infile, optimize, keep_defs)
+
+
+def _export_job(job):
+    """Worker function: export one frame, never raise."""
+    layerset, outfile, gzip_level = job
+    tree, layers, defs_index = _worker_doc
+    try:
+        export_layerset(tree, layers, layerset, outfile, gzip_level,
+                        defs_index)
+    except Exception as err:
+        return outfile, '%s: %s' % (type(err).__name__, err)
+    return outfile, None
+
+
+### Result cache (--cache-dir): frames by hash of their content, and whole
+### runs by hash of the input, so that cached runs need no parsing.
+def run_cache_key(infile, cfg, *options):
+    """Key of a whole run: the input and config contents, and the options
+    changing the outputs."""
+    cfg_key = file_digest(cfg) if cfg and os.path.isfile(cfg) else cfg
+    return ResultCache.key('svg_slayer', file_digest(infile), cfg_key,
+                           *options)
+
+
+def frame_cache_key(content_hash, layerset, mode, ext, optimize):
+    """Key of one output, of the given content hash (see `frame_hash`)."""
+    return ResultCache.key('svg_slayer frame', content_hash, layerset, mode,
+                           ext, optimize)
+
+
+def fetch_cached_run(cache, run_key, outdir, manifest_file):
+    """Put all the outputs of the cached run into outdir, and record them in
+    the manifest. Return False if the run is not (entirely) cached."""
+    data = cache.fetch_data(run_key)
+    if data is None:
+        return False
+    record = json.loads(data.decode('utf-8'))
+    for outname, key in sorted(record['outputs'].items()):
+        outfile = os.path.join(outdir, outname)
+        if not cache.fetch(key, outfile):
+            return False
+        print("OUT:  %s (cached)" % outfile)
+    stats.count('frames cached', len(record['outputs']))
+    manifest = read_manifest(manifest_file)
+    manifest.update(record['manifest'])
+    manifest['frames'] = dict(manifest.get('frames', {}),
+                              **record['manifest']['frames'])
+    write_manifest(manifest_file, manifest)
+    return True
+
+
+def store_cached_run(cache, run_key, outputs, manifest):
+    """Record the outputs {outname: frame key} of a run, with the manifest of
+    its frames only."""
+    manifest = dict(manifest,
+                    frames=dict((outname, manifest['frames'][outname])
+                                for outname in outputs))
+    cache.store_data(run_key, json.dumps({'outputs': outputs,
+                                          'manifest': manifest},
+                                         sort_keys=True).encode('utf-8'))
+
+
 def extract_layers_fromfile(infile, outdir, cfg=None, force=False,
-                            outfmt='{base}_{num:02d}', start=0, list_layers=False):
+                            outfmt='{base}_{num:02d}', start=0, list_layers=False,
+                            jobs=None, optimize=None, gzip_level=None,
+                            mode='frames', frame_duration=1., columns=None,
+                            keep_defs=False, cache=None):
     """
+    Export the frames of infile into outdir: one file per frame, or a
+    single file if mode is one of ANIMATION_MODES (see `export_animation`).
+    Results stored in cache (a `svgguru.ResultCache`) are reused, unless
+    force.
     """
+    global _worker_doc
+
     if not os.path.isfile(infile):
         print("ERROR: Can't find %s" % infile, file=sys.stderr)
         return 1
@@ -163,44 +807,143 @@ def extract_layers_fromfile(infile, outdir, cfg=None, force=False,
         return 1
 
     base, _ = os.path.splitext(os.path.basename(infile))
-    outfmt = os.path.join(outdir, outfmt + ".svg")
+    ext = ".svgz" if gzip_level else ".svg"
+    manifest_file = os.path.join(outdir, MANIFEST_FMT.format(base=base))
+    run_key = None
+    if cache is not None and not list_layers and not force:
+        with stats.phase('cache'):
+            run_key = run_cache_key(infile, cfg, outfmt, ext, start, mode,
+                                    frame_duration, columns, keep_defs,
+                                    optimize, gzip_level)
+            if fetch_cached_run(cache, run_key, outdir, manifest_file):
+                return 0
+    outfmt = os.path.join(outdir, outfmt + ext)
     
-    layers = get_layers(infile)
+    with stats.phase('parse'):
+        tree, all_layers, defs_index = load_document(infile, optimize,
+                                                     keep_defs)
+    layers = get_layers(all_layers)
+    stats.count('layers', len(all_layers))
     print("INFO: Found %d suitable layers" % len(layers), file=sys.stderr)
 
     if list_layers:
         print('\n'.join(layer for layer in layers))
         return 0
 
-    if not cfg:
-        iter_layers = ([layer] for layer in layers)
-    elif cfg == '+':
-        iter_layers = iter_add(layers)
-    else:
-        iter_layers = iter_layersets(cfg)
-
-        #for layer in layers:
-        #    outfile = "%s.svg" % os.path.join(outdir, layer)
-        #    if os.path.isfile(outfile):
-        #        print("%s - %s exists, skipped" % (layer, outfile))
-        #        continue
-        #    else:
-        #        export_layers(set((layer,)), infile, outfile)
-        #        print("%s - %s exported" % (layer, outfile))
+    iter_layers = iter_cfg_layersets(cfg, layers)
+
+    manifest = read_manifest(manifest_file)
+    old_frames = manifest.get('frames', {})
+    with stats.phase('hash'):
+        shared_hash, layer_hashes = hash_layers(tree, all_layers)
+    # Pruning or not the definitions changes the output.
+    frame_key = shared_hash if keep_defs else shared_hash + ' prunedefs'
+    # Also keep the records of the outputs of other modes.
+    frames = dict(old_frames)
+    # Cache keys of the outputs of this run.
+    outputs = {}
+
+    def up_to_date(outfile, layerset):
+        """Whether outfile can be kept (or fetched from the cache)."""
+        outname = os.path.basename(outfile)
+        if cache is not None:
+            outputs[outname] = frame_cache_key(frames[outname], layerset,
+                                               mode, ext, optimize)
+        if (not force and os.path.isfile(outfile)
+                and old_frames.get(outname) == frames[outname]):
+            print("SKIP: %s is up to date" % outfile)
+            if cache is not None \
+                    and not os.path.exists(cache.path(outputs[outname])):
+                cache.store(outputs[outname], outfile)
+            return True
+        if cache is not None and not force \
+                and cache.fetch(outputs[outname], outfile):
+            print("OUT:  %s (cached)" % outfile)
+            return True
+        return False
+
+    if mode != 'frames':
+        layersets = [list(layerset) for layerset in iter_layers]
+        outfile = os.path.join(outdir, ANIMATION_FMT.format(base=base, mode=mode)
+                                       + ext)
+        outname = os.path.basename(outfile)
+        frames[outname] = hash_bytes(' '.join(
+                [mode, repr(frame_duration), repr(columns), str(start)]
+                + [frame_hash(frame_key, all_layers, layer_hashes, layerset)
+                   for layerset in layersets]).encode('utf-8'))
+        if up_to_date(outfile, layersets):
+            stats.count('frames skipped', len(layersets))
+        else:
+            with stats.phase('export'):
+                export_animation(tree, all_layers, layersets, outfile, mode,
+                                 frame_duration, columns, start, gzip_level,
+                                 defs_index)
+            print("OUT:  %s exported (%d frames)" % (outfile, len(layersets)))
+            stats.count('frames written', len(layersets))
+            if cache is not None:
+                cache.store(outputs[outname], outfile)
+        manifest = build_manifest(infile, shared_hash, all_layers,
+                                  layer_hashes, frames)
+        write_manifest(manifest_file, manifest)
+        if run_key is not None:
+            store_cached_run(cache, run_key, outputs, manifest)
+        return 0
 
+    todo = []
     for i, layerset in enumerate(iter_layers, start=start):
+        layerset = list(layerset)  # iter_add yields the same list each time
         outfile = outfmt.format(num=i, base=base, layers=layerset)
-        if os.path.isfile(outfile) and not force:
-            print("SKIP: %s exists, skipped" % outfile)
+        outname = os.path.basename(outfile)
+        frames[outname] = frame_hash(frame_key, all_layers, layer_hashes,
+                                     layerset)
+        if up_to_date(outfile, layerset):
+            stats.count('frames skipped')
             continue
-        else:
-            export_layers(layerset, infile, outfile)
-            print("OUT:  %s exported" % outfile)
-
-    return 0
-
-
-def main():
+        todo.append((layerset, outfile, gzip_level))
+
+    jobs = min(jobs or DEFAULT_JOBS or os.cpu_count() or 1, len(todo))
+    failed = 0
+    _worker_doc = (tree, all_layers, defs_index)
+    pool = None
+    try:
+        with stats.phase('export'):
+            if jobs <= 1:
+                results = map(_export_job, todo)
+            else:
+                pool = multiprocessing.Pool(jobs, _init_worker,
+                                            (infile, optimize, keep_defs))
+                results = pool.imap(_export_job, todo)
+            for outfile, error in results:
+                if error:
+                    failed += 1
+                    frames.pop(os.path.basename(outfile), None)
+                    print("ERROR: %s: %s" % (outfile, error), file=sys.stderr)
+                else:
+                    print("OUT:  %s exported" % outfile)
+                    stats.count('frames written')
+                    if cache is not None:
+                        cache.store(outputs[os.path.basename(outfile)],
+                                    outfile)
+            if pool is not None:
+                pool.close()
+                pool.join()
+                pool = None
+    finally:
+        if pool is not None:
+            # Interrupted: do not wait for the remaining frames.
+            pool.terminate()
+            pool.join()
+        _worker_doc = None
+
+    manifest = build_manifest(infile, shared_hash, all_layers, layer_hashes,
+                              frames)
+    write_manifest(manifest_file, manifest)
+    if run_key is not None and not failed:
+        store_cached_run(cache, run_key, outputs, manifest)
+    return 1 if failed else 0
+
+
+def build_parser():
     parser = argparse.ArgumentParser(description=__doc__, epilog=EPILOG,
                 formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument('infile')
@@ -208,7 +951,9 @@ def main():
     parser.add_argument('cfg', nargs='?',
                         help='If not given, extract all layers into separate files.')
     parser.add_argument('-f', '--force', action='store_true',
-                        help='Overwrite existing files')
+                        help='Overwrite existing files, even if up to date')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='Number of worker processes [number of cpus]')
     outfmt_group = parser.add_mutually_exclusive_group()
     outfmt_group.add_argument('-b', '--beamer', '--multiinclude',
                         action='store_const', dest='outfmt', const='{base}-{num:d}',
@@ -224,7 +969,51 @@ def main():
                         help='Where to start the output count [%(default)s]')
     parser.add_argument('-l', '--list-layers', '--list', action='store_true',
                         help='List layers. No output.')
-    return extract_layers_fromfile(**vars(parser.parse_args()))
+    parser.add_argument('-m', '--mode', choices=('frames',) + ANIMATION_MODES,
+                        default='frames',
+                        help=("'frames': one file per frame; else a single "
+                              "file '%s.svg' where each layer appears once, "
+                              "animated with 'smil' or 'css', showing frame "
+                              "<n> at the url 'file.svg#frame<n>' ('target'), "
+                              "or with all frames on a grid ('sprites') "
+                              "[%%(default)s]" % ANIMATION_FMT))
+    parser.add_argument('-d', '--frame-duration', type=float, default=1.,
+                        help='In seconds, for animations [%(default)s]')
+    parser.add_argument('-c', '--columns', type=int,
+                        help='Of the sprite sheet [about a square]')
+    parser.add_argument('-k', '--keep-defs', action='store_true',
+                        help=("Keep the definitions (gradients, markers...) "
+                              "that no exported layer uses"))
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help=("Keep running, and re-export the frames whose "
+                              "layers changed each time infile or cfg changes"))
+    add_stats_arguments(parser)
+    add_optimize_arguments(parser)
+    add_gzip_argument(parser)
+    add_cache_arguments(parser)
+    return parser
+
+
+def main(argv=None, parser=None):
+    parser = parser or build_parser()
+    args = vars(parser.parse_args(argv))
+    instrument = dict((key, args.pop(key))
+                      for key in ('show_stats', 'stats_json', 'profile'))
+    args['optimize'] = pop_optimize_arguments(args)
+    args['cache'] = pop_cache_arguments(args)
+    if args.pop('watch'):
+        # The manifest limits each run to the frames whose layers changed.
+        paths = [args['infile']]
+        if args['cfg'] and os.path.isfile(args['cfg']):
+            paths.append(args['cfg'])
+        return watch_files(paths,
+                           lambda: run_instrumented(extract_layers_fromfile,
+                                                    kwargs=args, **instrument))
+    status = run_instrumented(extract_layers_fromfile, kwargs=args,
+                              **instrument)
+    if args['cache'] is not None:
+        args['cache'].prune()
+    return status
 
 
 if __name__ == "__main__":
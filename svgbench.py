@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function
+
+"""Benchmark svgguru commands and svg_slayer on synthetic svg files."""
+
+# USAGE:
+#     ./svgbench.py generate <outfile> [--nodes N ...]
+#     ./svgbench.py run [--nodes N ...] [--save results.json] [--baseline base.json]
+
+
+import sys
+import os
+import json
+import time
+import random
+import shutil
+import tempfile
+import platform
+import argparse
+import resource
+import multiprocessing
+
+from lxml import etree as ET
+
+import svgguru
+import svg_slayer
+
+
+### Synthetic svg generator
+SVG_HEADER = '''<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<svg
+   xmlns:dc="http://purl.org/dc/elements/1.1/"
+   xmlns:cc="http://creativecommons.org/ns#"
+   xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+   xmlns:svg="http://www.w3.org/2000/svg"
+   xmlns="http://www.w3.org/2000/svg"
+   xmlns:xlink="http://www.w3.org/1999/xlink"
+   xmlns:sodipodi="http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd"
+   xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape"
+   width="1000" height="1000" viewBox="0 0 1000 1000" id="svg2" version="1.1">
+  <sodipodi:namedview id="base" pagecolor="#ffffff" bordercolor="#666666"
+     inkscape:current-layer="layer0" />
+'''
+
+TEXT_STYLE = ('font-style:normal;font-weight:normal;font-size:%dpx;'
+              'line-height:125%%;font-family:sans-serif;text-anchor:%s;'
+              'fill:%s;fill-opacity:1;stroke:none')
+SHAPE_STYLE = ('opacity:1;fill:%s;fill-opacity:1;stroke:%s;stroke-width:%d;'
+               'stroke-linecap:butt;stroke-linejoin:round')
+GENERATOR_DEFAULTS = dict(nodes=10000, text_density=0.3, tspans=1, colors=20,
+                          depth=3, layers=5, seed=0)
+
+
+def generate_svg(out, nodes=10000, text_density=0.3, tspans=1, colors=20,
+                 depth=3, layers=5, seed=0):
+    """Write a synthetic Inkscape-like svg to the `out` stream.
+
+    - nodes: approximate number of drawing elements (shapes + texts);
+    - text_density: fraction of these elements that are text;
+    - tspans: number of tspan per text;
+    - colors: number of distinct colors;
+    - depth: nesting depth of the groups inside each layer;
+    - layers: number of Inkscape layers.
+    """
+    rand = random.Random(seed)
+    palette = ['#%06x' % rand.randrange(1 << 24) for _ in range(max(colors, 1))]
+    layers = max(layers, 1)
+
+    out.write(SVG_HEADER)
+    out.write('  <defs id="defs4">\n')
+    for i in range(min(colors, 10)):
+        out.write('    <linearGradient id="grad%d"><stop offset="0" '
+                  'style="stop-color:%s;stop-opacity:1" /></linearGradient>\n'
+                  % (i, palette[i]))
+    out.write('  </defs>\n')
+
+    per_layer = max(nodes // layers, 1)
+    uid = 0
+    for layer in range(layers):
+        out.write('  <g inkscape:groupmode="layer" inkscape:label="layer%d" '
+                  'id="layer%d" style="display:inline">\n' % (layer, layer))
+        for i in range(per_layer):
+            # Open/close groups so that the nesting varies up to `depth`.
+            if depth and i % 50 == 0:
+                if i:
+                    out.write('</g>' * depth + '\n')
+                for level in range(depth):
+                    out.write('<g id="g%d-%d-%d">' % (layer, i, level))
+            uid += 1
+            x, y = rand.uniform(0, 1000), rand.uniform(0, 1000)
+            if rand.random() < text_density:
+                style = TEXT_STYLE % (rand.choice((8, 10, 12, 16)),
+                                      rand.choice(('start', 'middle', 'end')),
+                                      rand.choice(palette))
+                out.write('<text x="%.3f" y="%.3f" id="text%d" style="%s">'
+                          % (x, y, uid, style))
+                for k in range(tspans):
+                    out.write('<tspan sodipodi:role="line" x="%.3f" y="%.3f" '
+                              'style="font-size:%dpx">label %d</tspan>'
+                              % (x, y + 12 * k, rand.choice((8, 10, 12)), uid))
+                out.write('</text>\n')
+            elif i % 2:
+                out.write('<path d="m %.3f,%.3f %.3f,%.3f h 5 v 5 z" id="path%d" '
+                          'style="%s" />\n'
+                          % (x, y, rand.uniform(-20, 20), rand.uniform(-20, 20),
+                             uid, SHAPE_STYLE % (rand.choice(palette),
+                                                 rand.choice(palette),
+                                                 rand.randint(1, 3))))
+            else:
+                out.write('<rect x="%.3f" y="%.3f" width="10" height="10" '
+                          'id="rect%d" style="%s" />\n'
+                          % (x, y, uid, SHAPE_STYLE % (rand.choice(palette),
+                                                       rand.choice(palette),
+                                                       rand.randint(1, 3))))
+        if depth:
+            out.write('</g>' * depth + '\n')
+        out.write('  </g>\n')
+    out.write('</svg>\n')
+
+
+### Benchmark cases. Each one runs in a fresh process, to measure peak RSS.
+CMD_BENCH_ARGS = {'resizefont': dict(factor=1.5),
+                  'thicken': dict(factor=2.),
+                  'rescale': dict(factor=2.)}
+# Commands doing more than applying their rules: timed as a whole.
+WHOLE_COMMANDS = ('rescale',)
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def bench_command(command, infile, outfile, engine='tree'):
+    """Time the phases of a svgguru command."""
+    kwargs = CMD_BENCH_ARGS.get(command, {})
+    rules_func = getattr(svgguru, 'rules_' + command, None)
+    timings = {}
+    start = time.perf_counter()
+    if rules_func is not None and engine == 'tree' \
+            and command not in WHOLE_COMMANDS:
+        tree = ET.parse(infile)
+        timings['parse'] = time.perf_counter() - start
+        t = time.perf_counter()
+        svgguru.change_all_styleprops(tree, rules_func(**kwargs))
+        timings['transform'] = time.perf_counter() - t
+        t = time.perf_counter()
+        tree.write(outfile)
+        timings['serialize'] = time.perf_counter() - t
+    else:
+        # No separate phases available.
+        svgguru.COMMANDS[command](infile, outfile, engine=engine, **kwargs)
+    timings['total'] = time.perf_counter() - start
+    return timings
+
+
+def bench_slayer(infile, outdir):
+    """Time svg_slayer: parse and index layers, then export all frames."""
+    timings = {}
+    start = time.perf_counter()
+    tree, layers = svg_slayer.load_layers(infile)
+    timings['parse'] = time.perf_counter() - start
+    t = time.perf_counter()
+    for i, layerset in enumerate(svg_slayer.iter_add(svg_slayer.get_layers(layers))):
+        svg_slayer.export_layerset(tree, layers, layerset,
+                                   os.path.join(outdir, 'frame%02d.svg' % i))
+    timings['serialize'] = time.perf_counter() - t
+    timings['total'] = time.perf_counter() - start
+    t = time.perf_counter()
+    # The full command (including the manifest and the output checks).
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            svg_slayer.extract_layers_fromfile(infile, outdir, cfg='+',
+                                               force=True, jobs=1)
+        finally:
+            sys.stdout = stdout
+    timings['command'] = time.perf_counter() - t
+    return timings
+
+
+def run_case(case):
+    """Run in a child process: return timings and peak memory."""
+    name, infile, workdir = case
+    svgguru.print_if_verbose = lambda *args, **kwargs: None
+    if name == 'svg_slayer':
+        timings = bench_slayer(infile, workdir)
+    else:
+        command, engine = name.split(':')
+        timings = bench_command(command, infile,
+                                os.path.join(workdir, 'out.svg'), engine)
+    timings['peak_rss_kb'] = peak_rss_kb()
+    return name, timings
+
+
+def iter_cases(commands, engines):
+    for command in commands:
+        for engine in engines:
+            if engine == 'stream' and command in svgguru.TREE_ONLY_COMMANDS:
+                continue
+            yield '%s:%s' % (command, engine)
+    yield 'svg_slayer'
+
+
+def run_benchmarks(commands=None, engines=('tree', 'stream'), repeat=3,
+                   **gen_params):
+    """Generate the input file, and run each case `repeat` times (keep the
+    fastest)."""
+    commands = commands or sorted(svgguru.COMMANDS)
+    params = dict(GENERATOR_DEFAULTS, **gen_params)
+    workdir = tempfile.mkdtemp(prefix='svgbench')
+    try:
+        infile = os.path.join(workdir, 'input.svg')
+        with open(infile, 'w') as out:
+            generate_svg(out, **params)
+        results = {}
+        ctx = multiprocessing.get_context('spawn')
+        for name in iter_cases(commands, engines):
+            best = None
+            for _ in range(repeat):
+                with ctx.Pool(1) as pool:
+                    _, timings = pool.apply(run_case, ((name, infile, workdir),))
+                if best is None:
+                    best = timings
+                else:
+                    best = dict((key, min(value, timings[key]))
+                                for key, value in best.items())
+            results[name] = best
+            print('%-22s %s' % (name, '  '.join('%s=%.4g' % item
+                                for item in sorted(best.items()))),
+                  file=sys.stderr)
+        return {'meta': {'generator': params,
+                         'input_bytes': os.path.getsize(infile),
+                         'repeat': repeat,
+                         'python': platform.python_version(),
+                         'lxml': '.'.join(map(str, ET.LXML_VERSION)),
+                         'machine': platform.machine(),
+                         'date': time.strftime('%Y-%m-%d %H:%M:%S')},
+                'results': results}
+    finally:
+        shutil.rmtree(workdir)
+
+
+def compare(results, baseline, tolerance=0.2):
+    """Return the list of (case, measure, baseline value, new value) that got
+    worse by more than `tolerance` (relative)."""
+    regressions = []
+    for name, timings in results['results'].items():
+        base_timings = baseline.get('results', {}).get(name, {})
+        for key, value in timings.items():
+            base_value = base_timings.get(key)
+            if base_value and value > base_value * (1 + tolerance):
+                regressions.append((name, key, base_value, value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='action')
+    gen_parser = argparse.ArgumentParser(add_help=False)
+    gen_parser.add_argument('-n', '--nodes', type=int,
+                            default=GENERATOR_DEFAULTS['nodes'],
+                            help='number of drawing elements [%(default)s]')
+    gen_parser.add_argument('-t', '--text-density', type=float,
+                            default=GENERATOR_DEFAULTS['text_density'],
+                            help='fraction of text elements [%(default)s]')
+    gen_parser.add_argument('--tspans', type=int,
+                            default=GENERATOR_DEFAULTS['tspans'],
+                            help='tspans per text [%(default)s]')
+    gen_parser.add_argument('-c', '--colors', type=int,
+                            default=GENERATOR_DEFAULTS['colors'],
+                            help='number of distinct colors [%(default)s]')
+    gen_parser.add_argument('-d', '--depth', type=int,
+                            default=GENERATOR_DEFAULTS['depth'],
+                            help='group nesting depth [%(default)s]')
+    gen_parser.add_argument('-l', '--layers', type=int,
+                            default=GENERATOR_DEFAULTS['layers'],
+                            help='number of Inkscape layers [%(default)s]')
+    gen_parser.add_argument('--seed', type=int,
+                            default=GENERATOR_DEFAULTS['seed'])
+
+    generate = subparsers.add_parser('generate', parents=[gen_parser],
+                                     description=generate_svg.__doc__)
+    generate.add_argument('outfile')
+
+    run = subparsers.add_parser('run', parents=[gen_parser],
+                                description=run_benchmarks.__doc__)
+    run.add_argument('--commands', nargs='+', choices=sorted(svgguru.COMMANDS),
+                     help='[all]')
+    run.add_argument('--engines', nargs='+', default=['tree', 'stream'],
+                     choices=['tree', 'stream'], help='[%(default)s]')
+    run.add_argument('-r', '--repeat', type=int, default=3,
+                     help='keep the best of r runs [%(default)s]')
+    run.add_argument('-s', '--save', help='write results to this json file')
+    run.add_argument('-b', '--baseline',
+                     help='json results to compare with')
+    run.add_argument('--tolerance', type=float, default=0.2,
+                     help='relative slowdown flagged as regression [%(default)s]')
+
+    args = vars(parser.parse_args())
+    action = args.pop('action')
+    if action == 'generate':
+        with open(args.pop('outfile'), 'w') as out:
+            generate_svg(out, **args)
+        return 0
+    elif action != 'run':
+        parser.error('choose an action')
+
+    save = args.pop('save')
+    baseline = args.pop('baseline')
+    tolerance = args.pop('tolerance')
+    results = run_benchmarks(**args)
+    if save:
+        with open(save, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+    if baseline:
+        with open(baseline) as IN:
+            regressions = compare(results, json.load(IN), tolerance)
+        for name, key, base_value, value in regressions:
+            print('REGRESSION: %s %s: %.4g -> %.4g (%+.0f%%)'
+                  % (name, key, base_value, value,
+                     100 * (value / base_value - 1)), file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
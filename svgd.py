@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+"""Persistent server running svgguru and svg_slayer jobs, and its client.
+
+The server keeps the libraries, the argument parsers, the compiled XPath
+expressions and the caches warm, so each job only costs the work itself."""
+
+from __future__ import print_function
+
+# USAGE:
+#     ./svgd.py serve [--socket <path> | --stdin] [-j <workers>]
+#     ./svgd.py [--socket <path>] svgguru <svgguru arguments>
+#     ./svgd.py [--socket <path>] svg_slayer <svg_slayer arguments>
+#
+# With --stdin, jobs are read as json lines:
+#     {"id": 1, "tool": "svgguru", "argv": ["invert", "in.svg", "out.svg"],
+#      "cwd": "/some/dir"}
+# and results are written as json lines on stdout (in completion order):
+#     {"id": 1, "status": 0, "stdout": "", "stderr": "", "elapsed": 0.01}
+
+# The client part must stay light: do not import lxml or the tools here.
+import sys
+import os
+import io
+import json
+import time
+import socket
+import argparse
+import threading
+
+
+TOOLS = ('svgguru', 'svg_slayer')
+DEFAULT_SOCKET = os.environ.get('SVGD_SOCKET',
+                                '/tmp/svgd-%d.sock' % os.getuid())
+
+
+### Server side
+_parsers = {}
+
+
+def _init_worker():
+    """Import the tools and build their parsers once per worker."""
+    import svgguru
+    import svg_slayer
+    # Jobs are already run in parallel: no nested pools by default.
+    svgguru.DEFAULT_JOBS = 1
+    svg_slayer.DEFAULT_JOBS = 1
+    for name, module in (('svgguru', svgguru), ('svg_slayer', svg_slayer)):
+        _parsers[name] = (module, module.build_parser())
+
+
+def run_job(job):
+    """Run one job in a worker process, capturing its output."""
+    if not _parsers:
+        _init_worker()
+    start = time.time()
+    stdout, stderr = io.StringIO(), io.StringIO()
+    sys_stdout, sys_stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = stdout, stderr
+    cwd = os.getcwd()
+    try:
+        module, parser = _parsers[job['tool']]
+        if getattr(parser.parse_args(job['argv']), 'watch', False):
+            # It would never return, holding the worker and the client.
+            raise ValueError('--watch is not available in svgd jobs')
+        if job.get('cwd'):
+            os.chdir(job['cwd'])
+        status = module.main(job['argv'], parser=parser) or 0
+    except SystemExit as err:
+        # argparse errors and --help
+        status = err.code if isinstance(err.code, int) else 1
+    except Exception as err:
+        print('%s: %s' % (type(err).__name__, err), file=stderr)
+        status = 1
+    finally:
+        sys.stdout, sys.stderr = sys_stdout, sys_stderr
+        os.chdir(cwd)
+    return {'id': job.get('id'), 'status': status,
+            'stdout': stdout.getvalue(), 'stderr': stderr.getvalue(),
+            'elapsed': time.time() - start}
+
+
+def check_job(job):
+    if not isinstance(job, dict) or job.get('tool') not in TOOLS \
+            or not isinstance(job.get('argv'), list):
+        raise ValueError('a job needs a "tool" in %s and an "argv" list'
+                         % (TOOLS,))
+
+
+def handle_lines(lines, send, executor):
+    """Submit each json line as a job, and send each result when done.
+
+    Return a list of events, set once each result is sent."""
+    sent = []
+    for line in lines:
+        if not line.strip():
+            continue
+        job = None
+        try:
+            job = json.loads(line)
+            check_job(job)
+        except ValueError as err:
+            job_id = job.get('id') if isinstance(job, dict) else None
+            send({'id': job_id, 'status': 1, 'stdout': '',
+                  'stderr': 'Invalid job: %s\n' % err, 'elapsed': 0})
+            continue
+        done = threading.Event()
+        def send_result(future, done=done):
+            try:
+                send(future.result())
+            finally:
+                done.set()
+        executor.submit(run_job, job).add_done_callback(send_result)
+        sent.append(done)
+    return sent
+
+
+def make_sender(stream):
+    lock = threading.Lock()
+    def send(result):
+        with lock:
+            stream.write(json.dumps(result) + '\n')
+            stream.flush()
+    return send
+
+
+def server_running(socket_path):
+    """Whether a server answers on the socket."""
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except OSError:
+        return False
+    finally:
+        probe.close()
+    return True
+
+
+def serve(socket_path=DEFAULT_SOCKET, stdin=False, jobs=None):
+    """Run jobs received on a unix socket (or stdin) in a pool of warm
+    worker processes."""
+    from concurrent.futures import ProcessPoolExecutor
+    import socketserver
+
+    if not stdin and os.path.exists(socket_path):
+        if server_running(socket_path):
+            print('ERROR: svgd: a server already listens on %s' % socket_path,
+                  file=sys.stderr)
+            return 1
+        # Left by a server that did not exit cleanly.
+        os.remove(socket_path)
+    executor = ProcessPoolExecutor(jobs or os.cpu_count(),
+                                   initializer=_init_worker)
+    if stdin:
+        try:
+            handle_lines(sys.stdin, make_sender(sys.stdout), executor)
+        finally:
+            executor.shutdown(wait=True)
+        return 0
+
+    class JobHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            send = make_sender(io.TextIOWrapper(self.wfile, encoding='utf-8',
+                                                write_through=True))
+            lines = io.TextIOWrapper(self.rfile, encoding='utf-8')
+            # Wait for all the results before closing the connection.
+            for done in handle_lines(lines, send, executor):
+                done.wait()
+
+    server = socketserver.ThreadingUnixStreamServer(socket_path, JobHandler)
+    server.daemon_threads = True
+    print('svgd: listening on %s' % socket_path, file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+        executor.shutdown(wait=False)
+    return 0
+
+
+### Client side
+def submit(tool, argv, socket_path=DEFAULT_SOCKET):
+    """Send one job to the server, print its output, return its status."""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_path)
+    with client, client.makefile('rw', encoding='utf-8') as stream:
+        stream.write(json.dumps({'id': 0, 'tool': tool, 'argv': argv,
+                                 'cwd': os.getcwd()}) + '\n')
+        stream.flush()
+        client.shutdown(socket.SHUT_WR)
+        result = json.loads(stream.readline())
+    sys.stdout.write(result['stdout'])
+    sys.stderr.write(result['stderr'])
+    return result['status']
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    socket_path = DEFAULT_SOCKET
+    if argv[:1] == ['--socket']:
+        socket_path, argv = argv[1], argv[2:]
+
+    # Client: same syntax as the tools themselves.
+    if argv[:1] and argv[0] in TOOLS:
+        return submit(argv[0], argv[1:], socket_path)
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='action')
+    serve_parser = subparsers.add_parser('serve', description=serve.__doc__)
+    serve_parser.add_argument('-s', '--socket', dest='socket_path',
+                              default=socket_path, help='[%(default)s]')
+    serve_parser.add_argument('--stdin', action='store_true',
+                              help='read json jobs from stdin instead')
+    serve_parser.add_argument('-j', '--jobs', type=int,
+                              help='number of worker processes [number of cpus]')
+    args = vars(parser.parse_args(argv))
+    if args.pop('action') != 'serve':
+        parser.error('use "serve", or a tool name (%s)' % ', '.join(TOOLS))
+    return serve(**args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
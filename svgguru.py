@@ -11,17 +11,147 @@ from __future__ import print_function
 
 
 import sys
+import os
+import io
 import re
+import math
+import glob
+import time
 import argparse
-
-# TODO:
-# - included image: add a invert filter
+import json
+import shlex
+import shutil
+import gzip
+import copy
+import base64
+import bisect
+import struct
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict
+from contextlib import contextmanager
 
 from lxml import etree as ET
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+__version__ = '0.2.0'
+
 # Later muted if command line argument --verbose not given
 print_if_verbose = print
 
+
+### Run statistics (--stats)
+class RunStats(object):
+    """Wall time per phase, counters, and peak memory of a run."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = (self.phases.get(name, 0)
+                                 + time.perf_counter() - start)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, report):
+        """Add the report of another run (e.g. from a worker process)."""
+        for name, elapsed in report.get('phases', {}).items():
+            self.phases[name] = self.phases.get(name, 0) + elapsed
+        for name, n in report.get('counters', {}).items():
+            self.count(name, n)
+
+    def report(self, caches=None):
+        report = {'wall_time': time.perf_counter() - self.start,
+                  'phases': dict(self.phases),
+                  'counters': dict(self.counters),
+                  'caches': dict(caches or {})}
+        if resource is not None:
+            # kilobytes on Linux
+            report['peak_rss_kb'] = max(
+                    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                    resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        return report
+
+
+def format_report(report):
+    lines = ['wall time: %.3fs' % report['wall_time']]
+    lines += ['  %-18s %.3fs' % item for item in report['phases'].items()]
+    lines += ['%-20s %d' % item for item in report['counters'].items()]
+    for name, cache in report['caches'].items():
+        lines.append('%-20s %s' % (name + ' cache:', ', '.join(
+                        '%s=%s' % item for item in sorted(cache.items()))))
+    if 'peak_rss_kb' in report:
+        lines.append('peak memory: %.1f MiB' % (report['peak_rss_kb'] / 1024.))
+    return '\n'.join(lines)
+
+
+stats = RunStats()
+
+
+def run_instrumented(func, args=(), kwargs=None, show_stats=False,
+                     stats_json=None, profile=None, caches=None):
+    """Run func, optionally under cProfile, and report the run statistics.
+
+    caches: function returning the cache statistics to report."""
+    stats.reset()
+    profiler = None
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        return func(*args, **(kwargs or {}))
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile)
+            print('Profile written to %s (read it with pstats)' % profile,
+                  file=sys.stderr)
+        if show_stats or stats_json:
+            report = stats.report(caches() if caches else None)
+            if show_stats:
+                print(format_report(report), file=sys.stderr)
+            if stats_json:
+                with open(stats_json, 'w') as out:
+                    json.dump(report, out, indent=2)
+
+
+def add_stats_arguments(parser):
+    group = parser.add_argument_group('statistics')
+    group.add_argument('--stats', action='store_true', dest='show_stats',
+                       help='print time per phase, counters, cache hits and '
+                            'peak memory')
+    group.add_argument('--stats-json', metavar='FILE',
+                       help='write the statistics in json')
+    group.add_argument('--profile', metavar='FILE',
+                       help='dump cProfile statistics to FILE')
+
 # hexadecimal RGB color manipulation
 def hexcode2tuple(hexcolor):
     hexcolor = hexcolor.lstrip('#')
@@ -59,9 +189,9 @@ def hex_invert(hexcolor):
     return tuple2hexcode255(R,G,B) if base==255 else tuple2hexcode15(R,G,B)
 
 
-### TODO: make a decorator
 def col_invert(color, default=None):
-    name_inverter.update({None: default})
+    if color is None:
+        return default
     try:
         return name_inverter[color]
     except KeyError:
@@ -108,8 +238,6 @@ def fill_default(value, default=None):
 
 
 
-atomic_invert = col_invert
-
 def rgb_invertlight(R, G, B):
     middle_lum = (min(R, G, B) + max(R, G, B)) / 2
     #new_middle_lum = 255 - middle_lum
@@ -151,8 +279,307 @@ def hex_invertlight2(hexcolor):
     return tuple2hexcode(R, G, B)
 
 
-atomic_invertlight = hex_invertlight
-atomic_invertlight2 = hex_invertlight2
+### Batch color engine: each distinct color is converted once.
+# Vectorized versions of the rgb functions, on (N, 3) integer arrays.
+def rgbarray_invert(rgb, base=255):
+    return base - rgb
+
+
+def rgbarray_invertlight(rgb):
+    tr = 255 - rgb.min(axis=1) - rgb.max(axis=1)
+    return rgb + tr[:, None]
+
+
+def rgbarray_invertlight2(rgb):
+    lum = rgb.sum(axis=1) / 3
+    tr = np.trunc(255 - 2 * lum).astype(rgb.dtype)
+    tr = np.minimum(255 - rgb.max(axis=1), tr)
+    tr = np.maximum(- rgb.min(axis=1), tr)
+    return rgb + tr[:, None]
+
+
+def hexlist2rgbarray(hexcolors, bits=8):
+    """Convert a list of '#rrggbb' (or '#rgb' if bits=4) to a (N, 3) array."""
+    values = np.array([int(color[1:], 16) for color in hexcolors],
+                      dtype=np.int64)
+    mask = (1 << bits) - 1
+    return np.stack([(values >> (2 * bits)) & mask,
+                     (values >> bits) & mask,
+                     values & mask], axis=1)
+
+
+def rgbarray2hexlist(rgb, bits=8):
+    values = (rgb[:, 0] << (2 * bits)) | (rgb[:, 1] << bits) | rgb[:, 2]
+    fmt = '#%06x' if bits == 8 else '#%03x'
+    return [fmt % value for value in values.tolist()]
+
+
+REG_HEX6 = re.compile(r'#[0-9a-fA-F]{6}$')
+REG_HEX3 = re.compile(r'#[0-9a-fA-F]{3}$')
+
+
+def make_batch_hexfunc(rgbarray_func, short_too=False):
+    """Make a function converting a list of colors at once.
+
+    It returns a dictionary {color: converted color} for the hexadecimal
+    colors (others are left to the scalar function)."""
+    def batch_func(colors):
+        converted = {}
+        groups = [(8, [c for c in colors if REG_HEX6.match(c)])]
+        if short_too:
+            groups.append((4, [c for c in colors if REG_HEX3.match(c)]))
+        for bits, hexcolors in groups:
+            if hexcolors:
+                rgb = hexlist2rgbarray(hexcolors, bits)
+                if bits == 4:
+                    rgb = rgbarray_func(rgb, base=15)
+                else:
+                    rgb = rgbarray_func(rgb)
+                converted.update(zip(hexcolors, rgbarray2hexlist(rgb, bits)))
+        return converted
+    return batch_func
+
+
+### Perceptual light inversion: the lightness is inverted in the OKLab color
+### space (https://bottosson.github.io/posts/oklab/), hue kept, and the chroma
+### reduced as needed to stay within the sRGB gamut.
+# linear sRGB -> LMS, and cube root of LMS -> OKLab
+OKLAB_M1 = ((0.4122214708, 0.5363325363, 0.0514459929),
+            (0.2119034982, 0.6806995451, 0.1073969566),
+            (0.0883024619, 0.2817188376, 0.6299787005))
+OKLAB_M2 = ((0.2104542553, 0.7936177850, -0.0040720468),
+            (1.9779984951, -2.4285922050, 0.4505937099),
+            (0.0259040371, 0.7827717662, -0.8086757660))
+# The inverse matrices
+OKLAB_M2_INV = ((1., 0.3963377774, 0.2158037573),
+                (1., -0.1055613458, -0.0638541728),
+                (1., -0.0894841775, -1.2914855480))
+OKLAB_M1_INV = ((4.0767416621, -3.3077115913, 0.2309699292),
+                (-1.2684380046, 2.6097574011, -0.3413193965),
+                (-0.0041960863, -0.7034186147, 1.7076147010))
+# Iterations of the chroma bisection (enough for 8 bits per channel).
+GAMUT_STEPS = 10
+GAMUT_EPSILON = 1e-6
+
+
+def srgb2linear(c):
+    return c / 12.92 if c <= 0.04045 else ((c + 0.055) / 1.055) ** 2.4
+
+
+# 8-bit channel values -> linear, and the linear values where the rounded
+# 8-bit value changes.
+SRGB_LINEAR = [srgb2linear(c / 255.) for c in range(256)]
+SRGB_LINEAR_BOUNDS = [srgb2linear((c + 0.5) / 255.) for c in range(255)]
+
+
+def mat3_dot(matrix, vector):
+    return [sum(m * v for m, v in zip(row, vector)) for row in matrix]
+
+
+def oklab2linear(L, a, b):
+    return mat3_dot(OKLAB_M1_INV,
+                    [c ** 3 for c in mat3_dot(OKLAB_M2_INV, (L, a, b))])
+
+
+def in_gamut(linear):
+    return all(-GAMUT_EPSILON <= c <= 1 + GAMUT_EPSILON for c in linear)
+
+
+def rgb_invertoklab(R, G, B):
+    """Invert the OKLab lightness, keep the hue, reduce the chroma if out of
+    gamut (pure Python version of `rgbarray_invertoklab`)."""
+    lms = mat3_dot(OKLAB_M1, [SRGB_LINEAR[C] for C in (R, G, B)])
+    L, a, b = mat3_dot(OKLAB_M2, [math.copysign(abs(c) ** (1 / 3.), c)
+                                  for c in lms])
+    L = 1 - L
+    linear = oklab2linear(L, a, b)
+    if not in_gamut(linear):
+        low, high = 0., 1.
+        for _ in range(GAMUT_STEPS):
+            middle = (low + high) / 2
+            if in_gamut(oklab2linear(L, a * middle, b * middle)):
+                low = middle
+            else:
+                high = middle
+        linear = oklab2linear(L, a * low, b * low)
+    return tuple(bisect.bisect_left(SRGB_LINEAR_BOUNDS, c) for c in linear)
+
+
+def hex_invertoklab(hexcolor):
+    """Invert the perceived lightness (in OKLab), keep hue."""
+    if hexcolor is None:
+        return '"white"'
+    if not hexcolor.startswith('#') or not len(hexcolor) == 7 :
+        return hexcolor
+    R, G, B = hexcode2tuple(hexcolor)
+    if np is not None:
+        # Same result as the lookup table used in batch.
+        R, G, B = rgbarray_invertoklab(np.array([[R, G, B]])).tolist()[0]
+    else:
+        R, G, B = rgb_invertoklab(R, G, B)
+    return tuple2hexcode(R, G, B)
+
+
+def oklab2linear_array(lab):
+    lms = (lab @ np.array(OKLAB_M2_INV).T) ** 3
+    return lms @ np.array(OKLAB_M1_INV).T
+
+
+def compute_invertoklab(rgb):
+    """Vectorized `rgb_invertoklab` on a (N, 3) integer array."""
+    linear = np.array(SRGB_LINEAR)[rgb]
+    lab = np.cbrt(linear @ np.array(OKLAB_M1).T) @ np.array(OKLAB_M2).T
+    lab[:, 0] = 1 - lab[:, 0]
+    linear = oklab2linear_array(lab)
+    out = ((linear < -GAMUT_EPSILON)
+           | (linear > 1 + GAMUT_EPSILON)).any(axis=1)
+    if out.any():
+        # Bisection of the chroma factor, for all the colors at once.
+        outlab = lab[out]
+        low = np.zeros(len(outlab))
+        high = np.ones(len(outlab))
+        for _ in range(GAMUT_STEPS):
+            middle = (low + high) / 2
+            scaled = oklab2linear_array(outlab * np.column_stack(
+                    [np.ones(len(outlab)), middle, middle]))
+            inside = ((scaled >= -GAMUT_EPSILON)
+                      & (scaled <= 1 + GAMUT_EPSILON)).all(axis=1)
+            low = np.where(inside, middle, low)
+            high = np.where(inside, high, middle)
+        outlab[:, 1:] *= low[:, None]
+        linear[out] = oklab2linear_array(outlab)
+    return np.searchsorted(SRGB_LINEAR_BOUNDS, linear).astype(np.uint8)
+
+
+# The lookup table of all 24-bit colors (48 MiB) is memory-mapped, so that
+# the processes using it share its memory. It is only written to disk in a
+# directory given explicitly (this one, else the image cache directory): it
+# is then built once, when a conversion of many colors needs it (images),
+# and used whenever it exists. Without one, the colors are computed.
+LUT_DIR = os.environ.get('SVGGURU_LUT_DIR')
+OKLAB_LUT_FILE = 'invertoklab-1.npy'
+OKLAB_LUT_MIN_COLORS = 2**16
+LUT_CHUNK_SIZE = 2**20
+
+_oklab_luts = {}
+# (images are converted by several threads)
+_oklab_lut_lock = threading.Lock()
+
+
+def build_lut(path, func):
+    """Write the (2**24, 3) uint8 table of func over all 24-bit colors."""
+    print('INFO: building the color table %s (once)' % path, file=sys.stderr)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmpfile = '%s.%d.tmp' % (path, os.getpid())
+    table = np.lib.format.open_memmap(tmpfile, mode='w+', dtype=np.uint8,
+                                      shape=(1 << 24, 3))
+    with stats.phase('build table'):
+        for start in range(0, 1 << 24, LUT_CHUNK_SIZE):
+            values = np.arange(start, start + LUT_CHUNK_SIZE)
+            table[start:start + LUT_CHUNK_SIZE] = func(np.stack(
+                    [values >> 16, (values >> 8) & 255, values & 255], axis=1))
+    table.flush()
+    del table
+    os.replace(tmpfile, path)
+
+
+def oklab_lut(build=False, lut_dir=None):
+    """The memory-mapped table of `compute_invertoklab` in LUT_DIR (else
+    lut_dir), or None if there is no directory, or if the table does not
+    exist yet (unless build)."""
+    lut_dir = LUT_DIR or lut_dir
+    if not lut_dir:
+        return None
+    path = os.path.join(lut_dir, OKLAB_LUT_FILE)
+    if path in _oklab_luts:
+        return _oklab_luts[path]
+    with _oklab_lut_lock:
+        if path not in _oklab_luts:
+            if build and not os.path.isfile(path):
+                try:
+                    build_lut(path, compute_invertoklab)
+                except OSError as err:
+                    print('WARNING: color table not written: %s' % err,
+                          file=sys.stderr)
+                    return None
+            try:
+                _oklab_luts[path] = np.load(path, mmap_mode='r')
+            except (OSError, ValueError):
+                return None
+    return _oklab_luts[path]
+
+
+def rgbarray_invertoklab(rgb, lut_dir=None):
+    lut = oklab_lut(len(rgb) >= OKLAB_LUT_MIN_COLORS, lut_dir)
+    if lut is None:
+        return compute_invertoklab(rgb).astype(rgb.dtype)
+    stats.count('colors looked up', len(rgb))
+    index = rgb.astype(np.int64)
+    return lut[(index[:, 0] << 16) | (index[:, 1] << 8) | index[:, 2]
+               ].astype(rgb.dtype)
+
+
+COLOR_CACHE_SIZE = 4096
+
+
+class ColorMemo(object):
+    """Bounded memoization of an atomic color function.
+
+    The cache can be filled for many colors at once with `prefill`, which uses
+    the vectorized `batch_func` when numpy is available."""
+
+    def __init__(self, func, batch_func=None, maxsize=COLOR_CACHE_SIZE):
+        self.func = func
+        self.batch_func = batch_func
+        self.maxsize = maxsize
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def store(self, key, value):
+        if len(self.cache) >= self.maxsize:
+            # Drop the oldest entry.
+            del self.cache[next(iter(self.cache))]
+        self.cache[key] = value
+
+    def __call__(self, color, *args):
+        key = (color, args)
+        try:
+            value = self.cache[key]
+            self.hits += 1
+            return value
+        except KeyError:
+            self.misses += 1
+            value = self.func(color, *args)
+            self.store(key, value)
+            return value
+
+    def prefill(self, colors, *args):
+        """Convert all the given colors at once."""
+        if np is None or self.batch_func is None:
+            return
+        todo = [color for color in set(colors)
+                if color is not None and (color, args) not in self.cache]
+        if todo:
+            for color, value in self.batch_func(todo[:self.maxsize]).items():
+                self.store((color, args), value)
+            stats.count('colors batch-converted', len(todo))
+
+    def stats(self):
+        return {'size': len(self.cache), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses}
+
+
+atomic_invert = ColorMemo(col_invert,
+                          make_batch_hexfunc(rgbarray_invert, short_too=True))
+atomic_invertlight = ColorMemo(hex_invertlight,
+                               make_batch_hexfunc(rgbarray_invertlight))
+atomic_invertlight2 = ColorMemo(hex_invertlight2,
+                                make_batch_hexfunc(rgbarray_invertlight2))
+atomic_invertoklab = ColorMemo(hex_invertoklab,
+                               make_batch_hexfunc(rgbarray_invertoklab))
 
 
 def parse_style(stylestr):
@@ -173,6 +600,9 @@ REG_PX = re.compile(r'px$')
 ### Atomic functions to change ONE style property
 def atomic_resizefont(fontstr, factor, to_int=True):
     """multiply font-size by factor"""
+    if fontstr is None:
+        # No font-size in this style: leave it unset.
+        return None
     try:
         fontsize = float(REG_PX.sub('', fontstr))
     except ValueError as err:
@@ -186,48 +616,30 @@ def atomic_resizefont(fontstr, factor, to_int=True):
 
 
 ### Building blocks to make more specific changing functions
-def change_style(stylestr, propertyname, func, *funcargs):
-    """Change one property of the 'style' attribute, according to the given
-    function.
-    - func: use one of the atomic_func"""
-    styledict = parse_style(stylestr)
-    # property must exist, otherwise error.
+def change_styledict(styledict, propertyname, func, *funcargs):
+    """Change one property of a parsed style dictionary, in place."""
     prop = styledict.get(propertyname)
     newprop = func(prop, *funcargs)
     if newprop is not None:
         styledict[propertyname] = newprop
-    return format_style(styledict)
-
 
-def iter_multiplefindall(tree, xpathlist, ns):
-    # Totally inefficient but I don't see how to do this otherwise
-    for xpath in xpathlist:
-        for node in tree.findall(xpath, ns):
-            yield node
 
-#def iter_multiplefindall(tree, xpathlist, ns):
-#    for xpath in xpathlist:
-#        for node in tree.iter(xpath, ns):
-#            yield node
+def change_style(stylestr, propertyname, func, *funcargs):
+    """Change one property of the 'style' attribute, according to the given
+    function.
+    - func: use one of the atomic_func"""
+    styledict = parse_style(stylestr)
+    change_styledict(styledict, propertyname, func, *funcargs)
+    return format_style(styledict)
 
 
 def change_all_attr(tree, taglist, attrname, func, *funcargs):
     """transform all corresponding attributes in the tree with the function.
 
-    It transforms the attribute *while* traversing the tree.
+    taglist items are selectors (see `selector_to_xpath`).
     """
-    root = tree.getroot()
-    ns = root.nsmap
-    if None in ns:
-        ns.pop(None)
-        
-    xpathlist = ['.//%s[@%s]' % (tag, attrname) for tag in taglist]
-    #print('namespace: %r' % ns, file=sys.stderr)
-    #print('namespace: ', ' '.join(str(nitem) for nitem in ns.items()), file=sys.stderr)
-    #print('namespace:', '\n'.join(': '.join(nitem) for nitem in ns.items()),
-    #        file=sys.stderr)
-    #print('search str: %r' % xpath, file=sys.stderr) 
-    for node in iter_multiplefindall(tree, xpathlist, ns):
+    for node in select_nodes(tree, ['%s[%s]' % (tag, attrname)
+                                    for tag in taglist]):
         attr = node.attrib[attrname]
         node.set(attrname, func(attr, *funcargs))
 
@@ -239,22 +651,201 @@ def batch_change_all_nodes(tree, taglist, attrname, func, *funcargs):
     
     func must take the list of nodes, *funcargs, and modify in place the nodes.
     """
-    root = tree.getroot()
-    ns = root.nsmap
-    if None in ns:
-        ns.pop(None)
-    
     if attrname:
-        xpathlist = ['.//%s[@%s]' % (tag, attrname) for tag in taglist]
+        taglist = ['%s[%s]' % (tag, attrname) for tag in taglist]
+    func(select_nodes(tree, taglist), *funcargs)
+
+
+### Alignment-preserving font resizing
+# Average glyph width, in em, to estimate the width of texts.
+AVG_CHAR_WIDTH = 0.55
+# Distance between baseline and the visual middle of the text, in em.
+MIDDLE_HEIGHT = 0.35
+# Distance (in user units) under which two text edges are aligned.
+ALIGN_TOLERANCE = 0.5
+
+REG_NUMBER = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+REG_TRANSFORM = re.compile(r'(matrix|translate|scale|rotate|skewX|skewY)\s*\(([^)]*)\)')
+ANCHOR_FRACTION = {'start': 0., 'middle': 0.5, 'end': 1.}
+
+
+def parse_numbers(string):
+    return [float(x) for x in REG_NUMBER.findall(string or '')]
+
+
+def format_number(value, precision=6):
+    formatted = '%.*f' % (precision, value)
+    if '.' in formatted:
+        formatted = formatted.rstrip('0').rstrip('.')
+    return '0' if formatted == '-0' else formatted
+
+
+def multiply_matrices(m1, m2):
+    a1, b1, c1, d1, e1, f1 = m1
+    a2, b2, c2, d2, e2, f2 = m2
+    return (a1*a2 + c1*b2, b1*a2 + d1*b2,
+            a1*c2 + c1*d2, b1*c2 + d1*d2,
+            a1*e2 + c1*f2 + e1, b1*e2 + d1*f2 + f1)
+
+
+def parse_transform(transform):
+    """Return the (a, b, c, d, e, f) matrix of a transform attribute."""
+    matrix = (1., 0., 0., 1., 0., 0.)
+    for name, args in REG_TRANSFORM.findall(transform or ''):
+        args = parse_numbers(args)
+        if name == 'matrix':
+            m = tuple(args)
+        elif name == 'translate':
+            m = (1., 0., 0., 1., args[0], args[1] if len(args) > 1 else 0.)
+        elif name == 'scale':
+            m = (args[0], 0., 0., args[1] if len(args) > 1 else args[0], 0., 0.)
+        elif name == 'rotate':
+            angle = math.radians(args[0])
+            cos, sin = math.cos(angle), math.sin(angle)
+            m = (cos, sin, -sin, cos, 0., 0.)
+            if len(args) == 3:
+                cx, cy = args[1:]
+                m = multiply_matrices(multiply_matrices(
+                        (1., 0., 0., 1., cx, cy), m), (1., 0., 0., 1., -cx, -cy))
+        elif name == 'skewX':
+            m = (1., 0., math.tan(math.radians(args[0])), 1., 0., 0.)
+        else:
+            m = (1., math.tan(math.radians(args[0])), 0., 1., 0., 0.)
+        matrix = multiply_matrices(matrix, m)
+    return matrix
+
+
+def get_styleprop(node, propertyname):
+    stylestr = node.get('style')
+    if stylestr:
+        return parse_style(stylestr).get(propertyname)
+
+
+def text_layout(text, tspan_tag):
+    """Font-size, anchor position, width and orientation of a text element.
+
+    Return None if the text has no font-size or no position."""
+    nodes = [text] + list(text.iter(tspan_tag))
+    fontsize = anchor = None
+    for node in nodes:
+        fontsize = fontsize or get_styleprop(node, 'font-size')
+        anchor = anchor or get_styleprop(node, 'text-anchor')
+    positioned = [node for node in nodes if node.get('x') is not None]
+    if not fontsize or not positioned:
+        return None
+    fontsize = float(REG_PX.sub('', fontsize))
+    xs = parse_numbers(positioned[0].get('x'))
+    ys = parse_numbers(positioned[0].get('y')) or [0.]
+    if not xs:
+        return None
+
+    lines = [''.join(tspan.itertext()) for tspan in text.iterchildren(tspan_tag)]
+    nchars = max([len(line) for line in lines] or [len(text.text or '')])
+    if len(xs) > 1:
+        # Positions of each glyph are given.
+        width = xs[-1] - xs[0] + AVG_CHAR_WIDTH * fontsize
     else:
-        xpathlist = ['.//%s' % tag for tag in taglist]
-    nodelist = [node in iter_multiplefindall(tree, xpathlist, ns)]
-    func(nodelist, *funcargs)
-
-
-#def batch_resizefont():
-#    """Increase font-size intelligently: if some text elements are aligned, 
-#    keep them aligned. Otherwise keep it centered."""
+        width = nchars * AVG_CHAR_WIDTH * fontsize
+
+    a, b, c, d, e, f = parse_transform(text.get('transform'))
+    fraction = ANCHOR_FRACTION.get(anchor, 0.)
+    left = xs[0] - fraction * width
+    # Edges along the text direction, and baseline, in user units.
+    norm_u = math.hypot(a, b) or 1.
+    norm_v = math.hypot(c, d) or 1.
+    ux, uy, vx, vy = a / norm_u, b / norm_u, c / norm_v, d / norm_v
+    def along(x):
+        return (a * x + c * ys[0] + e) * ux + (b * x + d * ys[0] + f) * uy
+    baseline = (a * xs[0] + c * ys[0] + e) * vx + (b * xs[0] + d * ys[0] + f) * vy
+    orientation = (round(ux, 3), round(uy, 3), round(vx, 3), round(vy, 3))
+    return {'fontsize': fontsize, 'fraction': fraction, 'width': width,
+            'orientation': orientation,
+            'edges': (along(left), along(left + width / 2.),
+                      along(left + width)),
+            'baseline': baseline}
+
+
+def find_aligned(values, tolerance=ALIGN_TOLERANCE):
+    """Given (key, value, index) items, group the values within tolerance of
+    each other (with the same key), and return {index: size of its group}
+    for the groups of more than one item.
+
+    Sorting makes it O(n log n)."""
+    groups = []
+    previous = None
+    for key, value, index in sorted(values):
+        if previous is None or key != previous[0] \
+                or value - previous[1] > tolerance:
+            groups.append([])
+        groups[-1].append(index)
+        previous = (key, value)
+    return {index: len(group) for group in groups if len(group) > 1
+            for index in group}
+
+
+def shift_scale_coords(node, attrname, shift, factor, origin):
+    """New coordinate = origin + shift + (coordinate - origin) * factor."""
+    values = node.get(attrname)
+    if values is None:
+        return
+    node.set(attrname, ' '.join(format_number(origin + shift + (v - origin) * factor)
+                                for v in parse_numbers(values)))
+
+
+def batch_resizefont(nodelist, factor):
+    """Increase font-size intelligently: if some text elements are aligned, 
+    keep them aligned. Otherwise keep it centered.
+
+    nodelist: the svg:text elements."""
+    if not nodelist:
+        return
+    tspan_tag = '{%s}tspan' % SVG_NS
+    layouts = [text_layout(text, tspan_tag) for text in nodelist]
+    indexed = [(i, layout) for i, layout in enumerate(layouts) if layout]
+
+    # Spatial index: sort each kind of edge (left, middle, right) and the
+    # baselines, per text orientation.
+    aligned_edges = [find_aligned([(layout['orientation'], layout['edges'][k], i)
+                                   for i, layout in indexed])
+                     for k in range(3)]
+    aligned_baselines = find_aligned([(layout['orientation'], layout['baseline'], i)
+                                      for i, layout in indexed])
+
+    for i, (text, layout) in enumerate(zip(nodelist, layouts)):
+        for node in text.iter():
+            stylestr = node.get('style')
+            if stylestr is not None:
+                node.set('style', change_style(stylestr, 'font-size',
+                                               atomic_resizefont, factor))
+        if layout is None:
+            continue
+
+        # Point of the text that must not move: the anchor if it is aligned,
+        # else any aligned edge, else the center.
+        fraction = layout['fraction']
+        keep = 0.5
+        best = 1
+        # The biggest group of aligned edges wins, ties favor the anchor.
+        for k in (int(fraction * 2), 0, 2, 1):
+            if aligned_edges[k].get(i, 0) > best:
+                keep, best = k / 2., aligned_edges[k][i]
+        shift_x = (fraction - keep) * layout['width'] * (factor - 1)
+        # Keep the baseline of aligned rows, otherwise the vertical middle.
+        if i in aligned_baselines:
+            shift_y = 0.
+        else:
+            shift_y = MIDDLE_HEIGHT * layout['fontsize'] * (factor - 1)
+
+        positioned = [node for node in text.iter(ET.Element)
+                      if node.get('x') is not None or node.get('y') is not None]
+        x0 = (parse_numbers(positioned[0].get('x')) or [0.])[0]
+        y0 = (parse_numbers(positioned[0].get('y')) or [0.])[0]
+        for node in positioned:
+            shift_scale_coords(node, 'x', shift_x, factor, x0)
+            shift_scale_coords(node, 'y', shift_y, factor, y0)
+        for node in text.iter(ET.Element):
+            shift_scale_coords(node, 'dx', 0., factor, 0.)
+            shift_scale_coords(node, 'dy', 0., factor, 0.)
 
 ### More specifically change all 'style' attributes of the given tag.
 def change_all_styleprop(tree, taglist, propertyname, func, *funcargs):
@@ -264,49 +855,1862 @@ def change_all_styleprop(tree, taglist, propertyname, func, *funcargs):
     change_all_attr(tree, taglist, 'style', change_prop)
 
 
-### Specific function affecting all elements. They are called directly with
-### the script arguments.
-def svg_resizefont(infile, outfile, factor):
-    """Multiply font-size attributes by the given factor."""
-    tree = ET.parse(infile)
-    factor = float(factor)
-    change_all_styleprop(tree, ['svg:tspan', 'svg:text'], 'font-size',
-                         atomic_resizefont, factor)
-    tree.write(outfile)
+### Single-pass pipeline: apply several style changes in one traversal.
+# A rule is a tuple (taglist, propertyname, func, *funcargs), i.e. the
+# arguments of `change_all_styleprop` without the tree.
+
+SVG_NS = 'http://www.w3.org/2000/svg'
+
+
+def get_nsmap(root):
+    """Namespaces usable in selectors ('svg' is always defined)."""
+    ns = dict(root.nsmap)
+    ns.pop(None, None)
+    ns.setdefault('svg', SVG_NS)
+    return ns
+
+
+def expand_tag(tag, ns):
+    """Convert a 'prefix:tag' selector to the lxml '{uri}tag' notation
+    (unprefixed tags are SVG ones, like in selectors).
+
+    Return None for the '*' wildcard."""
+    if tag == '*':
+        return None
+    prefix, _, localname = tag.rpartition(':')
+    return '{%s}%s' % (ns[prefix or 'svg'], localname)
+
+
+def compile_rules(rules, ns):
+    """Resolve the tag selectors of each rule.
+
+    Return a list of (tagset, propertyname, func, funcargs), tagset being
+    None when the rule applies to any tag."""
+    compiled = []
+    for taglist, propertyname, func, *funcargs in rules:
+        tagset = set(expand_tag(tag, ns) for tag in taglist)
+        if None in tagset:
+            tagset = None
+        compiled.append((tagset, propertyname, func, tuple(funcargs)))
+    return compiled
+
+
+def rules_bytag(compiled):
+    """Return a function giving (and memoizing) the rules matching a tag.
+
+    The rules are returned as a "chain": a tuple of
+    (propertyname, func, funcargs)."""
+    bytag = {}
+    def rules_for(tag):
+        try:
+            return bytag[tag]
+        except KeyError:
+            chain = bytag[tag] = tuple((propertyname, func, funcargs)
+                        for tagset, propertyname, func, funcargs in compiled
+                        if tagset is None or tag in tagset)
+            return chain
+    return rules_for
+
+
+STYLE_CACHE_SIZE = 8192
+
+
+class StyleCache(object):
+    """Bounded LRU cache of transformed style strings.
+
+    Keys are (original style string, rule chain), so the atomic functions
+    must only depend on their arguments. Values are the new style strings."""
+
+    def __init__(self, maxsize=STYLE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, stylestr, chain):
+        try:
+            newstyle = self.entries[(stylestr, chain)]
+        except KeyError:
+            self.misses += 1
+            return None
+        except TypeError:
+            # Unhashable function arguments: not cacheable.
+            return None
+        self.entries.move_to_end((stylestr, chain))
+        self.hits += 1
+        return newstyle
+
+    def put(self, stylestr, chain, newstyle):
+        try:
+            self.entries[(stylestr, chain)] = newstyle
+        except TypeError:
+            return
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        return {'size': len(self.entries), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses}
+
+
+# Shared by all the documents processed by this process.
+style_cache = StyleCache()
+
+
+def transform_style(stylestr, chain, cache=style_cache):
+    """Apply a rule chain to a style string (parsing it once)."""
+    if cache is not None:
+        newstyle = cache.get(stylestr, chain)
+        if newstyle is not None:
+            return newstyle
+    styledict = parse_style(stylestr)
+    for propertyname, func, funcargs in chain:
+        change_styledict(styledict, propertyname, func, *funcargs)
+    newstyle = format_style(styledict)
+    if cache is not None:
+        cache.put(stylestr, chain, newstyle)
+    return newstyle
+
+
+def apply_rules_to_node(node, chain, cache=style_cache):
+    """Transform the node style with all the matching rules, write it back
+    once. Return True if the node had a style attribute."""
+    stylestr = node.get('style')
+    if stylestr is None:
+        return False
+    node.set('style', transform_style(stylestr, chain, cache))
+    return True
+
+
+# Plain strings are much faster than the default "smart strings".
+XPATH_STYLES = ET.XPath('.//@style', smart_strings=False)
+
+
+def prefill_colors(root, compiled):
+    """Gather the distinct values of the properties handled by a ColorMemo,
+    and convert them all at once."""
+    memo_rules = [(propertyname, func, funcargs)
+                  for _, propertyname, func, funcargs in compiled
+                  if isinstance(func, ColorMemo)]
+    if not memo_rules or np is None:
+        return
+    # Same parsing as `parse_style`: no whitespace around names.
+    reg_prop = re.compile(r'(?:^|;)(%s):([^;]*)' % '|'.join(
+                    set(re.escape(prop) for prop, _, _ in memo_rules)))
+    values = dict((prop, set()) for prop, _, _ in memo_rules)
+    for stylestr in set(XPATH_STYLES(root)):
+        for prop, value in reg_prop.findall(stylestr):
+            values[prop].add(value)
+    for prop, func, funcargs in memo_rules:
+        func.prefill(values[prop], *funcargs)
+
+
+def change_all_styleprops(tree, rules, select=None):
+    """Apply all the rules in a single traversal of the tree.
+
+    Rules are applied in the given order on each node, so the result is the
+    same as successive calls to `change_all_styleprop`.
+    select: only change the elements matching these selectors."""
+    root = tree.getroot()
+    ns = get_nsmap(root)
+    compiled = compile_rules(rules, ns)
+    prefill_colors(root, compiled)
+    rules_for = rules_bytag(compiled)
+
+    if select is None:
+        # The root element itself is not included.
+        nodes = root.iterdescendants(ET.Element)
+    else:
+        nodes = select_nodes(tree, select)
+    visited = rewritten = 0
+    for node in nodes:
+        visited += 1
+        chain = rules_for(node.tag)
+        if chain and apply_rules_to_node(node, chain):
+            rewritten += 1
+    stats.count('nodes visited', visited)
+    stats.count('styles rewritten', rewritten)
+
+
+def change_subtree_styleprops(node, rules, ns):
+    """Apply the rules to a subtree (including its root), ns being the
+    namespaces of its document (see `get_nsmap`)."""
+    rules_for = rules_bytag(compile_rules(rules, ns))
+    for subnode in node.iter(ET.Element):
+        chain = rules_for(subnode.tag)
+        if chain:
+            apply_rules_to_node(subnode, chain)
+
+
+### Selectors: CSS-like targeting of elements, compiled to XPath.
+# Supported: tag (svg:text or svg|text; unprefixed tags are in the SVG
+# namespace), *, #id, .class, [attr], [attr=value] (also ~=, ^=, $=, *=),
+# descendant (space) and child (>) combinators, and comma-separated groups.
+# The prefixes are fixed (not read from the document), so that a compiled
+# selector can be reused on any document.
+SELECTOR_NAMESPACES = {'svg': SVG_NS,
+                       'xlink': 'http://www.w3.org/1999/xlink',
+                       'inkscape': 'http://www.inkscape.org/namespaces/inkscape',
+                       'sodipodi': 'http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd'}
+
+REG_SELECTOR_TOKEN = re.compile(r'''
+      \s*(?P<combinator>[>,])\s*
+    | (?P<space>\s+)
+    | (?P<tag>\*|[\w-]+(?:[:|][\w-]+)?)
+    | \#(?P<id>[\w-]+)
+    | \.(?P<class>[\w-]+)
+    | \[\s*(?P<attr>[\w-]+(?:[:|][\w-]+)?)\s*
+        (?:(?P<op>[~^$*]?=)\s*(?P<value>"[^"]*"|'[^']*'|[^\]\s]+)\s*)?\]
+    ''', re.VERBOSE)
+
+# XPath 1.0 predicates of the attribute operators (name, value).
+SELECTOR_OPERATORS = {
+    '=': '@{0}={1}',
+    '~=': "contains(concat(' ', normalize-space(@{0}), ' '), concat(' ', {1}, ' '))",
+    '^=': 'starts-with(@{0}, {1})',
+    '$=': ('substring(@{0}, string-length(@{0}) - string-length({1}) + 1)'
+           '={1}'),
+    '*=': 'contains(@{0}, {1})'}
+
+
+class SelectorError(ValueError):
+    pass
+
+
+def xpath_literal(value):
+    if "'" not in value:
+        return "'%s'" % value
+    if '"' not in value:
+        return '"%s"' % value
+    return "concat('%s')" % "', \"'\", '".join(value.split("'"))
+
+
+def xpath_name(name, default_prefix=None):
+    prefix, _, localname = name.replace('|', ':').rpartition(':')
+    prefix = prefix or default_prefix
+    if prefix is None:
+        return localname
+    if prefix not in SELECTOR_NAMESPACES:
+        raise SelectorError('unknown namespace prefix %r' % prefix)
+    return '%s:%s' % (prefix, localname)
+
+
+def selector_to_xpath(selector):
+    """Translate a (comma-separated) selector to an XPath expression.
+
+    Like CSS selectors, it matches any element of the document (including
+    the root), wherever the XPath is evaluated from."""
+    paths = []
+    steps = []
+    axis = '/descendant::'
+    nodetest = None
+    predicates = []
+    pos = 0
+    selector = selector.strip()
+    while True:
+        match = REG_SELECTOR_TOKEN.match(selector, pos)
+        end = pos == len(selector)
+        if not end and match is None:
+            raise SelectorError('invalid selector %r at position %d'
+                                % (selector, pos))
+        if end or match.group('combinator') or match.group('space'):
+            if nodetest is None and not predicates:
+                raise SelectorError('invalid selector %r at position %d'
+                                    % (selector, pos))
+            steps.append(axis + (nodetest or '*') + ''.join(predicates))
+            nodetest = None
+            predicates = []
+            if end or match.group('combinator') == ',':
+                paths.append(''.join(steps))
+                steps = []
+                axis = '/descendant::'
+            else:
+                axis = '/' if match.group('combinator') else '/descendant::'
+            if end:
+                return ' | '.join(paths)
+        elif match.group('tag'):
+            if nodetest is not None or predicates:
+                raise SelectorError('misplaced tag in selector %r at '
+                                    'position %d' % (selector, pos))
+            tag = match.group('tag')
+            nodetest = '*' if tag == '*' else xpath_name(tag, 'svg')
+        elif match.group('id'):
+            predicates.append('[@id=%s]' % xpath_literal(match.group('id')))
+        elif match.group('class'):
+            predicates.append(
+                "[contains(concat(' ', normalize-space(@class), ' '), %s)]"
+                % xpath_literal(' %s ' % match.group('class')))
+        else:
+            attr = xpath_name(match.group('attr'))
+            value = match.group('value')
+            if value is None:
+                predicates.append('[@%s]' % attr)
+            else:
+                if value[:1] in '"\'':
+                    value = value[1:-1]
+                predicates.append('[%s]' % SELECTOR_OPERATORS[
+                    match.group('op')].format(attr, xpath_literal(value)))
+        pos = match.end()
+
+
+SELECTOR_CACHE_SIZE = 256
+
+
+class XPathCache(object):
+    """Bounded LRU cache of compiled selectors.
+
+    Keys are tuples of selectors, all merged into one XPath expression."""
+
+    def __init__(self, maxsize=SELECTOR_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, selectors):
+        try:
+            xpath = self.entries[selectors]
+        except KeyError:
+            self.misses += 1
+            xpath = self.entries[selectors] = ET.XPath(
+                        ' | '.join(selector_to_xpath(selector)
+                                   for selector in selectors),
+                        namespaces=SELECTOR_NAMESPACES, smart_strings=False)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+            return xpath
+        self.entries.move_to_end(selectors)
+        self.hits += 1
+        return xpath
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        return {'size': len(self.entries), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses}
+
+
+# Shared by all the documents processed by this process.
+selector_cache = XPathCache()
+
+
+def compile_selectors(selectors):
+    """Return the compiled XPath matching any of the selectors (a string or
+    a list of strings)."""
+    if isinstance(selectors, str):
+        selectors = (selectors,)
+    return selector_cache.get(tuple(selectors))
+
+
+def select_nodes(tree, selectors):
+    """List the elements of the tree (or of the document of an element)
+    matching any of the selectors, in document order."""
+    nodes = compile_selectors(selectors)(tree)
+    stats.count('nodes selected', len(nodes))
+    return nodes
+
+
+### Library API: documents can be given as paths, bytes, streams or trees.
+GZIP_MAGIC = b'\x1f\x8b'
+# Compression level of .svgz outputs.
+GZIP_LEVEL = 6
+
+
+def is_gzip(source):
+    """Whether a file path, bytes or (peekable) stream is gzip-compressed."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source[:2]) == GZIP_MAGIC
+    if isinstance(source, str):
+        with open(source, 'rb') as IN:
+            return IN.read(2) == GZIP_MAGIC
+    if hasattr(source, 'peek'):
+        return source.peek(2)[:2] == GZIP_MAGIC
+    return False
+
+
+@contextmanager
+def svg_input(source):
+    """Something that lxml can parse from a file path, bytes or stream,
+    decompressing it on the fly if it is gzip-compressed (.svgz)."""
+    if isinstance(source, str):
+        with open(source, 'rb') as handle:
+            if handle.peek(2)[:2] == GZIP_MAGIC:
+                with gzip.GzipFile(fileobj=handle, mode='rb') as stream:
+                    yield stream
+            elif os.path.isfile(source):
+                # lxml reads regular files faster by itself.
+                yield source
+            else:
+                # (e.g. a pipe, which can be read only once)
+                yield handle
+        return
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BufferedReader(io.BytesIO(source))
+    elif not hasattr(source, 'peek'):
+        source = io.BufferedReader(source)
+    if is_gzip(source):
+        with gzip.GzipFile(fileobj=source, mode='rb') as stream:
+            yield stream
+    else:
+        yield source
+
+
+def gzip_level_for(dest, gzip_level=None):
+    """Compression level of an output: gzip_level if given (0 means no
+    compression), else GZIP_LEVEL for .svgz paths."""
+    if gzip_level is not None:
+        return gzip_level
+    if isinstance(dest, str) and dest.lower().endswith('.svgz'):
+        return GZIP_LEVEL
+    return 0
+
+
+@contextmanager
+def svg_output(dest, gzip_level=None):
+    """Yield dest itself, or a stream compressing to dest (a path or a
+    writable binary stream), see `gzip_level_for`.
+
+    A path hardlinked elsewhere (e.g. from the `ResultCache`) is replaced
+    instead of overwritten."""
+    if isinstance(dest, str) and os.path.isfile(dest) \
+            and os.stat(dest).st_nlink > 1:
+        os.remove(dest)
+    level = gzip_level_for(dest, gzip_level)
+    if not level or dest is None:
+        yield dest
+        return
+    if hasattr(dest, 'write'):
+        handle = None
+    else:
+        handle = dest = open(dest, 'wb')
+    try:
+        # (mtime=0: same input, same output)
+        with gzip.GzipFile(filename='', mode='wb', fileobj=dest,
+                           compresslevel=level, mtime=0) as stream:
+            yield stream
+    finally:
+        if handle is not None:
+            handle.close()
+
+
+def read_svg_bytes(source):
+    """The (uncompressed) content of a file path, bytes or stream."""
+    with svg_input(source) as stream:
+        if isinstance(stream, str):
+            with open(stream, 'rb') as handle:
+                return handle.read()
+        return stream.read()
+
+
+def load_svg(source):
+    """Return an lxml ElementTree from a file path, bytes, a readable stream,
+    or an already parsed tree/element (returned as is, not copied).
+
+    Gzip-compressed input (.svgz) is detected."""
+    if isinstance(source, ET._ElementTree):
+        return source
+    if isinstance(source, ET._Element):
+        return source.getroottree()
+    with svg_input(source) as stream:
+        return ET.parse(stream)
+
+
+def dump_svg(tree, dest=None, **write_kwargs):
+    """Serialize the tree to dest (a file path or a writable binary stream).
+
+    .svgz paths are compressed. Return the bytes if dest is None."""
+    if dest is None:
+        return ET.tostring(tree, **write_kwargs)
+    with svg_output(dest) as out:
+        tree.write(out, **write_kwargs)
+
+
+### Streaming engine: constant memory (depends on nesting depth only).
+# Files bigger than this are streamed when the engine is 'auto'.
+STREAM_THRESHOLD = 64 * 2**20
+ENGINES = ('auto', 'tree', 'stream')
+XML_NS = 'http://www.w3.org/XML/1998/namespace'
+XML_NS_PREFIX = '{%s}' % XML_NS
+
+
+class _StreamWriter(object):
+    """Write elements as soon as they are complete, then drop them."""
+
+    def __init__(self, xf):
+        self.xf = xf
+        # stack of [element, element context, text written, last child,
+        #           xml prefix declared]
+        self.stack = []
+
+    def flush_parent(self):
+        """Write what precedes a new child in the current element."""
+        if not self.stack:
+            return
+        state = self.stack[-1]
+        elem, _, text_written, last_child, _ = state
+        if not text_written:
+            if elem.text:
+                self.xf.write(elem.text)
+            state[2] = True
+        if last_child is not None:
+            if last_child.tail:
+                self.xf.write(last_child.tail)
+            # Written: free the memory.
+            elem.remove(last_child)
+            state[3] = None
+
+    def start(self, elem):
+        self.flush_parent()
+        if self.stack:
+            parent_nsmap = self.stack[-1][0].nsmap
+            nsmap = dict((prefix, uri) for prefix, uri in elem.nsmap.items()
+                         if parent_nsmap.get(prefix) != uri)
+            xml_declared = self.stack[-1][4]
+        else:
+            nsmap = dict(elem.nsmap)
+            xml_declared = False
+        attrib = dict(elem.attrib)
+        if not xml_declared and any(key.startswith(XML_NS_PREFIX)
+                                    for key in attrib):
+            # The incremental writer needs to know about the xml: prefix
+            # (e.g. for xml:space).
+            nsmap['xml'] = XML_NS
+            xml_declared = True
+        context = self.xf.element(elem.tag, attrib, nsmap)
+        context.__enter__()
+        self.stack.append([elem, context, False, None, xml_declared])
+
+    def end(self, elem):
+        self.flush_parent()
+        context = self.stack.pop()[1]
+        context.__exit__(None, None, None)
+        if self.stack:
+            self.stack[-1][3] = elem
+
+    def leaf(self, node):
+        """comments and processing instructions."""
+        self.flush_parent()
+        self.xf.write(node, with_tail=False)
+        if self.stack:
+            self.stack[-1][3] = node
+
+
+def stream_transform(infile, outfile, rules, images=None, image_cache=None):
+    """Apply the rules while parsing, writing each element out as soon as
+    possible.
+
+    images: the color conversion of embedded images (see `convert_images`),
+    done one at a time here."""
+    convert = images is not None and can_convert_images()
+    with svg_input(infile) as stream, svg_output(outfile) as out:
+        _stream_transform(stream, out, rules, convert and images, image_cache)
+
+
+def _stream_transform(infile, outfile, rules, images, image_cache=None):
+    context = ET.iterparse(infile, events=('start', 'end', 'comment', 'pi'),
+                           remove_blank_text=False)
+    rules_for = None
+    visited = rewritten = 0
+    with ET.xmlfile(outfile, encoding='utf-8') as xf:
+        xf.write_declaration()
+        writer = _StreamWriter(xf)
+        for event, node in context:
+            if event == 'start':
+                if rules_for is None:
+                    # Root element: known namespaces. It is not transformed,
+                    # like with the './/tag' xpaths.
+                    rules_for = rules_bytag(compile_rules(rules,
+                                                          get_nsmap(node)))
+                    doctype = node.getroottree().docinfo.doctype
+                    if doctype:
+                        xf.write_doctype(doctype)
+                else:
+                    chain = rules_for(node.tag)
+                    if chain and apply_rules_to_node(node, chain):
+                        rewritten += 1
+                    if images and node.tag == IMAGE_TAG:
+                        for key, uri in list(image_hrefs(node)):
+                            newuri, error = _convert_data_uri_safe(
+                                                (uri, images, image_cache))
+                            if error:
+                                print('WARNING: embedded image not converted: '
+                                      '%s' % error, file=sys.stderr)
+                            elif newuri is not None:
+                                node.set(key, newuri)
+                                stats.count('images converted')
+                visited += 1
+                writer.start(node)
+            elif event == 'end':
+                writer.end(node)
+            else:
+                writer.leaf(node)
+    stats.count('nodes visited', visited)
+    stats.count('styles rewritten', rewritten)
+
+
+def choose_engine(infile, engine='auto'):
+    if engine not in ENGINES:
+        raise ValueError('Unknown engine %r' % engine)
+    if isinstance(infile, (ET._ElementTree, ET._Element)):
+        # Already in memory.
+        return 'tree'
+    if engine == 'auto':
+        if (isinstance(infile, str) and os.path.isfile(infile)
+                and os.path.getsize(infile) > STREAM_THRESHOLD):
+            return 'stream'
+        return 'tree'
+    return engine
+
+
+def transform_file(infile, outfile, rules, engine='auto', optimize=None,
+                   images=None, select=None, image_cache=None):
+    """Parse, apply the rules in one pass, write.
+
+    infile and outfile can be anything accepted by `load_svg` and `dump_svg`.
+    Output optimization (see `write_tree`) and selectors (see
+    `select_nodes`) are not available when streaming (ValueError with the
+    stream engine).
+    images: color conversion of the embedded raster images (a key of
+    IMAGE_FUNCS), or None; image_cache: where to also store the converted
+    images (see `convert_data_uri`).
+    Return the output bytes if outfile is None."""
+    if optimize is not None:
+        check_tree_engine('--optimize', engine)
+    if select is not None:
+        check_tree_engine('--select', engine)
+    result = None
+    if optimize is None and select is None \
+            and choose_engine(infile, engine) == 'stream':
+        out = io.BytesIO() if outfile is None else outfile
+        with stats.phase('stream'):
+            stream_transform(infile, out, rules, images, image_cache)
+        if outfile is None:
+            result = out.getvalue()
+    else:
+        with stats.phase('parse'):
+            tree = load_svg(infile)
+        with stats.phase('transform'):
+            change_all_styleprops(tree, rules, select)
+        if images is not None:
+            with stats.phase('images'):
+                convert_images(tree, images, select=select,
+                               cache_dir=image_cache)
+        result = write_tree(tree, outfile, optimize)
+    return result
+
+
+### Byte-level fast path for resizefont: no tree, the input is memory-mapped
+### and copied through, only the font-size values are replaced.
+FAST_CHUNK_SIZE = 2**20
+# If any of these is found, the style of texts may not come from their style
+# attribute only: use the tree.
+# (Separate expressions are much faster to search than one alternation.)
+REGS_FAST_UNSAFE = [re.compile(br'<(?:[\w.-]+:)?style[\s/>]'),
+                    re.compile(br'font-size\s*='),
+                    re.compile(br'<!ENTITY')]
+# Comments, CDATA and processing instructions are matched to be skipped.
+REG_FAST_TOKEN = re.compile(
+        br'<!--.*?-->|<!\[CDATA\[.*?\]\]>|<\?.*?\?>'
+        br'|<(?:[\w.-]+:)?(?:text|tspan)(?=[\s/>])((?:[^>"\']+|"[^"]*"|\'[^\']*\')*)>',
+        re.S)
+REG_FAST_STYLE = re.compile(br'\sstyle\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+REG_FAST_FONTSIZE = re.compile(br'(font-size\s*:\s*)([^;]*)')
+
+
+class FastPathError(ValueError):
+    """The byte-level scanner can not handle this document safely."""
+
+
+def fast_resizefont_edits(data, factor):
+    """Return the list of (start, end, replacement) to apply to data."""
+    for reg_unsafe in REGS_FAST_UNSAFE:
+        unsafe = reg_unsafe.search(data)
+        if unsafe:
+            raise FastPathError('found %r'
+                                % unsafe.group().decode('utf-8', 'replace'))
+
+    def resize(match):
+        value = match.group(2).strip()
+        if b'&' in value or b'\\' in value:
+            raise FastPathError('escaped font-size %r' % value)
+        try:
+            newvalue = atomic_resizefont(value.decode('ascii'), factor)
+        except (ValueError, UnicodeDecodeError):
+            raise FastPathError('font-size %r' % value)
+        return match.group(1) + newvalue.encode('ascii')
+
+    # The same styles are usually repeated many times.
+    newstyles = {}
+    edits = []
+    for token in REG_FAST_TOKEN.finditer(data):
+        attrs_start, attrs_end = token.span(1)
+        if attrs_start < 0:
+            continue
+        style = REG_FAST_STYLE.search(data, attrs_start, attrs_end)
+        if not style:
+            continue
+        group = 1 if style.group(1) is not None else 2
+        stylestr = style.group(group)
+        try:
+            newstyle = newstyles[stylestr]
+        except KeyError:
+            newstyle = newstyles[stylestr] = REG_FAST_FONTSIZE.sub(resize,
+                                                                   stylestr)
+        if newstyle != stylestr:
+            edits.append((style.start(group), style.end(group), newstyle))
+    return edits
+
+
+def write_edited(out, data, edits, chunk_size=FAST_CHUNK_SIZE):
+    """Write data with the edits applied, copying the rest by chunks."""
+    view = memoryview(data)
+    try:
+        pos = 0
+        for start, end, replacement in edits + [(len(data), len(data), b'')]:
+            for chunk_start in range(pos, start, chunk_size):
+                out.write(view[chunk_start:min(chunk_start + chunk_size, start)])
+            out.write(replacement)
+            pos = end
+    finally:
+        view.release()
+
+
+def fast_resizefont(infile, outfile, factor):
+    """Resize fonts of a file path or bytes without building a tree.
+
+    Raise FastPathError (before writing anything) if the document contains
+    constructs that the scanner does not handle."""
+    import mmap
+    if is_gzip(infile):
+        raise FastPathError('compressed input')
+    with stats.phase('scan'):
+        if isinstance(infile, bytes):
+            inhandle, data = None, infile
+        else:
+            inhandle = open(infile, 'rb')
+            try:
+                data = mmap.mmap(inhandle.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty file.
+                data = b''
+        try:
+            edits = fast_resizefont_edits(data, factor)
+            stats.count('styles rewritten', len(edits))
+        except Exception:
+            if inhandle:
+                close_mapped(inhandle, data)
+            raise
+    try:
+        with stats.phase('write'):
+            if outfile is None:
+                out = io.BytesIO()
+                write_edited(out, data, edits)
+                return out.getvalue()
+            if hasattr(outfile, 'write'):
+                write_edited(outfile, data, edits)
+            else:
+                with open(outfile, 'wb') as handle, \
+                        svg_output(handle, gzip_level_for(outfile)) as out:
+                    write_edited(out, data, edits)
+    finally:
+        if inhandle:
+            close_mapped(inhandle, data)
+
+
+def close_mapped(handle, data):
+    if not isinstance(data, bytes):
+        data.close()
+    handle.close()
+
+
+def cache_stats():
+    """Statistics of all the caches of this module."""
+    caches = {'style': style_cache.stats(),
+              'selector': selector_cache.stats()}
+    for memo in (atomic_invert, atomic_invertlight, atomic_invertlight2,
+                 atomic_invertoklab):
+        caches[memo.__name__] = memo.stats()
+    return caches
+
+
+### Rules of each command
+COLOR_PROPERTIES = ('fill', 'stroke', 'stop-color', 'pagecolor', 'bordercolor')
+# exclude gradients: 'stop-color', 
+LIGHT_COLOR_PROPERTIES = ('fill', 'stroke', 'pagecolor', 'bordercolor')
+
+
+def rules_resizefont(factor):
+    return [(['svg:tspan', 'svg:text'], 'font-size', atomic_resizefont,
+             float(factor))]
+
+
+def rules_invert():
+    rules = [(['*'], color_attr, atomic_invert)
+             for color_attr in COLOR_PROPERTIES]
+    rules.append((['svg:text'], 'fill', fill_default, 'white'))
+    return rules
 
 
-def svg_invert(infile, outfile, keep_gradients=True):
-    tree = ET.parse(infile)
-    # exclude gradients: 'stop-color', 
-    #change_all_styleprop(tree, ['*'], 'stop-color', atomic_invertlight)
-    for color_attr in ('fill', 'stroke', 'stop-color', 'pagecolor', 'bordercolor'):
-        change_all_styleprop(tree, ['*'], color_attr, atomic_invert)
+def rules_invertlight():
+    return [(['*'], color_attr, atomic_invertlight)
+            for color_attr in LIGHT_COLOR_PROPERTIES]
 
-    #change_all_styleprop(tree, ['text'], 'fill',
-    #                     fill_default, 'white')
-    change_all_styleprop(tree, ['svg:text'], 'fill',
-                         fill_default, 'white')
-    #for color_attr in ('fill', 'stroke', 'stop-color', 'pagecolor', 'bordercolor'):
-    #    change_all_styleprop(tree, ['*'], color_attr, atomic_invert)
-    #for color_attr in ('fill', 'stroke', 'stop-color', 'pagecolor', 'bordercolor'):
-    #    change_all_styleprop(tree, ['*'], color_attr, atomic_invert)
-    tree.write(outfile)
 
+def rules_invertlight2():
+    return [(['*'], color_attr, atomic_invertlight2)
+            for color_attr in LIGHT_COLOR_PROPERTIES]
+
+
+def rules_invertoklab():
+    return [(['*'], color_attr, atomic_invertoklab)
+            for color_attr in LIGHT_COLOR_PROPERTIES]
+
+
+def rules_thicken(factor):
+    return [(['*'], 'stroke-width', atomic_scalelength, float(factor))]
+
+
+def rules_rescale(factor, thicken=1.):
+    """Lengths of the style attributes (see `rescale_geometry` for the
+    coordinates)."""
+    factors = (float(factor), float(factor) * thicken)
+    return [(['*'], propertyname, atomic_scalelength, factors[k])
+            for propertyname, k in LENGTH_PROPERTIES.items()]
+
+
+def pipeline(source, *transforms, select=None):
+    """Apply several transforms to a document, parsing it only once.
+
+    Each transform is either a list of style rules (e.g. from `rules_invert()`)
+    or a function modifying a tree in place. Successive rule lists are fused
+    into a single traversal. Return the tree (the same object if `source` is
+    already a tree); use `dump_svg` to serialize it.
+    select: the rules only change the elements matching these selectors.
+
+        >>> tree = pipeline(svg_bytes, rules_invert(), rules_resizefont(1.5),
+        ...                 select=['#legend', '#legend *'])
+        >>> out_bytes = dump_svg(tree)
+    """
+    tree = load_svg(source)
+    rules = []
+    for transform in transforms:
+        if callable(transform):
+            if rules:
+                change_all_styleprops(tree, rules, select)
+                rules = []
+            transform(tree)
+        else:
+            rules.extend(transform)
+    if rules:
+        change_all_styleprops(tree, rules, select)
+    return tree
+
+
+### Flowed text (Inkscape flowRoot) to normal text.
+# Average glyph width (in em) of some font families. Unknown families use
+# 'sans-serif'.
+FONT_WIDTHS = {'sans-serif': 0.55, 'serif': 0.5, 'monospace': 0.6,
+               'DejaVu Sans': 0.58, 'DejaVu Serif': 0.58,
+               'DejaVu Sans Mono': 0.6, 'Bitstream Vera Sans': 0.58,
+               'Arial': 0.52, 'Helvetica': 0.52, 'Liberation Sans': 0.52,
+               'Times New Roman': 0.47, 'Times': 0.47,
+               'Liberation Serif': 0.47, 'Courier New': 0.6, 'Courier': 0.6}
+MONOSPACE_FAMILIES = set(['monospace', 'DejaVu Sans Mono', 'Courier New',
+                          'Courier'])
+# Relative width of some glyphs in proportional fonts.
+CHAR_WIDTHS = dict([(c, 0.5) for c in "iIjlft.,;:!|'`()[] "] +
+                   [(c, 1.5) for c in 'mwMW@%'] +
+                   [(c, 1.2) for c in 'ABCDEFGHKNOPQRSUVXYZ'])
+DEFAULT_FONTSIZE = 16.
+DEFAULT_LINEHEIGHT = 1.25
+TEXT_ANCHORS = {'start': 'start', 'left': 'start', 'justify': 'start',
+                'center': 'middle', 'end': 'end', 'right': 'end'}
+REG_SPACES = re.compile(r'(\s+)')
+REG_LENGTH = re.compile(r'^\s*(%s)\s*([a-zA-Z]*|%%)\s*$' % REG_NUMBER.pattern)
+# User units (px) per absolute unit.
+ABSOLUTE_UNITS = {'px': 1., 'pt': 4. / 3, 'pc': 16., 'mm': 96. / 25.4,
+                  'cm': 96. / 2.54, 'in': 96., 'q': 96. / 101.6}
+
+
+def safe_parse_style(stylestr):
+    return parse_style(stylestr) if stylestr and stylestr.strip(' ;') else {}
+
+
+def get_font_family(family):
+    for name in (family or '').split(','):
+        name = name.strip().strip('\'"')
+        if name in FONT_WIDTHS:
+            return name
+    return 'sans-serif'
+
+
+def text_width(string, fontsize, family='sans-serif'):
+    """Estimate the width of a string, from the font width table."""
+    width = FONT_WIDTHS[family]
+    if family in MONOSPACE_FAMILIES:
+        return len(string) * width * fontsize
+    return sum(CHAR_WIDTHS.get(c, 1.) for c in string) * width * fontsize
+
+
+def parse_length(value, relative_to, unitless=1.):
+    """Length in user units: absolute lengths (px, pt, mm, ...) converted,
+    '%' and 'em' relative to the given size, unitless numbers multiplied by
+    `unitless`. None if the value is invalid or its unit unknown."""
+    match = REG_LENGTH.match(value or '')
+    if match is None:
+        return None
+    number, unit = float(match.group(1)), match.group(2).lower()
+    if unit == '%':
+        return number / 100. * relative_to
+    if unit == 'em':
+        return number * relative_to
+    if unit == '':
+        return number * unitless
+    if unit in ABSOLUTE_UNITS:
+        return number * ABSOLUTE_UNITS[unit]
+    return None
+
+
+def parse_fontsize(value):
+    """Font-size in user units (unitless means px), the default one for
+    keywords and unknown units."""
+    fontsize = parse_length(value, DEFAULT_FONTSIZE)
+    return DEFAULT_FONTSIZE if fontsize is None else fontsize
+
+
+def parse_lineheight(value, fontsize):
+    """Line-height in user units (unitless is a multiple of the font-size),
+    the default one for 'normal' and unknown units."""
+    lineheight = parse_length(value, fontsize, unitless=fontsize)
+    return DEFAULT_LINEHEIGHT * fontsize if lineheight is None else lineheight
+
+
+def inherited_style(node):
+    """Style properties of the node, including those of its ancestors."""
+    styledict = {}
+    for ancestor in reversed([node] + list(node.iterancestors())):
+        styledict.update(safe_parse_style(ancestor.get('style')))
+    return styledict
+
+
+def flow_region(flowroot, region_tag, rect_tag):
+    """x, y, width of the first rect of the flowRegion (infinite width if
+    there is none)."""
+    region = flowroot.find(region_tag)
+    rect = region.find('.//' + rect_tag) if region is not None else None
+    if rect is None:
+        return 0., 0., float('inf')
+    return (float(rect.get('x', 0)), float(rect.get('y', 0)),
+            float(rect.get('width', 'inf')))
+
+
+def iter_runs(node, styledict, span_tag):
+    """Yield (text, styledict) for all the text of a flowPara."""
+    if node.text:
+        yield node.text, styledict
+    for child in node:
+        if child.tag == span_tag:
+            childstyle = dict(styledict)
+            childstyle.update(safe_parse_style(child.get('style')))
+            for run in iter_runs(child, childstyle, span_tag):
+                yield run
+        if child.tail:
+            yield child.tail, styledict
+
+
+def break_lines(runs, width):
+    """Greedy line breaking of the (text, styledict) runs.
+
+    Return the lines, as lists of [text, styledict]."""
+    lines = [[]]
+    line_width = 0.
+    for text, styledict in runs:
+        fontsize = parse_fontsize(styledict.get('font-size'))
+        family = get_font_family(styledict.get('font-family'))
+        for token in REG_SPACES.split(text):
+            if not token:
+                continue
+            token_width = text_width(token, fontsize, family)
+            if token.isspace():
+                if not lines[-1]:
+                    continue
+            elif lines[-1] and line_width + token_width > width:
+                # Drop the trailing space of the line.
+                last = lines[-1][-1]
+                last[0] = last[0].rstrip()
+                lines.append([])
+                line_width = 0.
+            line = lines[-1]
+            if line and line[-1][1] is styledict:
+                line[-1][0] += token
+            else:
+                line.append([token, styledict])
+            line_width += token_width
+    return lines
+
+
+def flowroot_to_text(flowroot):
+    """Replace a flowRoot by a text element with one tspan per line."""
+    tag = lambda name: '{%s}%s' % (SVG_NS, name)
+    x, y, width = flow_region(flowroot, tag('flowRegion'), tag('rect'))
+    rootstyle = inherited_style(flowroot)
+
+    text = flowroot.makeelement(tag('text'))
+    for attr in ('id', 'style', 'transform', 'class'):
+        if flowroot.get(attr) is not None:
+            text.set(attr, flowroot.get(attr))
+    text.set(XML_NS_PREFIX + 'space', 'preserve')
+    text.tail = flowroot.tail
+
+    baseline = None
+    for para in flowroot.iter(tag('flowPara')):
+        parastyle = dict(rootstyle)
+        parastyle.update(safe_parse_style(para.get('style')))
+        fontsize = parse_fontsize(parastyle.get('font-size'))
+        lineheight = parse_lineheight(parastyle.get('line-height'), fontsize)
+        anchor = TEXT_ANCHORS.get(parastyle.get('text-align', 'start'), 'start')
+        if width == float('inf') or anchor == 'start':
+            line_x = x
+        else:
+            line_x = x + (width if anchor == 'end' else width / 2.)
+
+        lines = break_lines(iter_runs(para, parastyle, tag('flowSpan')), width)
+        for line in lines:
+            baseline = y + fontsize if baseline is None else baseline + lineheight
+            tspan = ET.SubElement(text, tag('tspan'))
+            tspan.set('x', format_number(line_x))
+            tspan.set('y', format_number(baseline))
+            if para.get('style'):
+                tspan.set('style', para.get('style'))
+            if anchor != 'start':
+                tspan.set('style', format_style(dict(
+                    safe_parse_style(tspan.get('style')),
+                    **{'text-anchor': anchor, 'text-align': parastyle.get(
+                        'text-align')})))
+            for run_text, styledict in line:
+                if styledict is parastyle:
+                    if len(tspan):
+                        tspan[-1].tail = (tspan[-1].tail or '') + run_text
+                    else:
+                        tspan.text = (tspan.text or '') + run_text
+                else:
+                    span = ET.SubElement(tspan, tag('tspan'))
+                    spanstyle = dict((k, v) for k, v in styledict.items()
+                                     if parastyle.get(k) != v)
+                    span.set('style', format_style(spanstyle))
+                    span.text = run_text
+
+    flowroot.getparent().replace(flowroot, text)
+    return text
+
+
+def unflow_all(tree):
+    """Convert all flowRoot elements of the tree, whatever their depth."""
+    flowroots = list(tree.getroot().iter('{%s}flowRoot' % SVG_NS))
+    for flowroot in flowroots:
+        flowroot_to_text(flowroot)
+    stats.count('flowed texts converted', len(flowroots))
+
+
+### Geometry rescaling: all the coordinates of the document are parsed into
+### one array, scaled at once, and written back with one format per attribute.
+DEFAULT_PRECISION = 3
+FORMAT_CHUNK_SIZE = 2**18
+REG_NUMBER_SPLIT = re.compile('(%s)' % REG_NUMBER.pattern)
+# Path commands (not 'e', used in numbers).
+REG_PATH_SEGMENT = re.compile(r'([A-DF-Za-df-z])([^A-DF-Za-df-z]*)')
+# Arc parameters: flags can be written without separator ('a5 5 0 015 5').
+REG_ARC_PARAMS = re.compile(r'[\s,]*'.join(['(%s)' % REG_NUMBER.pattern] * 3 +
+                                           ['([01])'] * 2 +
+                                           ['(%s)' % REG_NUMBER.pattern] * 2))
+
+# Length attributes by tag (Clark notation added below). Gradients and
+# patterns are only scaled in userSpaceOnUse units.
+GEOMETRY_ATTRS = {'path': ('d',),
+                  'polyline': ('points',),
+                  'polygon': ('points',),
+                  'rect': ('x', 'y', 'width', 'height', 'rx', 'ry'),
+                  'circle': ('cx', 'cy', 'r'),
+                  'ellipse': ('cx', 'cy', 'rx', 'ry'),
+                  'line': ('x1', 'y1', 'x2', 'y2'),
+                  'text': ('x', 'y', 'dx', 'dy'),
+                  'tspan': ('x', 'y', 'dx', 'dy'),
+                  'image': ('x', 'y', 'width', 'height'),
+                  'use': ('x', 'y', 'width', 'height'),
+                  'foreignObject': ('x', 'y', 'width', 'height'),
+                  'svg': ('x', 'y', 'width', 'height', 'viewBox'),
+                  'linearGradient': ('x1', 'y1', 'x2', 'y2'),
+                  'radialGradient': ('cx', 'cy', 'r', 'fx', 'fy', 'fr'),
+                  'pattern': ('x', 'y', 'width', 'height')}
+GEOMETRY_ATTRS = dict(('{%s}%s' % (SVG_NS, tag), attrs)
+                      for tag, attrs in GEOMETRY_ATTRS.items())
+USER_SPACE_UNITS = {'{%s}linearGradient' % SVG_NS: 'gradientUnits',
+                    '{%s}radialGradient' % SVG_NS: 'gradientUnits',
+                    '{%s}pattern' % SVG_NS: 'patternUnits'}
+# Presentation attributes: which of the two factors (geometry or stroke) to use.
+LENGTH_PROPERTIES = {'font-size': 0, 'stroke-dasharray': 0,
+                     'stroke-dashoffset': 0, 'stroke-width': 1}
+# Translation arguments of each transform function (the linear part of a
+# transform is unchanged by a uniform scaling of the coordinates).
+TRANSFORM_TRANSLATIONS = {'matrix': (4, 5), 'translate': (0, 1),
+                          'rotate': (1, 2)}
+
+
+def split_path(d):
+    """Split path data into pieces alternating separators and numbers.
+
+    Return the pieces and the indices of the numbers that are not
+    coordinates (arc angles and flags)."""
+    if 'a' not in d and 'A' not in d:
+        return REG_NUMBER_SPLIT.split(d), ()
+    pieces = ['']
+    fixed = []
+    n = 0
+    for command, args in REG_PATH_SEGMENT.findall(d):
+        pieces[-1] += command
+        if command in 'Aa':
+            pos = 0
+            for match in REG_ARC_PARAMS.finditer(args):
+                for group in range(1, 8):
+                    pieces[-1] += args[pos:match.start(group)]
+                    pieces.extend((match.group(group), ''))
+                    pos = match.end(group)
+                    if group in (3, 4, 5):
+                        fixed.append(n)
+                    n += 1
+            pieces[-1] += args[pos:]
+        else:
+            argpieces = REG_NUMBER_SPLIT.split(args)
+            pieces[-1] += argpieces[0]
+            pieces.extend(argpieces[1:])
+            n += len(argpieces) // 2
+    return pieces, fixed
+
+
+def split_transform(transform):
+    """Same as `split_path` for a transform: only translations are scaled."""
+    pieces = REG_NUMBER_SPLIT.split(transform)
+    fixed = []
+    n = 0
+    for name, args in REG_TRANSFORM.findall(transform):
+        translations = TRANSFORM_TRANSLATIONS.get(name, ())
+        nargs = len(REG_NUMBER.findall(args))
+        fixed.extend(n + i for i in range(nargs) if i not in translations)
+        n += nargs
+    return pieces, fixed
+
+
+def iter_geometry(roots, factor, stroke_factor):
+    """Yield (node, attrname, pieces, multiplier, fixed indices) for all
+    the attributes containing lengths, in the given subtrees.
+
+    Percentages are relative: values containing '%' are left unchanged."""
+    factors = (factor, stroke_factor)
+    for node in (node for root in roots for node in root.iter(ET.Element)):
+        attrs = GEOMETRY_ATTRS.get(node.tag, ())
+        units = USER_SPACE_UNITS.get(node.tag)
+        if units and node.get(units) != 'userSpaceOnUse':
+            attrs = ()
+        for attrname in attrs:
+            value = node.get(attrname)
+            if value is None or '%' in value:
+                continue
+            if attrname == 'd':
+                pieces, fixed = split_path(value)
+            else:
+                pieces, fixed = REG_NUMBER_SPLIT.split(value), ()
+            yield node, attrname, pieces, factor, fixed
+        for attrname, k in LENGTH_PROPERTIES.items():
+            value = node.get(attrname)
+            if value is not None and '%' not in value:
+                yield node, attrname, REG_NUMBER_SPLIT.split(value), factors[k], ()
+        for attrname in ('transform', 'gradientTransform', 'patternTransform'):
+            value = node.get(attrname)
+            if value is not None and '%' not in value \
+                    and not (units and attrs == ()):
+                pieces, fixed = split_transform(value)
+                yield node, attrname, pieces, factor, fixed
+
+
+def format_decimals(values, precision=DEFAULT_PRECISION):
+    """Format an array of floats with at most `precision` decimals (without
+    trailing zeros), as a list of strings.
+
+    The characters are computed with arrays (one row per number) and joined
+    at once: much faster than formatting each float. Numbers too big for
+    64-bit integers are formatted with `format_number`."""
+    formatted = []
+    for start in range(0, len(values), FORMAT_CHUNK_SIZE):
+        chunk = values[start:start + FORMAT_CHUNK_SIZE]
+        scaled = chunk * 10**precision
+        small = np.abs(scaled) < 2.**63
+        if not small.all():
+            chunk_formatted = np.array([format_number(value, precision)
+                                        for value in chunk.tolist()],
+                                       dtype=object)
+            chunk_formatted[small] = format_decimals(chunk[small], precision)
+            formatted.extend(chunk_formatted.tolist())
+            continue
+        ints = np.rint(scaled).astype(np.int64)
+        negative = ints < 0
+        ints = np.abs(ints)
+        ndigits = max(len(str(ints.max())), precision + 1) if len(ints) else 1
+        digits = np.empty((len(ints), ndigits), dtype=np.uint8)
+        for i in range(ndigits - 1, -1, -1):
+            quotient = ints // 10
+            digits[:, i] = ints - quotient * 10
+            ints = quotient
+        nint = ndigits - precision
+        nonzero = digits != 0
+        # Drop leading zeros (but the units) and trailing decimal zeros.
+        keep_int = np.logical_or.accumulate(nonzero[:, :nint], axis=1)
+        keep_int[:, -1] = True
+        keep_frac = np.logical_or.accumulate(nonzero[:, :nint - 1:-1],
+                                             axis=1)[:, ::-1]
+        # Columns: sign, integer digits, dot, decimals, separator.
+        chars = np.empty((len(digits), ndigits + 3), dtype=np.uint8)
+        keep = np.empty(chars.shape, dtype=bool)
+        chars[:, 0] = ord('-')
+        keep[:, 0] = negative
+        chars[:, 1:nint + 1] = digits[:, :nint] + ord('0')
+        keep[:, 1:nint + 1] = keep_int
+        chars[:, nint + 1] = ord('.')
+        keep[:, nint + 1] = keep_frac[:, 0] if precision else False
+        chars[:, nint + 2:-1] = digits[:, nint:] + ord('0')
+        keep[:, nint + 2:-1] = keep_frac
+        chars[:, -1] = 0
+        keep[:, -1] = True
+        formatted.extend(chars[keep].tobytes().decode('ascii').split('\0')[:-1])
+    return formatted
+
+
+def scale_numbers(numbers, multipliers, fixed, precision=DEFAULT_PRECISION):
+    """Multiply the numbers (strings) by the multipliers, given as a list of
+    (count, multiplier), except at the fixed indices.
+
+    Return the formatted results."""
+    if np is not None:
+        values = np.array(numbers, dtype=float)
+        counts, factors = zip(*multipliers)
+        scale = np.repeat(np.array(factors, dtype=float), counts)
+        scale[np.array(fixed, dtype=np.intp)] = 1.
+        return format_decimals(values * scale, precision)
+    scale = [m for count, m in multipliers for _ in range(count)]
+    for i in fixed:
+        scale[i] = 1.
+    values = [round(float(v) * m, precision) for v, m in zip(numbers, scale)]
+    # The repr of rounded floats is their shortest decimal form (but in
+    # scientific notation when very big or small).
+    formatted = repr(values).replace('.0,', ',').replace('.0]', ']')
+    return ['0' if number == '-0' else
+            number if value == 0 or 1e-4 <= abs(value) < 1e15 else
+            format_number(value, precision)
+            for number, value in zip(formatted[1:-1].split(', '), values)]
+
+
+def rescale_geometry(tree, factor, stroke_factor=None,
+                     precision=DEFAULT_PRECISION, extra_roots=()):
+    """Multiply all coordinates and lengths of the tree by factor, and
+    stroke widths by stroke_factor (default: factor).
+
+    extra_roots: subtrees detached from the tree to process with it."""
+    stroke_factor = factor if stroke_factor is None else stroke_factor
+    targets = []
+    numbers = []
+    multipliers = []
+    fixed = []
+    roots = [tree.getroot()] + list(extra_roots)
+    for node, attrname, pieces, multiplier, fixed_indices in iter_geometry(
+            roots, factor, stroke_factor):
+        count = len(pieces) // 2
+        if not count:
+            continue
+        offset = len(numbers)
+        fixed.extend(offset + i for i in fixed_indices)
+        numbers.extend(pieces[1::2])
+        multipliers.append((count, multiplier))
+        # Numbers can be written without separator (e.g. '1.5.5' or '1-2'):
+        # once formatted, they need one.
+        template = '%s'.join(pieces[0::2]).replace('%s%s', '%s %s')
+        targets.append((node, attrname, template.replace('%s%s', '%s %s'),
+                        count))
+    if not numbers:
+        return
+
+    values = scale_numbers(numbers, multipliers, fixed, precision)
+    pos = 0
+    for node, attrname, template, count in targets:
+        node.set(attrname, template % tuple(values[pos:pos + count]))
+        pos += count
+    stats.count('coordinates scaled', len(numbers))
+
+
+def atomic_scalelength(lengthstr, factor):
+    """Multiply all numbers of a length (or list of lengths)."""
+    if lengthstr is None or '%' in lengthstr:
+        return lengthstr
+    return REG_NUMBER.sub(lambda m: format_number(float(m.group()) * factor),
+                          lengthstr)
+
+
+### Id references (url(#id), href) and unused definitions.
+# Definitions are the children of <defs> elements having an id: they are
+# only drawn when referenced from drawn content, directly or through other
+# definitions.
+DEFS_TAG = '{%s}defs' % SVG_NS
+HREF_KEYS = ('{http://www.w3.org/1999/xlink}href', 'href')
+UNPRUNED_TAGS = ('{%s}style' % SVG_NS, '{%s}script' % SVG_NS)
+REG_URL_REF = re.compile(r'''url\(\s*["']?#([^)"'\s]+)''')
+
+
+def node_references(node):
+    """Ids referenced by the attributes (and text, for <style>) of one
+    element."""
+    refs = []
+    for key, value in node.attrib.items():
+        if key in HREF_KEYS:
+            if value.startswith('#'):
+                refs.append(value[1:])
+        elif 'url(' in value:
+            refs.extend(REG_URL_REF.findall(value))
+    if node.tag == STYLE_TAG and node.text:
+        refs.extend(REG_URL_REF.findall(node.text))
+    return refs
+
+
+def is_definition(node):
+    return (node.get('id') is not None and node.tag not in UNPRUNED_TAGS
+            and node.getparent() is not None
+            and node.getparent().tag == DEFS_TAG)
+
+
+def iter_content(root):
+    """Elements of the subtree, except the definitions and their content."""
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        yield node
+        children = [child for child in node if isinstance(child.tag, str)]
+        if node.tag == DEFS_TAG:
+            children = [child for child in children
+                        if not is_definition(child)]
+        stack.extend(reversed(children))
+
+
+def reference_index(roots):
+    """Index the definitions of the subtrees.
+
+    Return (definitions, owners, definition_refs): the definitions in
+    document order, the definition containing each id defined inside one,
+    and the ids referenced from inside each definition."""
+    definitions = []
+    owners = {}
+    definition_refs = {}
+    for root in roots:
+        for defs in root.iter(DEFS_TAG):
+            for child in defs:
+                if isinstance(child.tag, str) and is_definition(child) \
+                        and child not in definition_refs:
+                    definitions.append(child)
+                    refs = definition_refs[child] = set()
+                    for node in child.iter(ET.Element):
+                        refs.update(node_references(node))
+                        if node.get('id') is not None:
+                            owners[node.get('id')] = child
+    return definitions, owners, definition_refs
+
+
+def reachable_definitions(refs, owners, definition_refs):
+    """The set of the definitions needed by the referenced ids."""
+    reached = set()
+    todo = list(refs)
+    while todo:
+        definition = owners.get(todo.pop())
+        if definition is not None and definition not in reached:
+            reached.add(definition)
+            todo.extend(definition_refs[definition])
+    return reached
+
+
+def content_references(root):
+    refs = set()
+    for node in iter_content(root):
+        refs.update(node_references(node))
+    return refs
+
+
+def prune_defs(tree, extra_roots=()):
+    """Remove the definitions not referenced from the drawn content (of the
+    tree and of the extra_roots). Return the number of removed definitions."""
+    roots = [tree.getroot()] + list(extra_roots)
+    definitions, owners, definition_refs = reference_index(roots)
+    refs = set()
+    for root in roots:
+        refs.update(content_references(root))
+    needed = reachable_definitions(refs, owners, definition_refs)
+    unused = [definition for definition in definitions
+              if definition not in needed]
+    for definition in unused:
+        definition.getparent().remove(definition)
+    stats.count('definitions removed', len(unused))
+    return len(unused)
+
+
+### Output optimization (minification)
+EDITOR_NAMESPACES = ('http://www.inkscape.org/namespaces/inkscape',
+                     'http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd')
+EDITOR_PREFIXES = tuple('{%s}' % ns for ns in EDITOR_NAMESPACES)
+EDITOR_STYLE_PREFIX = '-inkscape-'
+METADATA_TAG = '{%s}metadata' % SVG_NS
+STYLE_TAG = '{%s}style' % SVG_NS
+SVG_PREFIX = '{%s}' % SVG_NS
+# Style attributes used at least this number of times are replaced by a class.
+HOIST_MIN_COUNT = 2
+
+
+def strip_editor_style(stylestr):
+    return ';'.join(decl for decl in stylestr.split(';')
+                    if not decl.strip().startswith(EDITOR_STYLE_PREFIX))
+
+
+def optimize_tree(tree, precision=DEFAULT_PRECISION, extra_roots=()):
+    """Minify the document in place, in linear time:
+
+    - remove editor data (Inkscape and Sodipodi elements and attributes,
+      '-inkscape-' style properties, metadata);
+    - round the numbers to `precision` decimals (None or negative: keep them);
+    - remove the unused definitions (see `prune_defs`);
+    - replace repeated style attributes by classes of a new <style> element
+      (only if the document has no stylesheet, which could compete with them).
+
+    extra_roots: subtrees detached from the tree to process with it (e.g.
+    layers), their classes are defined in the <style> of the tree."""
+    root = tree.getroot()
+    roots = [root] + list(extra_roots)
+    removed_nodes = []
+    removed_attrs = 0
+    style_counts = OrderedDict()
+    cleaned_styles = {}
+    classes = set()
+    has_stylesheet = False
+    for node in (node for subroot in roots for node in subroot.iter(ET.Element)):
+        tag = node.tag
+        if tag.startswith(EDITOR_PREFIXES) or tag == METADATA_TAG:
+            removed_nodes.append(node)
+            continue
+        for key in node.attrib.keys():
+            if key.startswith(EDITOR_PREFIXES):
+                del node.attrib[key]
+                removed_attrs += 1
+        if tag == STYLE_TAG:
+            has_stylesheet = True
+        stylestr = node.get('style')
+        if stylestr is not None:
+            if EDITOR_STYLE_PREFIX in stylestr:
+                try:
+                    stylestr = cleaned_styles[stylestr]
+                except KeyError:
+                    stylestr = cleaned_styles[stylestr] = strip_editor_style(
+                                                                    stylestr)
+                node.set('style', stylestr)
+            if tag.startswith(SVG_PREFIX):
+                style_counts[stylestr] = style_counts.get(stylestr, 0) + 1
+        if node.get('class'):
+            classes.update(node.get('class').split())
+
+    for node in removed_nodes:
+        parent = node.getparent()
+        # (a removed node can be inside an already removed one)
+        if parent is not None:
+            parent.remove(node)
+    stats.count('editor nodes removed', len(removed_nodes))
+    stats.count('editor attributes removed', removed_attrs)
+
+    prune_defs(tree, extra_roots)
+
+    if precision is not None and precision >= 0:
+        rescale_geometry(tree, 1., 1., precision, extra_roots)
+
+    # (before adding the <style>, so that it uses the default namespace)
+    for subroot in roots:
+        ET.cleanup_namespaces(subroot)
+
+    if not has_stylesheet:
+        hoist_styles(roots, style_counts, classes)
+
+
+def hoist_styles(roots, style_counts, classes=()):
+    """Replace the style attributes used at least HOIST_MIN_COUNT times by
+    generated classes, defined in a <style> element in roots[0]."""
+    class_names = {}
+    n = 0
+    for stylestr, count in style_counts.items():
+        if count < HOIST_MIN_COUNT or not stylestr.strip(' ;'):
+            continue
+        name = 's%x' % n
+        while name in classes:
+            n += 1
+            name = 's%x' % n
+        class_names[stylestr] = name
+        n += 1
+    if not class_names:
+        return
+
+    for node in (node for subroot in roots for node in subroot.iter(ET.Element)):
+        name = class_names.get(node.get('style'))
+        if name is not None and node.tag.startswith(SVG_PREFIX):
+            del node.attrib['style']
+            node.set('class', (node.get('class', '') + ' ' + name).lstrip())
+    style = ET.Element(STYLE_TAG)
+    style.text = '\n' + ''.join('.%s{%s}\n' % (name, stylestr)
+                                for stylestr, name in class_names.items())
+    roots[0].insert(0, style)
+    stats.count('styles hoisted', len(class_names))
+
+
+def write_tree(tree, outfile, optimize=None):
+    """Optimize the tree if `optimize` (the precision) is not None, and dump
+    it."""
+    if optimize is not None:
+        with stats.phase('optimize'):
+            optimize_tree(tree, optimize)
+    with stats.phase('serialize'):
+        return dump_svg(tree, outfile)
+
+
+def add_optimize_arguments(parser):
+    group = parser.add_argument_group('output optimization')
+    group.add_argument('-O', '--optimize', action='store_true',
+                       help=("minify the output: no editor data, rounded "
+                             "numbers, repeated styles as classes"))
+    group.add_argument('--optimize-precision', type=int,
+                       default=DEFAULT_PRECISION,
+                       help=("decimals kept by --optimize (negative: no "
+                             "rounding) [%(default)s]"))
+
+
+def pop_optimize_arguments(argdict):
+    """Return the `optimize` keyword value (precision or None)."""
+    precision = argdict.pop('optimize_precision')
+    return precision if argdict.pop('optimize') else None
+
+
+### Embedded raster images (base64 data URIs of <image> elements)
+IMAGE_TAG = '{%s}image' % SVG_NS
+XLINK_HREF = '{http://www.w3.org/1999/xlink}href'
+REG_DATA_URI = re.compile(r'data:(image/[\w.+-]+)(?:;[^;,]*)*;base64,', re.I)
+# Converted images, by hash of the source image and of the conversion: kept
+# in memory, and on disk only if a directory is given (by default this one,
+# else in the --cache-dir, see `image_cache_dir`).
+IMAGE_CACHE_DIR = os.environ.get('SVGGURU_IMAGE_CACHE')
+IMAGE_MEMO_SIZE = 64
+image_memo = OrderedDict()
+IMAGE_THREADS = None
+IMAGE_FORMATS = {'PNG': 'image/png', 'JPEG': 'image/jpeg', 'GIF': 'image/gif',
+                 'WEBP': 'image/webp'}
+IMAGE_FUNCS = {'invert': rgbarray_invert,
+               'invertlight': rgbarray_invertlight,
+               'invertlight2': rgbarray_invertlight2,
+               'invertoklab': rgbarray_invertoklab}
+
+
+def convert_image_bytes(data, conversion, lut_dir=None):
+    """Apply the color conversion to all the pixels of an encoded image
+    (lut_dir: see `oklab_lut`).
+
+    Return the mime type and the encoded result (same format when possible,
+    PNG otherwise)."""
+    image = Image.open(io.BytesIO(data))
+    fmt = image.format if image.format in IMAGE_FORMATS else 'PNG'
+    if image.mode not in ('RGB', 'RGBA'):
+        has_alpha = 'A' in image.mode or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+    if fmt == 'JPEG' and image.mode == 'RGBA':
+        fmt = 'PNG'
+    pixels = np.asarray(image).astype(np.int16)
+    rgb = pixels[..., :3].reshape(-1, 3)
+    if conversion == 'invertoklab':
+        converted = rgbarray_invertoklab(rgb, lut_dir)
+    else:
+        converted = IMAGE_FUNCS[conversion](rgb)
+    pixels[..., :3] = np.clip(converted, 0, 255
+                              ).reshape(pixels.shape[:2] + (3,))
+    out = io.BytesIO()
+    Image.fromarray(pixels.astype(np.uint8), image.mode).save(out, fmt)
+    return IMAGE_FORMATS[fmt], out.getvalue()
+
+
+def remember_image(key, newuri):
+    if len(image_memo) >= IMAGE_MEMO_SIZE:
+        try:
+            # Drop the oldest (images are converted by several threads).
+            image_memo.popitem(last=False)
+        except KeyError:
+            pass
+    image_memo[key] = newuri
+    return newuri
+
+
+def convert_data_uri(uri, conversion, cache_dir=None):
+    """Return the converted data URI, or None if it is not a raster image.
+
+    Results are cached in memory, and in cache_dir (default IMAGE_CACHE_DIR)
+    if any, by hash of the image and conversion; the invertoklab table is
+    also kept there (see `oklab_lut`)."""
+    match = REG_DATA_URI.match(uri)
+    if not match or match.group(1).lower() == 'image/svg+xml':
+        return None
+    payload = ''.join(uri[match.end():].split())
+    key = hashlib.sha1(('%s\0%s' % (conversion, payload)).encode('ascii')
+                       ).hexdigest()
+    try:
+        return image_memo[key]
+    except KeyError:
+        pass
+    cache_dir = cache_dir or IMAGE_CACHE_DIR
+    cache_file = os.path.join(cache_dir, key[:2], key) if cache_dir else None
+    if cache_file and os.path.isfile(cache_file):
+        with open(cache_file) as cached:
+            newuri = cached.read()
+        # (the least recently used results are evicted from a ResultCache)
+        os.utime(cache_file)
+        return remember_image(key, newuri)
+
+    mime, data = convert_image_bytes(base64.b64decode(payload), conversion,
+                                     cache_dir)
+    newuri = remember_image(key, 'data:%s;base64,%s'
+                            % (mime, base64.b64encode(data).decode('ascii')))
+    if cache_file:
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            tmpfile = '%s.%d.tmp' % (cache_file, os.getpid())
+            with open(tmpfile, 'w') as out:
+                out.write(newuri)
+            os.replace(tmpfile, cache_file)
+        except OSError as err:
+            print_if_verbose('WARNING: image cache not written: %s' % err,
+                             file=sys.stderr)
+    return newuri
+
+
+def _convert_data_uri_safe(args):
+    uri, conversion, cache_dir = args
+    try:
+        return convert_data_uri(uri, conversion, cache_dir), None
+    except Exception as err:
+        return None, '%s: %s' % (type(err).__name__, err)
 
-def svg_invertlight(infile, outfile):
-    tree = ET.parse(infile)
-    # exclude gradients: 'stop-color', 
-    for color_attr in ('fill', 'stroke', 'pagecolor', 'bordercolor'):
-        change_all_styleprop(tree, ['*'], color_attr, atomic_invertlight)
-    tree.write(outfile)
 
+def image_hrefs(node):
+    for key in (XLINK_HREF, 'href'):
+        value = node.get(key)
+        if value is not None and value.startswith('data:'):
+            yield key, value
 
-def svg_invertlight2(infile, outfile):
-    tree = ET.parse(infile)
-    # exclude gradients: 'stop-color', 
-    for color_attr in ('fill', 'stroke', 'pagecolor', 'bordercolor'):
-        change_all_styleprop(tree, ['*'], color_attr, atomic_invertlight2)
-    tree.write(outfile)
+
+def can_convert_images():
+    if Image is None or np is None:
+        print('WARNING: embedded images are left unchanged (Pillow and NumPy '
+              'are needed)', file=sys.stderr)
+        return False
+    return True
+
+
+def convert_images(tree, conversion, threads=IMAGE_THREADS, select=None,
+                   cache_dir=None):
+    """Convert the colors of all embedded raster images (or of the ones
+    matching the selectors), in a thread pool.
+
+    Identical images are converted once (see `convert_data_uri` for
+    cache_dir)."""
+    from concurrent.futures import ThreadPoolExecutor
+    targets = OrderedDict()
+    if select is None:
+        images = tree.getroot().iter(IMAGE_TAG)
+    else:
+        images = [node for node in compile_selectors(select)(tree)
+                  if node.tag == IMAGE_TAG]
+    for node in images:
+        for key, uri in image_hrefs(node):
+            targets.setdefault(uri, []).append((node, key))
+    if not targets or not can_convert_images():
+        return
+    with ThreadPoolExecutor(threads) as executor:
+        results = executor.map(_convert_data_uri_safe,
+                               [(uri, conversion, cache_dir)
+                                for uri in targets])
+        for (uri, nodes), (newuri, error) in zip(targets.items(), results):
+            if error:
+                print('WARNING: embedded image not converted: %s' % error,
+                      file=sys.stderr)
+            elif newuri is not None:
+                for node, key in nodes:
+                    node.set(key, newuri)
+                stats.count('images converted', len(nodes))
+
+
+# Commands needing the whole tree: they have no streaming engine.
+TREE_ONLY_COMMANDS = ('unflowtext', 'rescale', 'prunedefs', 'optimize')
+
+
+def check_tree_engine(command, engine):
+    if engine == 'stream':
+        raise ValueError('%s needs the whole tree: the stream engine is not '
+                         'available' % command)
+
+
+### Specific function affecting all elements. They are called directly with
+### the script arguments. infile and outfile can also be bytes, streams or
+### trees (see `load_svg` and `dump_svg`): they return the bytes when outfile
+### is None.
+def svg_resizefont(infile, outfile, factor, engine='auto', align=False,
+                   fast=False, optimize=None, select=None):
+    """Multiply font-size attributes by the given factor.
+
+    With align, move the texts so that aligned texts stay aligned (needs the
+    whole tree: the streaming engine is not used).
+    With fast, rewrite the font-size values directly in the bytes of the file
+    when it is safe, otherwise use the engine."""
+    if fast and not align and optimize is None and select is None \
+            and isinstance(infile, (str, bytes)):
+        try:
+            return fast_resizefont(infile, outfile, factor)
+        except FastPathError as err:
+            print_if_verbose('INFO: no fast path (%s), using the %s engine.'
+                             % (err, engine), file=sys.stderr)
+    if not align:
+        return transform_file(infile, outfile, rules_resizefont(factor), engine,
+                              optimize, select=select)
+    check_tree_engine('resizefont --align', engine)
+    with stats.phase('parse'):
+        tree = load_svg(infile)
+    with stats.phase('transform'):
+        if select is None:
+            batch_change_all_nodes(tree, ['svg:text'], None, batch_resizefont,
+                                   float(factor))
+        else:
+            selected = set(select_nodes(tree, select))
+            batch_resizefont([text for text in select_nodes(tree, 'svg:text')
+                              if text in selected], float(factor))
+    return write_tree(tree, outfile, optimize)
+
+
+def svg_unflowtext(infile, outfile, engine='auto', optimize=None):
+    """Convert flowed text (Inkscape flowRoot) to normal text elements."""
+    check_tree_engine('unflowtext', engine)
+    with stats.phase('parse'):
+        tree = load_svg(infile)
+    with stats.phase('transform'):
+        unflow_all(tree)
+    return write_tree(tree, outfile, optimize)
+
+
+def svg_thicken(infile, outfile, factor, engine='auto', optimize=None,
+                select=None):
+    """Multiply stroke widths (of style attributes) by the given factor."""
+    return transform_file(infile, outfile, rules_thicken(factor), engine,
+                          optimize, select=select)
+
+
+def svg_rescale(infile, outfile, factor, thicken=1.,
+                precision=DEFAULT_PRECISION, engine='auto', optimize=None):
+    """Resize the drawing: multiply all coordinates and lengths by the given
+    factor (and stroke widths, by thicken too)."""
+    check_tree_engine('rescale', engine)
+    with stats.phase('parse'):
+        tree = load_svg(infile)
+    with stats.phase('transform'):
+        change_all_styleprops(tree, rules_rescale(factor, thicken))
+        rescale_geometry(tree, factor, factor * thicken, precision)
+    return write_tree(tree, outfile, optimize)
+
+
+def svg_invert(infile, outfile, keep_gradients=True, engine='auto',
+               optimize=None, keep_images=False, select=None,
+               image_cache=None):
+    """Invert colors (also of embedded images, unless keep_images)."""
+    return transform_file(infile, outfile, rules_invert(), engine, optimize,
+                          None if keep_images else 'invert', select,
+                          image_cache)
+
+
+def svg_invertlight(infile, outfile, engine='auto', optimize=None,
+                    keep_images=False, select=None,
+                    image_cache=None):
+    """Invert luminosity, but keep hue."""
+    return transform_file(infile, outfile, rules_invertlight(), engine,
+                          optimize, None if keep_images else 'invertlight',
+                          select, image_cache)
+
+
+def svg_invertlight2(infile, outfile, engine='auto', optimize=None,
+                     keep_images=False, select=None,
+                     image_cache=None):
+    """Invert luminosity, but keep hue (mean luminosity, within gamut)."""
+    return transform_file(infile, outfile, rules_invertlight2(), engine,
+                          optimize, None if keep_images else 'invertlight2',
+                          select, image_cache)
+
+
+def svg_invertoklab(infile, outfile, engine='auto', optimize=None,
+                    keep_images=False, select=None,
+                    image_cache=None):
+    """Invert the perceived lightness (in OKLab), keep hue."""
+    return transform_file(infile, outfile, rules_invertoklab(), engine,
+                          optimize, None if keep_images else 'invertoklab',
+                          select, image_cache)
+
+
+def svg_prunedefs(infile, outfile, engine='auto', optimize=None):
+    """Remove the definitions (gradients, filters, markers, clip paths,
+    symbols...) that nothing drawn references."""
+    check_tree_engine('prunedefs', engine)
+    with stats.phase('parse'):
+        tree = load_svg(infile)
+    with stats.phase('transform'):
+        removed = prune_defs(tree)
+    print_if_verbose('INFO: %d unused definitions removed.' % removed,
+                     file=sys.stderr)
+    return write_tree(tree, outfile, optimize)
+
+
+def svg_optimize(infile, outfile, precision=DEFAULT_PRECISION, engine='auto'):
+    """Minify: remove editor data and unused definitions, round numbers, and
+    replace repeated styles by classes. Report the bytes saved."""
+    check_tree_engine('optimize', engine)
+    insize = None
+    with stats.phase('parse'):
+        if isinstance(infile, (ET._ElementTree, ET._Element)):
+            tree = load_svg(infile)
+        else:
+            # Read it first to know its (uncompressed) size.
+            data = read_svg_bytes(infile)
+            insize = len(data)
+            tree = load_svg(data)
+    with stats.phase('optimize'):
+        optimize_tree(tree, precision)
+    with stats.phase('serialize'):
+        result = dump_svg(tree)
+        if outfile is not None:
+            with svg_output(outfile) as out:
+                if hasattr(out, 'write'):
+                    out.write(result)
+                else:
+                    with open(out, 'wb') as handle:
+                        handle.write(result)
+    if insize:
+        stats.count('bytes saved', insize - len(result))
+        print('INFO: optimized %d -> %d bytes (%.1f%% saved)'
+              % (insize, len(result), 100. * (insize - len(result)) / insize),
+              file=sys.stderr)
+    if outfile is None:
+        return result
 
 
 ### OLD less malleable versions
@@ -353,12 +2757,61 @@ def svg_resizefont_old(filename, factor, outfile):
 COMMANDS = {'resizefont': svg_resizefont,
             'invert': svg_invert,
             'invertlight': svg_invertlight,
-            'invertlight2': svg_invertlight2}
+            'invertlight2': svg_invertlight2,
+            'invertoklab': svg_invertoklab,
+            'unflowtext': svg_unflowtext,
+            'thicken': svg_thicken,
+            'rescale': svg_rescale,
+            'prunedefs': svg_prunedefs,
+            'optimize': svg_optimize}
 
 #CMD_FUNC = {cmd_name: globals()['svg_' + cmd_name] for cmd_name in COMMANDS}
 
+KEEP_IMAGES_ARG = dict(args=('-k', '--keep-images'), action='store_true',
+                       help="do not convert embedded raster images")
+def selector_arg(value):
+    try:
+        compile_selectors(value)
+    except (SelectorError, ET.XPathSyntaxError) as err:
+        raise argparse.ArgumentTypeError(str(err))
+    return value
+
+
+SELECT_ARG = dict(args=('-s', '--select'), action='append',
+                  type=selector_arg,
+                  help=("only change the elements matching this CSS-like "
+                        "selector (tag, #id, .class, [attr=value], "
+                        "descendant and child combinators; can be repeated)"))
+
 CMD_ARGS = {'resizefont': [dict(args=('factor',), type=float,
-                            help="by how much to multiply the font-size")]}
+                            help="by how much to multiply the font-size"),
+                           dict(args=('-a', '--align'), action='store_true',
+                                help=("move texts so that aligned texts stay "
+                                      "aligned (tree engine only)")),
+                           dict(args=('-f', '--fast'), action='store_true',
+                                help=("rewrite font-sizes in the raw bytes, "
+                                      "without parsing (when the file allows "
+                                      "it)")),
+                           SELECT_ARG],
+            'thicken': [dict(args=('factor',), type=float,
+                             help="by how much to multiply stroke widths"),
+                        SELECT_ARG],
+            'rescale': [dict(args=('factor',), type=float,
+                             help="by how much to multiply the coordinates"),
+                        dict(args=('-t', '--thicken'), type=float, default=1.,
+                             help=("additional factor for stroke widths "
+                                   "[%(default)s]")),
+                        dict(args=('--precision',), type=int,
+                             default=DEFAULT_PRECISION,
+                             help="number of decimals [%(default)s]")],
+            'invert': [KEEP_IMAGES_ARG, SELECT_ARG],
+            'invertlight': [KEEP_IMAGES_ARG, SELECT_ARG],
+            'invertlight2': [KEEP_IMAGES_ARG, SELECT_ARG],
+            'invertoklab': [KEEP_IMAGES_ARG, SELECT_ARG],
+            'optimize': [dict(args=('--precision',), type=int,
+                              default=DEFAULT_PRECISION,
+                              help=("number of decimals (negative: no "
+                                    "rounding) [%(default)s]"))]}
 
 # Complete __doc__
 #longest_cmd_len = max(len(cmd) for cmd in COMMANDS)
@@ -368,39 +2821,997 @@ CMD_ARGS = {'resizefont': [dict(args=('factor',), type=float,
 #    __doc__ += cmd_fmt % (command, command_doc)
 
 
-if __name__ == '__main__':
+### Watch mode: re-run when the inputs change, re-transforming only the
+### subtrees that changed when the command allows it.
+# inotify event mask: file written and closed, or moved in place (editors
+# often save to a temporary file and rename it).
+IN_CLOSE_WRITE = 0x08
+IN_MOVED_TO = 0x80
+IN_CLOEXEC = 0o2000000
+# Seconds to wait for more events after a change (one save can make several).
+WATCH_DEBOUNCE = 0.02
+# Seconds between two checks when inotify is not available.
+POLL_INTERVAL = 0.1
+
+
+class FileWatcher(object):
+    """Wait for changes of a set of files, with inotify on Linux (watching
+    their directories), else by polling their modification time and size."""
+
+    def __init__(self, paths, poll_interval=POLL_INTERVAL):
+        self.paths = set(os.path.abspath(path) for path in paths)
+        self.poll_interval = poll_interval
+        self.fd = None
+        try:
+            self.fd, self.dirs = self.init_inotify()
+        except (OSError, AttributeError):
+            # No inotify: poll.
+            self.signatures = self.poll()
+
+    def init_inotify(self):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        fd = libc.inotify_init1(IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        dirs = {}
+        for dirname in set(os.path.dirname(path) for path in self.paths):
+            wd = libc.inotify_add_watch(fd, dirname.encode(),
+                                        IN_CLOSE_WRITE | IN_MOVED_TO)
+            if wd < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(),
+                              'inotify_add_watch failed on %s' % dirname)
+            dirs[wd] = dirname
+        return fd, dirs
+
+    def read_events(self):
+        changed = set()
+        data = os.read(self.fd, 65536)
+        pos = 0
+        while pos < len(data):
+            wd, _, _, length = struct.unpack_from('iIII', data, pos)
+            pos += 16
+            name = data[pos:pos + length].rstrip(b'\0').decode(
+                                                sys.getfilesystemencoding())
+            pos += length
+            path = os.path.join(self.dirs.get(wd, ''), name)
+            if path in self.paths:
+                changed.add(path)
+        return changed
+
+    def poll(self):
+        signatures = {}
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+                signatures[path] = (st.st_mtime_ns, st.st_size, st.st_ino)
+            except OSError:
+                signatures[path] = None
+        return signatures
+
+    def wait(self):
+        """Block until some files changed, and return their paths."""
+        import select
+        changed = set()
+        if self.fd is not None:
+            while not changed:
+                select.select([self.fd], [], [])
+                changed = self.read_events()
+            while select.select([self.fd], [], [], WATCH_DEBOUNCE)[0]:
+                changed.update(self.read_events())
+            return sorted(changed)
+        while True:
+            time.sleep(self.poll_interval)
+            signatures = self.poll()
+            changed = [path for path in self.paths
+                       if signatures[path] != self.signatures[path]
+                       and signatures[path] is not None]
+            # (a missing file is being saved: wait for it)
+            if changed and None not in (signatures[path] for path in changed):
+                self.signatures = signatures
+                return sorted(changed)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def watch_files(paths, run):
+    """Call run() now, then after each change of the files, until
+    interrupted. Errors are reported without stopping."""
+    watcher = FileWatcher(paths)
+    try:
+        while True:
+            start = time.time()
+            try:
+                run()
+            except Exception as err:
+                print('ERROR: %s: %s' % (type(err).__name__, err),
+                      file=sys.stderr)
+            else:
+                print('INFO: updated in %.3fs' % (time.time() - start),
+                      file=sys.stderr)
+            print('INFO: watching %s (%s)' % (', '.join(sorted(paths)),
+                  'inotify' if watcher.fd is not None else 'polling'),
+                  file=sys.stderr)
+            changed = watcher.wait()
+            print('INFO: changed: %s' % ', '.join(changed), file=sys.stderr)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        watcher.close()
+
+
+REG_NEWLINE = re.compile(b'\n')
+
+
+def line_offsets(data):
+    """Offsets of the start of each line of data."""
+    if np is not None:
+        return np.concatenate(([0], np.flatnonzero(
+                    np.frombuffer(data, np.uint8) == ord('\n')) + 1))
+    return [0] + [match.end() for match in REG_NEWLINE.finditer(data)]
+
+
+def same_node(node1, node2):
+    """Whether the nodes are equal, apart from the content of their
+    children."""
+    return (node1.tag == node2.tag and node1.text == node2.text
+            and node1.tail == node2.tail
+            and dict(node1.attrib) == dict(node2.attrib)
+            and len(node1) == len(node2))
+
+
+def diff_subtrees(old_root, new_root, old_source, new_source):
+    """Find the smallest subtrees that differ between two versions of a
+    document. The sources are (bytes, `line_offsets`) of each version:
+    children whose lines are identical are skipped, so only the changed
+    parts of the tree are visited.
+
+    Return a list of (path, new node), path being the list of child indices
+    leading to the node from the root, or None if the root itself (or
+    what precedes it) differs."""
+    def span(source, first, last):
+        """The bytes of lines first to last (from 1)."""
+        data, offsets = source
+        return data[offsets[first - 1]:
+                    offsets[last] if last < len(offsets) else len(data)]
+
+    if span(old_source, 1, old_root.sourceline) != \
+            span(new_source, 1, new_root.sourceline) \
+            or not same_node(old_root, new_root) \
+            or old_root.nsmap != new_root.nsmap:
+        return None
+    changed = []
+    todo = [(old_root, new_root, len(old_source[1]), len(new_source[1]), [])]
+    while todo:
+        old, new, old_bound, new_bound, path = todo.pop()
+        if path and not same_node(old, new):
+            changed.append((path, new))
+            continue
+        old_children = list(old)
+        new_children = list(new)
+        old_start, new_start = old.sourceline, new.sourceline
+        for k, (old_child, new_child) in enumerate(zip(old_children,
+                                                       new_children)):
+            # The line of a node is where its start tag *ends*: a child
+            # spans from the line of its previous sibling to the next one.
+            if k > 0:
+                old_start = old_children[k - 1].sourceline
+                new_start = new_children[k - 1].sourceline
+            if k + 1 < len(new_children):
+                old_end = old_children[k + 1].sourceline
+                new_end = new_children[k + 1].sourceline
+            else:
+                old_end, new_end = old_bound, new_bound
+            if None in (old_start, new_start, old_end, new_end):
+                # (no line numbers: compare the whole subtrees)
+                if ET.tostring(old_child) != ET.tostring(new_child):
+                    changed.append((path + [k], new_child))
+                continue
+            if span(old_source, old_start, old_end) != \
+                    span(new_source, new_start, new_end):
+                todo.append((old_child, new_child, old_end, new_end,
+                             path + [k]))
+    return changed
+
+
+def command_rules(command, kwargs):
+    """(rules, image conversion) of commands changing each element
+    independently of the others, else None."""
+    if kwargs.get('select') is not None or kwargs.get('optimize') is not None:
+        return None
+    images = None if kwargs.get('keep_images') else command
+    if command == 'invert':
+        return rules_invert(), images
+    elif command == 'invertlight':
+        return rules_invertlight(), images
+    elif command == 'invertlight2':
+        return rules_invertlight2(), images
+    elif command == 'invertoklab':
+        return rules_invertoklab(), images
+    elif command == 'thicken':
+        return rules_thicken(kwargs['factor']), None
+    elif command == 'resizefont' and not kwargs.get('align'):
+        return rules_resizefont(kwargs['factor']), None
+    return None
+
+
+class WatchedCommand(object):
+    """Run a command on each update of its input.
+
+    When the command changes each element independently (see
+    `command_rules`), the previous input and output trees are kept, and only
+    the subtrees that changed are transformed again."""
+
+    def __init__(self, command, kwargs, gzip_level=None):
+        self.command = command
+        self.kwargs = kwargs
+        self.gzip_level = gzip_level
+        self.incremental = command_rules(command, kwargs)
+        self.source = self.input = self.output = None
+
+    def update(self):
+        infile, outfile = self.kwargs['infile'], self.kwargs['outfile']
+        if self.incremental is None:
+            with svg_output(outfile, self.gzip_level) as out:
+                return COMMANDS[self.command](**dict(self.kwargs,
+                                                     outfile=out))
+        rules, images = self.incremental
+        with stats.phase('parse'):
+            data = read_svg_bytes(infile)
+            if self.source is not None and data == self.source[0]:
+                print_if_verbose('INFO: no change', file=sys.stderr)
+                return
+            tree = load_svg(data)
+        with stats.phase('diff'):
+            source = (data, line_offsets(data))
+            changed = None
+            if self.input is not None:
+                changed = diff_subtrees(self.input.getroot(), tree.getroot(),
+                                        self.source, source)
+        if changed is None:
+            output = copy.deepcopy(tree)
+            with stats.phase('transform'):
+                change_all_styleprops(output, rules)
+            if images is not None:
+                with stats.phase('images'):
+                    convert_images(output, images,
+                                   cache_dir=self.kwargs.get('image_cache'))
+        else:
+            output = self.output
+            ns = get_nsmap(tree.getroot())
+            with stats.phase('transform'):
+                for path, node in changed:
+                    replaced = output.getroot()
+                    for k in path:
+                        replaced = replaced[k]
+                    node = copy.deepcopy(node)
+                    node.tail = replaced.tail
+                    change_subtree_styleprops(node, rules, ns)
+                    if images is not None:
+                        convert_images(ET.ElementTree(node), images,
+                                       cache_dir=self.kwargs.get('image_cache'))
+                    replaced.getparent().replace(replaced, node)
+            stats.count('subtrees updated', len(changed))
+            print_if_verbose('INFO: %d changed subtrees' % len(changed),
+                             file=sys.stderr)
+        self.source, self.input, self.output = source, tree, output
+        with svg_output(outfile, self.gzip_level) as out:
+            write_tree(output, out)
+
+
+### Result cache: outputs stored by hash of the input, command, arguments and
+### version, and reused without parsing (opt-in, with --cache-dir).
+RESULT_CACHE_DIR = os.environ.get('SVGGURU_CACHE_DIR')
+# Bytes kept in the cache, the least recently used results are evicted.
+RESULT_CACHE_SIZE = 2**30
+HASH_CHUNK_SIZE = 2**20
+REG_BYTESIZE = re.compile(r'^\s*(\d+(?:\.\d*)?)\s*([KMGT]?)i?B?\s*$', re.I)
+
+
+def parse_bytesize(value):
+    """'500M' -> 524288000 (K, M, G and T are powers of 1024)."""
+    match = REG_BYTESIZE.match(value)
+    if not match:
+        raise argparse.ArgumentTypeError('invalid size: %r' % value)
+    return int(float(match.group(1))
+               * 1024 ** ' KMGT'.index(match.group(2).upper() or ' '))
+
+
+def format_bytesize(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            break
+        size /= 1024.
+    return ('%d %s' if unit == 'B' else '%.1f %s') % (size, unit)
+
+
+def file_digest(path):
+    """sha256 of the content of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache(object):
+    """Directory of results, by key (see `key`).
+
+    Entries are read-only files, hardlinked to the outputs (or copied if link
+    is False or the cache is on another filesystem). Their modification
+    time is updated at each use, and `prune` evicts the least recently used
+    ones beyond max_size bytes."""
+
+    def __init__(self, cache_dir, max_size=RESULT_CACHE_SIZE, link=True):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.link = link
+
+    @staticmethod
+    def key(*parts):
+        """Hash of the tool version and of json-serializable parts."""
+        data = json.dumps([__version__] + list(parts), sort_keys=True,
+                          default=repr)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def fetch(self, key, outfile):
+        """Put the result of key at outfile. Return False if not cached."""
+        entry = self.path(key)
+        tmpfile = '%s.%d.tmp' % (outfile, os.getpid())
+        if os.path.lexists(tmpfile):
+            os.remove(tmpfile)
+        try:
+            try:
+                if not self.link:
+                    raise OSError('no link')
+                os.link(entry, tmpfile)
+            except FileNotFoundError:
+                raise
+            except OSError:
+                shutil.copyfile(entry, tmpfile)
+            os.utime(entry)
+        except FileNotFoundError:
+            stats.count('cache misses')
+            return False
+        os.replace(tmpfile, outfile)
+        stats.count('cache hits')
+        return True
+
+    def fetch_data(self, key):
+        """The bytes stored for key, or None."""
+        try:
+            with open(self.path(key), 'rb') as handle:
+                data = handle.read()
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            return None
+        return data
+
+    def _add(self, key, write):
+        entry = self.path(key)
+        tmpfile = '%s.%d.tmp' % (entry, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            write(tmpfile)
+            os.chmod(tmpfile, 0o444)
+            os.replace(tmpfile, entry)
+        except OSError as err:
+            print('WARNING: result not cached: %s' % err, file=sys.stderr)
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+
+    def store(self, key, outfile):
+        """Store (a copy of) outfile as the result of key."""
+        self._add(key, lambda tmpfile: shutil.copyfile(outfile, tmpfile))
+
+    def store_data(self, key, data):
+        def write(tmpfile):
+            with open(tmpfile, 'wb') as handle:
+                handle.write(data)
+        self._add(key, write)
+
+    def cached_output(self, key, outfile, write):
+        """Fetch the result of key to outfile, else call write() and store
+        outfile. Return whether it was cached."""
+        if self.fetch(key, outfile):
+            return True
+        write()
+        self.store(key, outfile)
+        return False
+
+    def entries(self):
+        """(last use, size, path) of each entry."""
+        if not os.path.isdir(self.cache_dir):
+            return
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield st.st_mtime, st.st_size, path
+
+    def prune(self, max_size=None):
+        """Evict the least recently used entries until the cache holds at
+        most max_size bytes (default self.max_size).
+
+        Return the number of entries removed and of bytes freed."""
+        if max_size is None:
+            max_size = self.max_size
+        entries = sorted(self.entries())
+        excess = sum(size for _, size, _ in entries) - max_size
+        removed = freed = 0
+        for _, size, path in entries:
+            if freed >= excess:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            removed += 1
+            freed += size
+        stats.count('cache evictions', removed)
+        return removed, freed
+
+    def summary(self):
+        entries = list(self.entries())
+        return {'dir': self.cache_dir,
+                'entries': len(entries),
+                'size': sum(size for _, size, _ in entries),
+                'max_size': self.max_size,
+                'oldest_use': min(mtime for mtime, _, _ in entries)
+                              if entries else None,
+                'newest_use': max(mtime for mtime, _, _ in entries)
+                              if entries else None}
+
+
+def add_cache_arguments(parser):
+    parser.add_argument('--cache-dir', default=RESULT_CACHE_DIR,
+                        help=("reuse the results stored in this directory, "
+                              "and store the new ones [$SVGGURU_CACHE_DIR]"))
+    parser.add_argument('--cache-size', type=parse_bytesize,
+                        default=RESULT_CACHE_SIZE,
+                        help=("maximum size of the cache (K, M, G suffixes) "
+                              "[%s]" % format_bytesize(RESULT_CACHE_SIZE)))
+    parser.add_argument('--cache-copy', action='store_true',
+                        help="copy cached results instead of hardlinking")
+
+
+def pop_cache_arguments(argdict):
+    """The ResultCache of the command line arguments (None if no
+    --cache-dir), removing them from argdict."""
+    cache_dir = argdict.pop('cache_dir')
+    max_size = argdict.pop('cache_size')
+    link = not argdict.pop('cache_copy')
+    if not cache_dir:
+        return None
+    return ResultCache(cache_dir, max_size, link)
+
+
+def image_cache_dir(cache):
+    """Absolute directory of the converted images (the daemon workers change
+    directory): $SVGGURU_IMAGE_CACHE, else the 'images' directory of the
+    ResultCache if any, else None (kept in memory only)."""
+    if IMAGE_CACHE_DIR:
+        return os.path.abspath(IMAGE_CACHE_DIR)
+    if cache is not None:
+        return os.path.abspath(os.path.join(cache.cache_dir, 'images'))
+    return None
+
+
+def add_image_cache(cmd_kwargs, cache):
+    """Pass the image cache to the commands converting images."""
+    if 'keep_images' in cmd_kwargs:
+        cmd_kwargs['image_cache'] = image_cache_dir(cache)
+
+
+def svg_cache(action, cache):
+    """Show the content of the result cache ('stats'), or evict its least
+    recently used entries beyond --cache-size ('prune')."""
+    if action == 'prune':
+        removed, freed = cache.prune()
+        print('cache prune: %d entries removed, %s freed.'
+              % (removed, format_bytesize(freed)))
+    summary = cache.summary()
+    print('cache directory: %s' % summary['dir'])
+    print('entries: %d' % summary['entries'])
+    print('size: %s (max %s)' % (format_bytesize(summary['size']),
+                                 format_bytesize(summary['max_size'])))
+    if summary['entries']:
+        print('last used: %s (least recent: %s)'
+              % tuple(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t))
+                      for t in (summary['newest_use'],
+                                summary['oldest_use'])))
+    return 0
+
+
+def command_cache_key(command, infile, outfile, cmd_kwargs):
+    """Cache key of the result of a command (a key of COMMANDS, or
+    VARIANT_COPY), or None unless the input and output are regular files."""
+    if not (isinstance(infile, str) and isinstance(outfile, str)
+            and os.path.isfile(infile)) \
+            or (os.path.exists(outfile) and not os.path.isfile(outfile)):
+        return None
+    cmd_kwargs = dict(cmd_kwargs)
+    cmd_kwargs['gzip_level'] = gzip_level_for(outfile,
+                                              cmd_kwargs.get('gzip_level'))
+    # Where the converted images are kept does not change the result.
+    cmd_kwargs.pop('image_cache', None)
+    return ResultCache.key('svgguru', command, file_digest(infile),
+                           cmd_kwargs)
+
+
+def run_command(command, infile, outfile, gzip_level=None, cache=None,
+                **cmd_kwargs):
+    """Apply a command of COMMANDS, reusing the result stored in cache (a
+    `ResultCache`) if any."""
+    def write():
+        with svg_output(outfile, gzip_level) as out:
+            COMMANDS[command](infile, out, **cmd_kwargs)
+
+    key = None if cache is None else command_cache_key(
+            command, infile, outfile, dict(cmd_kwargs, gzip_level=gzip_level))
+    if key is None:
+        write()
+    elif cache.cached_output(key, outfile, write):
+        print_if_verbose('INFO: %s: cached result' % outfile, file=sys.stderr)
+
+
+### Batch mode: process many files with a pool of workers.
+BATCH_PATTERN = '{reldir}{base}{ext}'
+# Number of workers when not specified (None: number of cpus).
+DEFAULT_JOBS = None
+
+
+def iter_batch_inputs(inputs, manifest=None):
+    """Expand globs, directories and manifest lines into (infile, reldir,
+    outfile) triplets. outfile is None unless given by the manifest."""
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            for dirpath, _, filenames in os.walk(pattern):
+                reldir = os.path.relpath(dirpath, pattern)
+                for filename in sorted(filenames):
+                    if filename.lower().endswith(('.svg', '.svgz')):
+                        yield (os.path.join(dirpath, filename),
+                               '' if reldir == '.' else reldir + os.sep,
+                               None)
+        else:
+            matches = sorted(glob.glob(pattern, recursive=True))
+            if not matches:
+                # Let the worker report the missing file.
+                matches = [pattern]
+            for infile in matches:
+                yield infile, '', None
+
+    if manifest:
+        # One file per line, optionally followed by its output file.
+        with open(manifest) as IN:
+            for line in IN:
+                words = line.split('#', 1)[0].split()
+                if words:
+                    yield words[0], '', (words[1] if len(words) > 1 else None)
+
+
+def batch_outfile(infile, reldir, outdir, pattern, command):
+    base, ext = os.path.splitext(os.path.basename(infile))
+    return os.path.join(outdir, pattern.format(base=base, ext=ext,
+                                               reldir=reldir, command=command))
+
+
+def run_batch_job(job):
+    """Worker function: run one command, never raise."""
+    command, infile, outfile, cmd_kwargs = job
+    start = time.time()
+    stats.reset()
+    try:
+        outdir = os.path.dirname(outfile)
+        if outdir and not os.path.isdir(outdir):
+            os.makedirs(outdir, exist_ok=True)
+        run_command(command, infile, outfile, **cmd_kwargs)
+        error = None
+    except Exception as err:
+        error = '%s: %s' % (type(err).__name__, err)
+    return infile, outfile, error, time.time() - start, stats.report()
+
+
+def svg_batch(command, inputs, outdir='.', pattern=BATCH_PATTERN,
+              manifest=None, jobs=None, **cmd_kwargs):
+    """Apply a command to many files in parallel. Return the number of
+    failures."""
+    jobs = jobs or DEFAULT_JOBS or os.cpu_count() or 1
+    joblist = []
+    for infile, reldir, outfile in iter_batch_inputs(inputs, manifest):
+        if outfile is None:
+            outfile = batch_outfile(infile, reldir, outdir, pattern, command)
+        joblist.append((command, infile, outfile, cmd_kwargs))
+
+    failures = []
+    start = time.time()
+    # The workers reset the statistics of their own process (also this one
+    # when jobs == 1): the reports are merged apart, and copied at the end.
+    batch_stats = RunStats()
+    batch_stats.start = stats.start
+    batch_stats.merge(stats.report())
+    if jobs == 1:
+        results = map(run_batch_job, joblist)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(jobs)
+        # Bigger chunks amortize the inter-process communication.
+        chunksize = max(1, len(joblist) // (jobs * 4))
+        results = pool.imap_unordered(run_batch_job, joblist, chunksize)
+    try:
+        for infile, outfile, error, elapsed, report in results:
+            batch_stats.merge(report)
+            if error:
+                failures.append((infile, error))
+                print('FAIL: %s: %s' % (infile, error), file=sys.stderr)
+            else:
+                print_if_verbose('OUT:  %s (%.3fs)' % (outfile, elapsed),
+                                 file=sys.stderr)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        stats.start = batch_stats.start
+        stats.phases, stats.counters = batch_stats.phases, batch_stats.counters
+
+    print('%s: %d files processed in %.2fs with %d workers, %d failed.'
+          % (command, len(joblist), time.time() - start, jobs, len(failures)),
+          file=sys.stderr)
+    for infile, error in failures:
+        print('  %s: %s' % (infile, error), file=sys.stderr)
+    return len(failures)
+
+
+### Variants: several outputs of one input, parsed once.
+# The variant writing the parsed document as is (with the output options).
+VARIANT_COPY = 'copy'
+
+# Document parsed once, inherited by the forked workers.
+_variant_tree = None
+
+
+def run_variant(tree, command, outfile, cmd_kwargs):
+    """Apply one command to the tree (modified in place) and write it."""
+    cmd_kwargs = dict(cmd_kwargs)
+    gzip_level = cmd_kwargs.pop('gzip_level', None)
+    outdir = os.path.dirname(outfile)
+    if outdir and not os.path.isdir(outdir):
+        os.makedirs(outdir, exist_ok=True)
+    with svg_output(outfile, gzip_level) as out:
+        if command == VARIANT_COPY:
+            write_tree(tree, out, cmd_kwargs.get('optimize'))
+        else:
+            COMMANDS[command](tree, out, **cmd_kwargs)
+
+
+def run_variant_job(job):
+    """Worker function: run one variant on the inherited document, never
+    raise. Each worker is a fresh fork: its copy of the tree is shared with
+    the parent until modified."""
+    command, outfile, cmd_kwargs = job
+    start = time.time()
+    stats.reset()
+    try:
+        run_variant(_variant_tree, command, outfile, cmd_kwargs)
+        error = None
+    except Exception as err:
+        error = '%s: %s' % (type(err).__name__, err)
+    return outfile, error, time.time() - start, stats.report()
+
+
+def svg_variants(infile, variants, jobs=None, cache=None):
+    """Produce several variants of a file from a single parse: variants is a
+    list of (command, outfile, command keyword arguments); the command
+    VARIANT_COPY writes the document unchanged. Return the number of
+    failures.
+
+    Where processes can be forked, each variant runs in its own worker,
+    which modifies and serializes a copy-on-write view of the parsed tree
+    (only the modified memory is duplicated); otherwise the variants run one
+    after the other on copies of the tree.
+    The results stored in cache (a `ResultCache`) are reused, and the input
+    is not parsed if they are all there."""
+    global _variant_tree
+
+    for command, _, _ in variants:
+        if command != VARIANT_COPY and command not in COMMANDS:
+            raise ValueError('Unknown command %r' % command)
+    start = time.time()
+    total = len(variants)
+    keys = {}
+    if cache is not None:
+        todo = []
+        for command, outfile, cmd_kwargs in variants:
+            key = command_cache_key(command, infile, outfile, cmd_kwargs)
+            if key is not None and cache.fetch(key, outfile):
+                print_if_verbose('OUT:  %s (cached)' % outfile,
+                                 file=sys.stderr)
+                continue
+            keys[outfile] = key
+            todo.append((command, outfile, cmd_kwargs))
+        variants = todo
+    jobs = min(jobs or DEFAULT_JOBS or os.cpu_count() or 1,
+               max(1, len(variants)))
+    if variants:
+        with stats.phase('parse'):
+            tree = load_svg(infile)
+
+    failures = []
+    pool = None
+    if not variants:
+        results = ()
+    elif jobs > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        _variant_tree = tree
+        # One task per worker: each variant starts from the pristine tree.
+        pool = multiprocessing.get_context('fork').Pool(jobs,
+                                                        maxtasksperchild=1)
+        results = pool.imap_unordered(run_variant_job, variants)
+    else:
+        jobs = 1
+        def run_in_process(k, variant):
+            command, outfile, cmd_kwargs = variant
+            start = time.time()
+            try:
+                # The last variant may modify the tree itself.
+                run_variant(tree if k == len(variants) - 1
+                            else copy.deepcopy(tree),
+                            command, outfile, cmd_kwargs)
+                error = None
+            except Exception as err:
+                error = '%s: %s' % (type(err).__name__, err)
+            return outfile, error, time.time() - start, {}
+        results = (run_in_process(k, variant)
+                   for k, variant in enumerate(variants))
+    try:
+        with stats.phase('variants'):
+            for outfile, error, elapsed, report in results:
+                stats.merge(report)
+                if error:
+                    failures.append((outfile, error))
+                    print('FAIL: %s: %s' % (outfile, error), file=sys.stderr)
+                else:
+                    if keys.get(outfile) is not None:
+                        cache.store(keys[outfile], outfile)
+                    print_if_verbose('OUT:  %s (%.3fs)' % (outfile, elapsed),
+                                     file=sys.stderr)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _variant_tree = None
+
+    print('variants: %d outputs of %s (%d cached) in %.2fs with %d workers, '
+          '%d failed.' % (total, infile, total - len(variants),
+                          time.time() - start, jobs, len(failures)),
+          file=sys.stderr)
+    return len(failures)
+
+
+def build_variant_parser():
+    """Parser of the variant specifications: 'command outfile [arguments]',
+    with the arguments of the command."""
+    parser = argparse.ArgumentParser(prog='variant',
+                                     description='command outfile [arguments]')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    cmd_descriptions = dict((cmd_name, cmd_func.__doc__)
+                            for cmd_name, cmd_func in COMMANDS.items())
+    cmd_descriptions[VARIANT_COPY] = 'Write the document unchanged.'
+    for cmd_name, description in cmd_descriptions.items():
+        cmd_parser = subparsers.add_parser(cmd_name, description=description)
+        cmd_parser.add_argument('outfile')
+        for cmd_args in CMD_ARGS.get(cmd_name, []):
+            cmd_args = dict(cmd_args)
+            cmd_parser.add_argument(*cmd_args.pop('args'), **cmd_args)
+        add_gzip_argument(cmd_parser)
+        if cmd_name != 'optimize':
+            add_optimize_arguments(cmd_parser)
+    return parser
+
+
+def parse_variants(specs, manifest=None):
+    """(command, outfile, keyword arguments) of each specification string
+    (see `build_variant_parser`), then of each line of the manifest file."""
+    specs = list(specs)
+    if manifest:
+        with open(manifest) as IN:
+            specs.extend(line for line in IN
+                         if line.split('#', 1)[0].strip())
+    parser = build_variant_parser()
+    variants = []
+    for spec in specs:
+        cmd_kwargs = vars(parser.parse_args(
+                                    shlex.split(spec, comments=True)))
+        if 'optimize' in cmd_kwargs:
+            cmd_kwargs['optimize'] = pop_optimize_arguments(cmd_kwargs)
+        command = cmd_kwargs.pop('command')
+        variants.append((command, cmd_kwargs.pop('outfile'), cmd_kwargs))
+    return variants
+
+
+def build_parser():
     parser = argparse.ArgumentParser(description=__doc__)
     parent_parser = argparse.ArgumentParser(add_help=False)
     parent_parser.add_argument('infile')
     parent_parser.add_argument('outfile')
     parent_parser.add_argument('-v', '--verbose', action='store_true')
+    parent_parser.add_argument('-w', '--watch', action='store_true',
+                               help=("keep running, and update the output "
+                                     "each time the input changes"))
+    add_stats_arguments(parent_parser)
+    add_gzip_argument(parent_parser)
+    add_cache_arguments(parent_parser)
+    parent_parser.add_argument('-e', '--engine', choices=ENGINES,
+                               default='auto',
+                               help=("'stream' uses constant memory, 'auto' "
+                                     "streams files bigger than %d MiB "
+                                     "[%%(default)s]" % (STREAM_THRESHOLD >> 20)))
 
     subparsers = parser.add_subparsers(dest='command')
 
-    #if len(sys.argv) <= 1 or sys.argv[1] not in COMMANDS:
-    #    print(__doc__, file=sys.stderr)
-    #    sys.exit(1)
-
-    #command, *cl_args = sys.argv[1:]
-    #command_func = COMMANDS[command]
-
     # Create argument parser of the specific command.
     for cmd_name, cmd_func in COMMANDS.items():
         cmd_parser = subparsers.add_parser(cmd_name, 
                                           description=cmd_func.__doc__, 
                                           parents=[parent_parser])
         for cmd_args in CMD_ARGS.get(cmd_name, []):
-            #if cmd_args:
+            cmd_args = dict(cmd_args)
             cmd_parser.add_argument(*cmd_args.pop('args'), **cmd_args)
+        if cmd_name != 'optimize':
+            add_optimize_arguments(cmd_parser)
 
-    parsed_args = parser.parse_args()
-
-    # Finally process the svg file.
-    argdict = vars(parsed_args)
+    batch_parser = subparsers.add_parser('batch', description=svg_batch.__doc__)
+    batch_subparsers = batch_parser.add_subparsers(dest='batch_command')
+    for cmd_name, cmd_func in COMMANDS.items():
+        cmd_parser = batch_subparsers.add_parser(cmd_name,
+                                                 description=cmd_func.__doc__)
+        for cmd_args in CMD_ARGS.get(cmd_name, []):
+            cmd_args = dict(cmd_args)
+            cmd_parser.add_argument(*cmd_args.pop('args'), **cmd_args)
+        cmd_parser.add_argument('inputs', nargs='*',
+                                help='svg files, globs or directories')
+        cmd_parser.add_argument('-m', '--manifest',
+                                help=('file listing one input per line '
+                                      '(optionally followed by its output)'))
+        cmd_parser.add_argument('-o', '--outdir', default='.',
+                                help='[%(default)s]')
+        cmd_parser.add_argument('-p', '--pattern', default=BATCH_PATTERN,
+                                help=("Output path format, relative to outdir "
+                                      "['%(default)s']. Keys are {base}, {ext}, "
+                                      "{command}, and {reldir} the subdirectory "
+                                      "(with trailing slash) inside an input "
+                                      "directory."))
+        cmd_parser.add_argument('-j', '--jobs', type=int,
+                                help='number of workers [number of cpus]')
+        cmd_parser.add_argument('-v', '--verbose', action='store_true')
+        cmd_parser.add_argument('-e', '--engine', choices=ENGINES,
+                                default='auto', help='[%(default)s]')
+        add_gzip_argument(cmd_parser)
+        add_stats_arguments(cmd_parser)
+        add_cache_arguments(cmd_parser)
+        if cmd_name != 'optimize':
+            add_optimize_arguments(cmd_parser)
+
+    variants_parser = subparsers.add_parser('variants',
+                                            description=svg_variants.__doc__)
+    variants_parser.add_argument('infile')
+    variants_parser.add_argument('specs', nargs='*', metavar='spec',
+                                 help=("'command outfile [arguments]' (quoted),"
+                                       " e.g. 'resizefont big.svg 1.5'; the "
+                                       "command '%s' writes the input as is"
+                                       % VARIANT_COPY))
+    variants_parser.add_argument('-m', '--manifest',
+                                 help='file listing one spec per line')
+    variants_parser.add_argument('-j', '--jobs', type=int,
+                                 help='number of workers [number of cpus]')
+    variants_parser.add_argument('-v', '--verbose', action='store_true')
+    add_stats_arguments(variants_parser)
+    add_cache_arguments(variants_parser)
+
+    cache_parser = subparsers.add_parser('cache',
+                                         description=svg_cache.__doc__)
+    cache_parser.add_argument('action', choices=('stats', 'prune'))
+    add_cache_arguments(cache_parser)
+    return parser
+
+
+def add_gzip_argument(parser):
+    parser.add_argument('-z', '--gzip-level', type=int, choices=range(10),
+                        metavar='{0-9}',
+                        help=("compress the output with gzip (0: not at all) "
+                              "[%d for .svgz outputs, else 0]" % GZIP_LEVEL))
+
+
+def check_engine_argument(parser, command, argdict):
+    """Exit with a usage error if the command cannot stream as requested."""
+    if argdict.get('engine') != 'stream':
+        return
+    options = [option for option, key in (('--align', 'align'),
+                                          ('--select', 'select'))
+               if argdict.get(key)]
+    if argdict.get('optimize') is not None:
+        options.append('--optimize')
+    if command in TREE_ONLY_COMMANDS or options:
+        parser.error('%s: the stream engine is not available (needs the '
+                     'whole tree)' % ' '.join([command] + options))
+
+
+def mute(*args, **kwargs):
+    pass
+
+
+def main(argv=None, parser=None):
+    global print_if_verbose
+
+    parser = parser or build_parser()
+    argdict = vars(parser.parse_args(argv))
+
+    if argdict['command'] == 'cache':
+        cache = pop_cache_arguments(argdict)
+        if cache is None:
+            parser.error('cache: no --cache-dir (or $SVGGURU_CACHE_DIR) given')
+        return svg_cache(argdict['action'], cache)
+
+    print_if_verbose = print if argdict.pop('verbose') else mute
+
+    instrument = dict((key, argdict.pop(key))
+                      for key in ('show_stats', 'stats_json', 'profile'))
+    if 'optimize' in argdict:
+        argdict['optimize'] = pop_optimize_arguments(argdict)
+    cache = pop_cache_arguments(argdict)
+    command = argdict.pop('command')
+    check_engine_argument(parser, command, argdict)
+    add_image_cache(argdict, cache)
+    if command == 'batch':
+        command = argdict.pop('batch_command')
+        if not argdict['inputs'] and not argdict['manifest']:
+            parser.error('batch: no input files given')
+        check_engine_argument(parser, command, argdict)
+        failures = run_instrumented(svg_batch, (command,),
+                                    dict(argdict, cache=cache), **instrument)
+    elif command == 'variants':
+        variants = parse_variants(argdict.pop('specs'),
+                                  argdict.pop('manifest'))
+        if not variants:
+            parser.error('variants: no variant given')
+        for _, _, cmd_kwargs in variants:
+            add_image_cache(cmd_kwargs, cache)
+        failures = run_instrumented(svg_variants, (argdict['infile'],
+                                                   variants),
+                                    {'jobs': argdict['jobs'], 'cache': cache},
+                                    caches=cache_stats, **instrument)
+    elif argdict.pop('watch'):
+        if os.path.abspath(argdict['infile']) == \
+                os.path.abspath(argdict['outfile']):
+            parser.error('--watch: the output must not be the input')
+        updater = WatchedCommand(command, argdict, argdict.pop('gzip_level'))
+        return watch_files([argdict['infile']],
+                           lambda: run_instrumented(updater.update,
+                                                    caches=cache_stats,
+                                                    **instrument))
+    else:
+        # Finally process the svg file.
+        run_instrumented(run_command, (command,), dict(argdict, cache=cache),
+                         caches=cache_stats, **instrument)
+        failures = 0
+    if cache is not None:
+        cache.prune()
+    return 1 if failures else 0
 
-    if not argdict.pop('verbose'):
-        def print_if_verbose(*args, **kwargs):
-            pass
-        
-    COMMANDS[argdict.pop('command')](**argdict)
 
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+import svgguru
+
+
+@pytest.fixture(params=[True, False], ids=['link', 'copy'])
+def cache(request, tmp_path):
+    return svgguru.ResultCache(str(tmp_path / 'cache'), max_size=1000,
+                               link=request.param)
+
+
+def set_last_use(cache, key, mtime):
+    os.utime(cache.path(key), (mtime, mtime))
+
+
+def test_key():
+    assert svgguru.ResultCache.key('invert', 1) == \
+           svgguru.ResultCache.key('invert', 1)
+    assert svgguru.ResultCache.key('invert', 1) != \
+           svgguru.ResultCache.key('invert', 2)
+
+
+def test_miss_then_hit(cache, tmp_path):
+    outfile = str(tmp_path / 'out.svg')
+    key = cache.key('invert', 'input')
+    assert not cache.fetch(key, outfile)
+    assert not os.path.exists(outfile)
+    with open(outfile, 'wb') as handle:
+        handle.write(b'<svg/>')
+    cache.store(key, outfile)
+    os.remove(outfile)
+    assert cache.fetch(key, outfile)
+    with open(outfile, 'rb') as handle:
+        assert handle.read() == b'<svg/>'
+    assert cache.fetch_data(key) == b'<svg/>'
+    assert cache.fetch_data(cache.key('other')) is None
+
+
+def test_cached_output_writes_once(cache, tmp_path):
+    outfile = str(tmp_path / 'out.svg')
+    calls = []
+
+    def write():
+        calls.append(1)
+        with open(outfile, 'wb') as handle:
+            handle.write(b'<svg/>')
+    key = cache.key('invert', 'input')
+    assert not cache.cached_output(key, outfile, write)
+    assert cache.cached_output(key, outfile, write)
+    assert len(calls) == 1
+
+
+def test_prune_evicts_least_recently_used(cache):
+    keys = [cache.key('entry', i) for i in range(4)]
+    for i, key in enumerate(keys):
+        cache.store_data(key, b'x' * 400)
+        set_last_use(cache, key, 1000000 + i)
+    # A hit refreshes the oldest entry.
+    assert cache.fetch_data(keys[0]) is not None
+    assert cache.summary()['size'] == 1600
+    assert cache.prune() == (2, 800)
+    assert [cache.fetch_data(key) is not None for key in keys] == \
+           [True, False, False, True]
+    assert cache.summary()['entries'] == 2
+
+
+def test_prune_within_limit(cache):
+    cache.store_data(cache.key('entry'), b'x' * 10)
+    assert cache.prune() == (0, 0)
+    assert cache.prune(max_size=0) == (1, 10)
+    assert cache.summary()['entries'] == 0
@@ -0,0 +1,60 @@
+import io
+import os
+
+import pytest
+from lxml import etree as ET
+
+import svgbench
+import svgguru
+
+TESTDATA = os.path.join(os.path.dirname(os.path.dirname(
+                            os.path.abspath(__file__))), 'testdata')
+STREAMING_COMMANDS = [('invert', {}), ('invertlight', {}),
+                      ('invertlight2', {}), ('invertoklab', {}),
+                      ('thicken', {'factor': 2.}), ('resizefont', {'factor': 1.5})]
+
+
+def canonical(data):
+    """Compare documents, not serializations (the stream engine drops the
+    unused namespace declarations, and does not write empty tags)."""
+    root = ET.fromstring(data)
+    ET.cleanup_namespaces(root)
+    return ET.tostring(root, method='c14n')
+
+
+@pytest.fixture(scope='module')
+def synthetic():
+    out = io.StringIO()
+    svgbench.generate_svg(out, nodes=300)
+    return out.getvalue().encode('utf-8')
+
+
+@pytest.mark.parametrize('command,kwargs', STREAMING_COMMANDS)
+def test_stream_matches_tree(synthetic, command, kwargs):
+    tree = svgguru.COMMANDS[command](synthetic, None, engine='tree', **kwargs)
+    stream = svgguru.COMMANDS[command](synthetic, None, engine='stream',
+                                       **kwargs)
+    assert canonical(tree) != canonical(synthetic)
+    assert canonical(stream) == canonical(tree)
+
+
+@pytest.mark.parametrize('filename', sorted(
+    name for name in os.listdir(TESTDATA) if name.endswith('.svg')))
+def test_stream_matches_tree_testdata(filename):
+    infile = os.path.join(TESTDATA, filename)
+    assert canonical(svgguru.svg_invert(infile, None, engine='stream')) == \
+           canonical(svgguru.svg_invert(infile, None, engine='tree'))
+
+
+@pytest.mark.parametrize('kwargs', [{'optimize': 3},
+                                    {'select': ['text']}])
+def test_stream_refuses_tree_options(synthetic, kwargs):
+    with pytest.raises(ValueError):
+        svgguru.svg_invert(synthetic, None, engine='stream', **kwargs)
+
+
+@pytest.mark.parametrize('command', svgguru.TREE_ONLY_COMMANDS)
+def test_stream_refuses_tree_commands(synthetic, command):
+    kwargs = {'factor': 2.} if command == 'rescale' else {}
+    with pytest.raises(ValueError):
+        svgguru.COMMANDS[command](synthetic, None, engine='stream', **kwargs)
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+import svgguru
+
+EDGE_VALUES = [0., -0., -1e-7, 1e-7, 1.5, -2.25, 100., 123.456789, 0.1,
+               1e19, -3e20]
+
+
+@pytest.mark.parametrize('value,precision,expected', [
+    (0., 6, '0'),
+    (-0., 6, '0'),
+    (-1e-7, 6, '0'),
+    (-1e-7, 0, '0'),
+    (100., 0, '100'),
+    (100., 3, '100'),
+    (1.5, 0, '2'),
+    (-2.25, 2, '-2.25'),
+    (123.456789, 2, '123.46'),
+    (0.1, 6, '0.1'),
+    (1e19, 0, '10000000000000000000'),
+    (-3e20, 2, '-300000000000000000000'),
+])
+def test_format_number(value, precision, expected):
+    assert svgguru.format_number(value, precision) == expected
+
+
+@pytest.mark.parametrize('precision', [0, 2, 6])
+def test_format_decimals_matches_format_number(precision):
+    values = np.array(EDGE_VALUES)
+    assert svgguru.format_decimals(values, precision) == \
+           [svgguru.format_number(value, precision) for value in EDGE_VALUES]
+
+
+def test_format_decimals_chunks():
+    values = np.random.RandomState(0).uniform(
+        -1e4, 1e4, svgguru.FORMAT_CHUNK_SIZE * 2 + 7)
+    values[svgguru.FORMAT_CHUNK_SIZE + 1] = 1e30
+    assert svgguru.format_decimals(values, 3) == \
+           [svgguru.format_number(value, 3) for value in values.tolist()]
+
+
+def test_format_decimals_empty():
+    assert svgguru.format_decimals(np.array([]), 3) == []
@@ -0,0 +1,133 @@
+import pytest
+from lxml import etree as ET
+
+import svg_slayer
+
+SVG_NS = 'http://www.w3.org/2000/svg'
+XLINK_NS = 'http://www.w3.org/1999/xlink'
+INKSCAPE_NS = 'http://www.inkscape.org/namespaces/inkscape'
+NS = {'svg': SVG_NS, 'xlink': XLINK_NS}
+
+DRAWING = b'''<?xml version="1.0" encoding="UTF-8"?>
+<svg xmlns="http://www.w3.org/2000/svg"
+     xmlns:svg="http://www.w3.org/2000/svg"
+     xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape"
+     width="100" height="50" viewBox="0 0 100 50">
+  <rect id="background" width="100" height="50"/>
+  <g inkscape:groupmode="layer" inkscape:label="A" id="layerA">
+    <circle id="a" r="5"/>
+  </g>
+  <g inkscape:groupmode="layer" inkscape:label="B" id="layerB"
+     style="display:none">
+    <rect id="b" width="5" height="5"/>
+    <g inkscape:groupmode="layer" inkscape:label="C" id="layerC">
+      <rect id="c" width="2" height="2"/>
+    </g>
+  </g>
+</svg>
+'''
+# C is only visible in the last frame: in the second one its parent B is
+# not shown.
+LAYERSETS = [['A'], ['A', 'C'], ['B', 'C']]
+
+
+@pytest.fixture
+def loaded():
+    return svg_slayer.load_layers(DRAWING)
+
+
+def export(loaded, mode, layersets=LAYERSETS):
+    tree, layers = loaded
+    return ET.fromstring(svg_slayer.export_animation(tree, layers, layersets,
+                                                     None, mode=mode))
+
+
+def layer(root, layer_id):
+    return root.find('.//svg:g[@id="%s"]' % layer_id, NS)
+
+
+def test_load_layers(loaded):
+    tree, layers = loaded
+    assert [label for label, _, _, _ in layers] == ['A', 'B', 'C']
+    assert tree.find('.//svg:g[@id="layerA"]', NS) is None
+    assert tree.find('.//svg:rect[@id="background"]', NS) is not None
+
+
+@pytest.mark.parametrize('mode', svg_slayer.ANIMATION_MODES)
+def test_layers_written_once(loaded, mode):
+    root = export(loaded, mode)
+    for element_id in ('background', 'a', 'b', 'c'):
+        assert len(root.findall('.//*[@id="%s"]' % element_id)) == 1
+    # Layers are attached in the default namespace, without prefix.
+    assert b'<svg:' not in ET.tostring(root)
+
+
+@pytest.mark.parametrize('mode', svg_slayer.ANIMATION_MODES)
+def test_tree_unchanged(loaded, mode):
+    tree, layers = loaded
+    before = ET.tostring(tree)
+    export(loaded, mode)
+    assert ET.tostring(tree) == before
+
+
+def test_unknown_mode(loaded):
+    with pytest.raises(ValueError):
+        export(loaded, 'gif')
+
+
+def test_smil(loaded):
+    root = export(loaded, 'smil')
+    a, b = layer(root, 'layerA'), layer(root, 'layerB')
+    assert a.get('display') == 'inline'
+    assert b.get('display') == 'none'
+    animate = a.find('svg:animate', NS)
+    assert animate.get('values') == 'inline;none'
+    assert animate.get('keyTimes') == '0;0.666667'
+    assert animate.get('dur') == '3s'
+    assert b.find('svg:animate', NS).get('values') == 'none;inline'
+
+
+def test_css(loaded):
+    root = export(loaded, 'css')
+    style = root.find('svg:style', NS).text
+    c = layer(root, 'layerC')
+    assert c.get('visibility') == 'hidden'
+    # C has the same visibility as B: both share the keyframes.
+    assert c.get('class') == 'slayer-l2'
+    assert '.slayer-l1 { animation: slayer-k1 3s' in style
+    assert '.slayer-l2 { animation: slayer-k1 3s' in style
+    assert '@keyframes slayer-k1 { 0% { visibility: hidden; } ' \
+           '66.6667% { visibility: visible; }' in style
+
+
+def test_target(loaded):
+    root = export(loaded, 'target')
+    frames = root.findall('svg:g[@class="slayer-frame"]', NS)
+    assert [frame.get('id') for frame in frames] == \
+           ['frame0', 'frame1', 'frame2']
+    assert 'slayer-first' in layer(root, 'layerA').get('class')
+    assert 'slayer-first' not in layer(root, 'layerC').get('class')
+    style = root.find('svg:style', NS).text
+    assert '#frame2:target ~ .slayer-l1' in style
+    assert '#frame1:target ~ .slayer-l2' in style
+
+
+def test_sprites(loaded):
+    root = export(loaded, 'sprites')
+    assert root.get('viewBox') == '0 0 200 100'
+    assert root.get('width') == '200'
+    segments = {}
+    for group in root.find('svg:defs', NS):
+        segments[group.get('id')] = set(
+            element.get('id') for element in group.iter()
+            if element.get('id') in ('background', 'a', 'b', 'c'))
+    drawn = []
+    for cell in root.findall('svg:svg', NS):
+        drawn.append(set().union(*[
+            segments[use.get('{%s}href' % XLINK_NS)[1:]]
+            for use in cell.findall('svg:use', NS)]))
+    assert drawn == [{'background', 'a'},
+                     {'background', 'a'},
+                     {'background', 'b', 'c'}]
+    assert [view.get('id') for view in root.findall('svg:view', NS)] == \
+           ['frame0', 'frame1', 'frame2']